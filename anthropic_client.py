@@ -0,0 +1,170 @@
+"""
+Anthropic client construction with a tuned HTTP transport and connection warm-up.
+
+The SDK's default transport closes idle connections after 5 seconds, so most turns after a
+pause pay DNS, TCP and TLS setup again. Clients built here keep connections alive longer,
+use explicit connect/read timeouts, optionally speak HTTP/2, and can open their connection
+ahead of the first request (warm_up) or keep it open while idle (KeepWarm).
+
+Warm-up requests list a single model: they are authenticated but cost no tokens.
+"""
+import time
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+import anthropic
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def transport_options(max_connections: int = 100, max_keepalive_connections: int = 20,
+                      keepalive_expiry: float = 60.0, connect_timeout: float = 5.0,
+                      read_timeout: float = 180.0, http2: bool = False) -> dict:
+    """
+    Keyword arguments for an httpx client with the given pool and timeout settings.
+
+    Args:
+        max_connections: Open connections allowed in the pool
+        max_keepalive_connections: Idle connections kept open for reuse
+        keepalive_expiry: Seconds an idle connection is kept before being closed
+        connect_timeout: Seconds allowed to establish a connection
+        read_timeout: Seconds allowed between received bytes (also used for write and pool waits)
+        http2: Negotiate HTTP/2, multiplexing requests over fewer connections
+
+    Returns:
+        dict: limits, timeout and http2 options
+
+    Raises:
+        RuntimeError: If HTTP/2 is requested but the h2 package is not installed
+    """
+    if http2:
+        try:
+            import h2  # noqa: F401 (httpx needs it for HTTP/2)
+        except ImportError:
+            raise RuntimeError("CLIENT_HTTP2 requires the h2 package: pip install 'httpx[http2]'")
+
+    return {
+        'limits': httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        'timeout': httpx.Timeout(read_timeout, connect=connect_timeout),
+        'http2': http2,
+    }
+
+
+def create_client(api_key: str, base_url: Optional[str] = None, max_retries: int = 0,
+                  rate_limiter=None, **transport) -> anthropic.Anthropic:
+    """
+    Build a synchronous Anthropic client with a tuned transport.
+
+    Args:
+        api_key: Anthropic API key
+        base_url: API base URL (defaults to the SDK's)
+        max_retries: SDK-level retries; 0 because step and sentiment calls retry through
+                     retry_policy (warm-up pings are best-effort and only logged)
+        rate_limiter: AdaptiveRateLimiter to feed with every response's rate-limit headers
+        **transport: Options for transport_options
+
+    Returns:
+        anthropic.Anthropic
+    """
+    options = transport_options(**transport)
+    if rate_limiter is not None:
+        options['event_hooks'] = {'response': [rate_limiter.observe_response]}
+    return anthropic.Anthropic(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=max_retries,
+        timeout=options['timeout'],
+        http_client=anthropic.DefaultHttpxClient(**options),
+    )
+
+
+def create_async_client(api_key: str, base_url: Optional[str] = None, max_retries: int = 0,
+                        rate_limiter=None, **transport) -> anthropic.AsyncAnthropic:
+    """Same as create_client, for anthropic.AsyncAnthropic"""
+    options = transport_options(**transport)
+    if rate_limiter is not None:
+        options['event_hooks'] = {'response': [rate_limiter.observe_response_async]}
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=max_retries,
+        timeout=options['timeout'],
+        http_client=anthropic.DefaultAsyncHttpxClient(**options),
+    )
+
+
+def warm_up(client: anthropic.Anthropic) -> Optional[float]:
+    """
+    Open a pooled connection to the API with a request that costs no tokens.
+
+    Args:
+        client: Anthropic client
+
+    Returns:
+        Seconds taken, or None if the request failed (failures are only logged)
+    """
+    start_time = time.monotonic()
+    try:
+        client.models.list(limit=1)
+    except anthropic.APIError as e:
+        logger.warning(f"Anthropic client warm-up failed: {type(e).__name__} - {str(e)}")
+        return None
+    return time.monotonic() - start_time
+
+
+async def warm_up_async(client: anthropic.AsyncAnthropic) -> Optional[float]:
+    """Same as warm_up, for anthropic.AsyncAnthropic"""
+    start_time = time.monotonic()
+    try:
+        await client.models.list(limit=1)
+    except anthropic.APIError as e:
+        logger.warning(f"Anthropic client warm-up failed: {type(e).__name__} - {str(e)}")
+        return None
+    return time.monotonic() - start_time
+
+
+def warm_up_in_background(client: anthropic.Anthropic) -> threading.Thread:
+    """Run warm_up on a daemon thread so startup is not held up by it"""
+    thread = threading.Thread(target=warm_up, args=(client,), name='anthropic-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+class KeepWarm:
+    """
+    Pings the API from a daemon thread so an idle client keeps an open connection.
+
+    The interval must be shorter than the client's keepalive expiry, or the pooled
+    connection is closed between pings.
+    """
+
+    def __init__(self, client: anthropic.Anthropic, interval: float):
+        self.client = client
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='anthropic-keep-warm', daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            warm_up(self.client)
+
+    def start(self) -> 'KeepWarm':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+async def keep_warm_async(client: anthropic.AsyncAnthropic, interval: float) -> None:
+    """Ping the API every interval seconds until cancelled (run as an asyncio task)"""
+    while True:
+        await asyncio.sleep(interval)
+        await warm_up_async(client)
@@ -1,4 +1,6 @@
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, Response, request, jsonify, session, send_from_directory
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from flask_cors import CORS
 import anthropic
 from steps.step1 import handle_step1
@@ -6,13 +8,37 @@ from steps.step2 import handle_step2
 from steps.step3 import handle_step3
 from steps.step4 import handle_step4
 from steps.step5 import handle_step5
-import re
+from steps.engine import engine
 import os
+import secrets
 import json
+import time
+import queue
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from config import (SESSION_CONFIG, STEPS, ANTHROPIC_API_KEY, 
-                   STEP_COMPLETE_MARKER)
-from utils import truncate_history, extract_goal, remove_step_headers, with_retry
+                   STEP_COMPLETE_MARKER, EXECUTOR_MAX_WORKERS, SENTIMENT_TIMEOUT,
+                   SENTIMENT_BACKEND, SESSION_BACKEND, SESSION_LRU_MAX_ENTRIES, SESSION_SQLITE_PATH,
+                   SESSION_REDIS_URL, SESSION_COMPRESSION, SESSION_COOKIE_MAX_CHUNKS,
+                   SESSION_HISTORY_CHAR_LIMIT, CONTEXT_EXACT_TOKEN_COUNT, COMPACT_COMPLETED_STEPS,
+                   TRANSCRIPT_ARCHIVE, TRANSCRIPT_SQLITE_PATH, TRANSCRIPT_REDIS_URL, TRANSCRIPT_TTL,
+                   CLIENT_TRANSPORT, CLIENT_WARM_UP, CLIENT_KEEP_WARM_INTERVAL, RATE_LIMIT_ADAPTIVE,
+                   SPECULATIVE_PREFETCH, PREFETCH_INPUT, PREFETCH_TTL, PREFETCH_MAX_ENTRIES,
+                   PREFETCH_MAX_WORKERS, PREFETCH_WAIT_TIMEOUT, STREAM_COMMIT_MAX_AGE)
+from utils import extract_goal, remove_step_headers, with_retry, usage_summary
+from sentiment import get_sentiment_scorer
+from stream_parser import ResponseStreamParser
+from context import configure_token_counter
+from compaction import compact_step_history, create_transcript_archive
+from session_store import ServerSideSessionInterface, create_session_interface
+from anthropic_client import KeepWarm, create_client, warm_up_in_background
+from retry_policy import CircuitOpenError, circuit_breaker
+from rate_limiter import RateLimitTimeout, rate_limiter
+from router import model_router
+from prefetch import StepPrefetcher
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, keyed_collector, phase_seconds,
+                     registry as metrics_registry, snapshot_collector)
 
 # Configure logging
 logging.basicConfig(
@@ -23,12 +49,24 @@ logger = logging.getLogger(__name__)
 
 def configure_sessions(app):
     """
-    Configure sessions for Vercel deployment - serverless environment requires simpler session handling
+    Configure sessions. Cookie sessions (the default) suit Vercel's serverless environment;
+    server-side backends keep only an opaque session id in the cookie.
     """
     # Apply all session configuration from config file
     for key, value in SESSION_CONFIG.items():
         app.config[key] = value
     
+    session_interface = create_session_interface(
+        SESSION_BACKEND,
+        lru_max_entries=SESSION_LRU_MAX_ENTRIES,
+        sqlite_path=SESSION_SQLITE_PATH,
+        redis_url=SESSION_REDIS_URL,
+        compression=SESSION_COMPRESSION,
+        cookie_max_chunks=SESSION_COOKIE_MAX_CHUNKS
+    )
+    if session_interface is not None:
+        app.session_interface = session_interface
+    
     return app
 
 app = Flask(__name__)
@@ -37,12 +75,32 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable caching for static files
 CORS(app)
 
 try:
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    client = create_client(ANTHROPIC_API_KEY, rate_limiter=rate_limiter if RATE_LIMIT_ADAPTIVE else None,
+                           **CLIENT_TRANSPORT)
     logger.info("Successfully initialized Anthropic client")
 except Exception as e:
     logger.error(f"Error initializing Anthropic client: {str(e)}")
     raise RuntimeError(f"Failed to initialize Anthropic client: {str(e)}")
 
+if CLIENT_WARM_UP:
+    # Open the API connection while the rest of the app loads, not on the first turn
+    warm_up_in_background(client)
+if CLIENT_KEEP_WARM_INTERVAL > 0:
+    keep_warm = KeepWarm(client, CLIENT_KEEP_WARM_INTERVAL).start()
+
+if CONTEXT_EXACT_TOKEN_COUNT:
+    # Step handlers size their context with exact counts from the token-counting API
+    configure_token_counter(client)
+
+# Background sentiment scoring, so it runs alongside the step call on the request thread
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix='fivestep')
+
+# Opening turns of the next step, generated when a step completes (SPECULATIVE_PREFETCH), on
+# a pool of their own so they never hold up sentiment scoring
+prefetcher = StepPrefetcher(PREFETCH_MAX_ENTRIES, PREFETCH_TTL) if SPECULATIVE_PREFETCH else None
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS,
+                                       thread_name_prefix='fivestep-prefetch') if SPECULATIVE_PREFETCH else None
+
 # Map step numbers to their functions
 step_functions = {
     1: handle_step1,
@@ -55,53 +113,57 @@ step_functions = {
 # Use steps from config
 steps = STEPS
 
-# New: Function to analyze rationality vs emotionality using Claude
-def analyze_response_sentiment(user_input, client):
+# Cold storage for the raw turns of compacted steps
+transcript_archive = create_transcript_archive(
+    TRANSCRIPT_ARCHIVE,
+    TRANSCRIPT_TTL,
+    sqlite_path=TRANSCRIPT_SQLITE_PATH,
+    redis_url=TRANSCRIPT_REDIS_URL
+) if COMPACT_COMPLETED_STEPS else None
+
+# Scorer selected by SENTIMENT_BACKEND in config ('llm', 'lexicon' or 'inline')
+sentiment_scorer = get_sentiment_scorer(SENTIMENT_BACKEND, client)
+logger.info(f"Using '{sentiment_scorer.name}' sentiment backend")
+
+def analyze_response_sentiment(user_input, scorer=None):
     """
     Analyzes whether a user response is more rational or emotional
     Returns a score from -10 (highly emotional) to +10 (highly rational)
     """
-    system_content = """
-    Analyze the following text and rate it on a rationality vs emotionality scale from -10 to +10:
-    - -10 to -7: Highly emotional (dominated by feelings, passions, subjective experiences)
-    - -6 to -3: Moderately emotional (contains emotional language but with some reasoning)
-    - -2 to +2: Balanced (contains both emotional and rational elements in equilibrium)
-    - +3 to +6: Moderately rational (logical with some emotional components)
-    - +7 to +10: Highly rational (dominated by logic, evidence, structured reasoning)
-    
-    Provide ONLY a single number score between -10 and +10 without any explanation.
+    with phase_seconds.time(phase='sentiment'):
+        return (scorer or sentiment_scorer).score(user_input)
+
+def start_sentiment(user_input):
     """
+    Starts scoring the user input and returns a future for the result.
+    Local scorers finish in well under a millisecond, so they run inline
+    instead of taking a slot on the shared executor.
+    """
+    if sentiment_scorer.is_local:
+        future = Future()
+        future.set_result(analyze_response_sentiment(user_input))
+        return future
+    return executor.submit(analyze_response_sentiment, user_input)
+
+def resolve_sentiment(future, deadline, fallback):
+    """
+    Waits for a sentiment future until the request deadline passes.
     
+    Args:
+        future: Future returned by submitting analyze_response_sentiment
+        deadline: Absolute time.monotonic() value after which we stop waiting
+        fallback: Score to use when the call runs late (the last sentiment EMA)
+    
+    Returns:
+        The sentiment score, or the fallback if the deadline was missed
+    """
     try:
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=10,
-            system=system_content,
-            messages=[{"role": "user", "content": user_input}]
-        )
-        score_text = response.content[0].text.strip()
-        
-        # Extract numeric score, handling potential formatting issues
-        score = None
-        try:
-            # Try direct conversion first
-            score = int(score_text)
-        except ValueError:
-            # If that fails, search for a number pattern
-            import re
-            number_pattern = r'-?\d+'
-            match = re.search(number_pattern, score_text)
-            if match:
-                score = int(match.group(0))
-        
-        # Ensure score is within bounds
-        if score is not None:
-            return max(min(score, 10), -10)
-        else:
-            return 0  # Default to neutral if parsing fails
-    except Exception as e:
-        logger.error(f"Error analyzing sentiment: {str(e)}")
-        return 0  # Default to neutral on error
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        # Don't hold the turn for theming data - the result is simply dropped
+        future.cancel()
+        logger.warning("Sentiment analysis missed its deadline, reusing last EMA")
+        return fallback
 
 def generate_email_summary(session_data):
     """
@@ -202,18 +264,24 @@ class SessionState:
     
     @history.setter
     def history(self, value):
-        # Apply compression before storing to reduce cookie size
-        self.session['history'] = truncate_history(value)
+        # Stored verbatim; build_messages decides what each request compresses or drops
+        self.session['history'] = value
     
     def add_message(self, role, content):
         history = self.history.copy()
         history.append({'role': role, 'content': content})
         
-        # Ensure we never exceed our cookie size limit by aggressive truncation if needed
-        if len(str(history)) > 3500:  # Leave some margin for other session data
-            logger.warning("History size exceeding safe limit, performing aggressive truncation")
-            # Keep only last 5 messages to prevent cookie overflow
-            history = history[-5:]
+        # Cookie sessions can't hold an unbounded history: drop the oldest exchanges, unchanged,
+        # until it fits (the limit depends on the cookie encoding; server-side backends have none)
+        size = len(str(history)) if SESSION_HISTORY_CHAR_LIMIT else 0
+        if SESSION_HISTORY_CHAR_LIMIT and size > SESSION_HISTORY_CHAR_LIMIT:
+            logger.warning("History size exceeding safe limit, dropping oldest messages")
+            start = 0
+            while len(history) - start > 2 and size > SESSION_HISTORY_CHAR_LIMIT:
+                # Each message's repr plus its ', ' separator
+                size -= len(str(history[start])) + len(str(history[start + 1])) + 4
+                start += 2
+            history = history[start:]
             
         self.history = history
     
@@ -234,6 +302,40 @@ class SessionState:
         evaluations[str(step)] = evaluation
         self.session['step_evaluations'] = evaluations
     
+    @property
+    def archive_id(self):
+        """Identifies this conversation's archived transcripts; created on first use"""
+        if not self.session.get('archive_id'):
+            self.session['archive_id'] = secrets.token_urlsafe(16)
+        return self.session['archive_id']
+    
+    @property
+    def commit_nonce(self):
+        """Changes with every turn and step change; /chat/commit only applies snapshots made from the current one"""
+        return self.session.get('commit_nonce')
+    
+    def rotate_commit_nonce(self):
+        self.session['commit_nonce'] = secrets.token_urlsafe(8)
+    
+    def compact_step(self, step, archive=None):
+        """Replaces a completed step's turns in history with its summary, archiving the raw turns"""
+        history, transcript = compact_step_history(
+            self.history,
+            step,
+            get_step_info(step)['name'],
+            self.goal,
+            self.step_evaluations.get(str(step), '')
+        )
+        if not transcript:
+            return
+        
+        if archive is not None:
+            try:
+                archive.save(self.archive_id, step, transcript)
+            except Exception as e:
+                logger.error(f"Error archiving step {step} transcript: {str(e)}")
+        self.history = history
+    
     # New: Properties for sentiment tracking
     @property
     def sentiment_ema(self):
@@ -251,62 +353,155 @@ class SessionState:
         self._initialize_if_needed()
 
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        # Use our new SessionState class to manage state
-        state = SessionState(session)
+def prefetch_fingerprint(step, goal, history):
+    """The parts of a session a prefetched turn depends on"""
+    return (step, goal, len(history), history[-1]['content'] if history else None)
+
+def start_prefetch(state):
+    """Starts generating the opening turn of the session's new step in the background"""
+    if circuit_breaker.state != 'closed':
+        return
+    step, goal = state.current_step, state.goal
+    history = state.history
+    # The step call reads its own copy while later turns keep updating the session
+    snapshot = [dict(message) for message in history]
+    prefetcher.start(state.archive_id, prefetch_fingerprint(step, goal, history),
+                     lambda: prefetch_executor.submit(step_functions[step], PREFETCH_INPUT, snapshot, goal, client))
+
+WELCOME_MESSAGE = (
+    "STEP 1: HAVE CLEAR GOALS\n\n"
+    " Hi there! What goal would you like to focus on today? "
+    "Think about something meaningful you're working toward. The more specific you can be, the better we can work together.\n\n"
+    "CURRENT STEP: 1 - HAVE CLEAR GOALS"
+)
+
+class ChatTurn:
+    """Per-turn inputs shared by the JSON and streaming chat endpoints"""
+    
+    def __init__(self, state, user_input):
+        self.state = state
+        self.user_input = user_input
         
-        data = request.get_json()
-        user_input = data.get('user_input', '')
+        # Start sentiment scoring in the background; it must never delay the step call
+        self.sentiment_deadline = time.monotonic() + SENTIMENT_TIMEOUT
+        self.sentiment_future = start_sentiment(user_input)
         
-        # New: Calculate sentiment score using Claude and update EMA
-        sentiment_score = analyze_response_sentiment(user_input, client)
-        alpha = 0.3  # Smoothing factor for EMA
-        new_ema = alpha * sentiment_score + (1 - alpha) * state.sentiment_ema
-        state.sentiment_ema = new_ema
+        # build_messages fits the history to the step's token budget
+        self.history = state.history
+        self.goal = state.goal
+        self.current_step = state.current_step
+        self.step_function = step_functions[self.current_step]
         
-        # Get and truncate history to manage token count
-        history = truncate_history(state.history)
-        goal = state.goal
-        current_step = state.current_step
-        step_function = step_functions[current_step]
+        # Reply generated when the previous step completed, if this message just says "go on"
+        self.prefetched = None
+        session_key = state.session.get('archive_id')
+        if prefetcher is not None and session_key:
+            self.prefetched = prefetcher.claim(
+                session_key, prefetch_fingerprint(self.current_step, self.goal, self.history), user_input)
+    
+    @property
+    def is_greeting(self):
+        """First message is a greeting - we'll auto-generate a welcome message"""
+        return len(self.history) == 0 and self.user_input.lower() in ['hi', 'hello', 'hey', 'start']
+    
+    def run_step(self, on_text=None):
+        """Runs the step handler for this turn"""
+        # Do NOT modify the step function calls or pass sentiment info to them
+        if on_text is None:
+            return self.step_function(self.user_input, self.history, self.goal, client)
+        return self.step_function(self.user_input, self.history, self.goal, client, on_text=on_text)
+    
+    def use_prefetched(self, on_text=None):
+        """
+        Returns the prefetched step result, passing its text to on_text in one piece, or runs
+        the step handler if the prefetch failed or is not done within PREFETCH_WAIT_TIMEOUT
+        """
+        try:
+            result = self.prefetched.result(timeout=PREFETCH_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            self.prefetched.cancel()
+            logger.warning(f"Prefetched turn not done within {PREFETCH_WAIT_TIMEOUT:g}s, running the step instead")
+            prefetcher.record_failure()
+            return self.run_step(on_text)
+        except Exception as e:
+            logger.warning(f"Prefetched turn failed, running the step instead: {str(e)}")
+            prefetcher.record_failure()
+            return self.run_step(on_text)
+        return self.serve_prefetched(result, on_text)
+    
+    def serve_prefetched(self, result, on_text=None):
+        """Counts a prefetch hit and returns its step result as this turn's"""
+        prefetcher.record_hit()
+        if on_text is not None:
+            on_text(result.response)
+        # An inline score in the prefetched reply rated PREFETCH_INPUT, not the user's message
+        return result._replace(sentiment_score=None)
+    
+    def step_result(self, on_text=None):
+        """Runs the step handler (or takes the prefetched result) on the calling thread"""
+        if self.prefetched is not None:
+            return self.use_prefetched(on_text)
+        return self.run_step(on_text)
+    
+    def submit_step(self, on_text=None):
+        """
+        Runs step_result on a thread of its own and returns its future, for streams whose request
+        thread is busy forwarding text. Not the shared executor, where the step would queue
+        behind sentiment scoring.
+        """
+        future = Future()
         
-        # Handle special case for first message - we'll auto-generate a welcome message
-        if len(history) == 0 and user_input.lower() in ['hi', 'hello', 'hey', 'start']:
-            welcome_message = (
-                "STEP 1: HAVE CLEAR GOALS\n\n"
-                " Hi there! What goal would you like to focus on today? "
-                "Think about something meaningful you're working toward. The more specific you can be, the better we can work together.\n\n"
-                "CURRENT STEP: 1 - HAVE CLEAR GOALS"
-            )
-            
-            # Update conversation history with full message including markers (for system use)
-            state.add_message('user', user_input)
-            state.add_message('assistant', welcome_message)
-            
-            # Clean welcome message for user display
-            cleaned_welcome = remove_step_headers(welcome_message)
-            
-            return jsonify({
-                'main_response': cleaned_welcome,
-                'evaluation_summary': '',
-                'completed_steps': [],
-                'current_step': 1,
-                'step_info': get_step_info(1),
-                # Include sentiment data for UI theming only
-                'sentiment_score': sentiment_score,
-                'sentiment_ema': state.sentiment_ema,
-                # Bot name will be generated in the frontend
-            })
+        def run():
+            try:
+                future.set_result(self.step_result(on_text))
+            except BaseException as e:
+                future.set_exception(e)
         
-        # Normal flow for all other messages - with retry
-        # Do NOT modify the step function calls or pass sentiment info to them
-        main_response, is_complete, evaluation_summary = step_function(user_input, history, goal, client)
+        future.set_running_or_notify_cancel()
+        threading.Thread(target=run, name='fivestep-stream-step', daemon=True).start()
+        return future
+    
+    def welcome(self):
+        """Records the welcome exchange and returns the response payload"""
+        state = self.state
+        sentiment_score = update_sentiment(state, self.sentiment_future, self.sentiment_deadline)
+        
+        # Update conversation history with full message including markers (for system use)
+        state.add_message('user', self.user_input)
+        state.add_message('assistant', WELCOME_MESSAGE)
+        state.rotate_commit_nonce()
+        
+        return {
+            # Clean welcome message for user display
+            'main_response': remove_step_headers(WELCOME_MESSAGE),
+            'evaluation_summary': '',
+            'completed_steps': [],
+            'current_step': 1,
+            'step_info': get_step_info(1),
+            # Include sentiment data for UI theming only
+            'sentiment_score': sentiment_score,
+            'sentiment_ema': state.sentiment_ema,
+            # Bot name will be generated in the frontend
+        }
+    
+    def complete(self, main_response, is_complete, evaluation_summary, inline_sentiment=None, goal=None,
+                 visible_response=None):
+        """
+        Applies a step handler result to the session and returns the response payload.
+        An inline sentiment score from the step reply replaces the separately scored one.
+        The goal and visible response come from the step engine's post-processing; they are
+        only derived here from main_response when a handler didn't supply them.
+        """
+        state = self.state
+        current_step = self.current_step
+        sentiment_score = update_sentiment(state, self.sentiment_future, self.sentiment_deadline,
+                                           inline_sentiment)
+        start_time = time.perf_counter()
 
         # Update conversation history
-        state.add_message('user', user_input)
+        state.add_message('user', self.user_input)
         state.add_message('assistant', main_response)
+        state.rotate_commit_nonce()
 
         # Store evaluation summary for this step if provided
         if evaluation_summary:
@@ -318,15 +513,21 @@ def chat():
             
             if current_step == 1:
                 # Extract and store goal from step 1 completion
-                extracted_goal = extract_goal(main_response)
+                extracted_goal = goal or (extract_goal(main_response) if visible_response is None else None)
                 if extracted_goal:
                     state.goal = extracted_goal
                 else:
                     logger.warning("Could not extract goal from step 1 completion")
             
+            if COMPACT_COMPLETED_STEPS:
+                # Later steps see the step's summary instead of its raw turns
+                state.compact_step(current_step, transcript_archive)
+            
             # Move to next step if not on final step
             if current_step < 5:
                 state.current_step = current_step + 1
+                if prefetcher is not None:
+                    start_prefetch(state)
 
         # Prepare data for frontend
         completed_steps = [
@@ -339,12 +540,11 @@ def chat():
             }
             for i in state.completed_steps
         ]
+        phase_seconds.observe(time.perf_counter() - start_time, phase='complete', step=current_step)
         
-        # Clean response for user display
-        cleaned_response = remove_step_headers(main_response)
-
-        return jsonify({
-            'main_response': cleaned_response,
+        return {
+            # Clean response for user display
+            'main_response': visible_response if visible_response is not None else remove_step_headers(main_response),
             'evaluation_summary': evaluation_summary,
             'completed_steps': completed_steps,
             'current_step': state.current_step,
@@ -353,61 +553,199 @@ def chat():
             'sentiment_score': sentiment_score,
             'sentiment_ema': state.sentiment_ema,
             # Bot name will be generated in the frontend
-        })
-    except anthropic.APIError as api_err:
+        }
+
+def error_payload(error, state_source):
+    """
+    Builds the friendly error payload returned by the chat endpoints.
+    
+    Args:
+        error: The exception raised while handling the turn
+        state_source: Mapping with the session data to report back
+        
+    Returns:
+        dict: Payload for the frontend
+    """
+    if isinstance(error, (CircuitOpenError, RateLimitTimeout)):
+        # The turn was never sent: recent calls kept failing, or we are at the API rate limit
+        logger.warning(f"Failing fast: {str(error)}")
+        user_message = "The AI service is currently overloaded. Please try again in a moment."
+        evaluation_summary = f"API unavailable: {str(error)}"
+    elif isinstance(error, anthropic.APIError):
         # Handle API-specific errors
-        logger.error(f"Anthropic API error: {str(api_err)}")
-        error_type = type(api_err).__name__
+        logger.error(f"Anthropic API error: {str(error)}")
+        error_type = type(error).__name__
         
-        if isinstance(api_err, anthropic.RateLimitError):
+        if isinstance(error, anthropic.RateLimitError):
             user_message = "The AI service is currently overloaded. Please try again in a moment."
-        elif isinstance(api_err, anthropic.APITimeoutError):
+        elif isinstance(error, anthropic.APITimeoutError):
             user_message = "The request timed out. Please try again or reset the conversation."
-        elif isinstance(api_err, anthropic.APIConnectionError):
+        elif isinstance(error, anthropic.APIConnectionError):
             user_message = "Could not connect to the AI service. Please check your internet connection."
         else:
             user_message = "There was an issue with the AI service. Please try again later."
-            
-        # Get sentiment EMA for bot name
-        sentiment_ema = session.get('sentiment_ema', 0)
-        
-        return jsonify({
-            'main_response': user_message,
-            'evaluation_summary': f"API Error ({error_type}): {str(api_err)}",
-            'completed_steps': session.get('completed_steps', []),
-            'current_step': session.get('current_step', 1),
-            'step_info': get_step_info(session.get('current_step', 1)),
-            'sentiment_score': 0,
-            'sentiment_ema': sentiment_ema
-            # Bot name will be generated in the frontend
-        }), 500
-        
-    except Exception as e:
+        evaluation_summary = f"API Error ({error_type}): {str(error)}"
+    else:
         # Handle any other errors
-        error_message = f"An error occurred: {str(e)}"
-        logger.error(error_message, exc_info=True)
+        evaluation_summary = f"An error occurred: {str(error)}"
+        logger.error(evaluation_summary, exc_info=error)
         
         # Create a more user-friendly message
-        user_error_message = "I encountered an error. Please try again or reset the conversation."
+        user_message = "I encountered an error. Please try again or reset the conversation."
         
         # Check for common error patterns
-        error_str = str(e).lower()
+        error_str = str(error).lower()
         if "token" in error_str or "exceed" in error_str or "overload" in error_str:
-            user_error_message = "The conversation has become too long. Please reset the conversation to continue."
-        
+            user_message = "The conversation has become too long. Please reset the conversation to continue."
+    
+    return {
+        'main_response': user_message,
+        'evaluation_summary': evaluation_summary,
+        'completed_steps': state_source.get('completed_steps', []),
+        'current_step': state_source.get('current_step', 1),
+        'step_info': get_step_info(state_source.get('current_step', 1)),
+        'sentiment_score': 0,
         # Get sentiment EMA for bot name
-        sentiment_ema = session.get('sentiment_ema', 0)
+        'sentiment_ema': state_source.get('sentiment_ema', 0)
+        # Bot name will be generated in the frontend
+    }
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    start_time = time.perf_counter()
+    step = ''
+    try:
+        # Use our new SessionState class to manage state
+        state = SessionState(session)
         
-        return jsonify({
-            'main_response': user_error_message,
-            'evaluation_summary': error_message,
-            'completed_steps': session.get('completed_steps', []),
-            'current_step': session.get('current_step', 1),
-            'step_info': get_step_info(session.get('current_step', 1)),
-            'sentiment_score': 0,
-            'sentiment_ema': sentiment_ema
-            # Bot name will be generated in the frontend
-        }), 500
+        data = request.get_json()
+        turn = ChatTurn(state, data.get('user_input', ''))
+        step = turn.current_step
+        
+        # Handle special case for first message - we'll auto-generate a welcome message
+        if turn.is_greeting:
+            return jsonify(turn.welcome())
+        
+        # Normal flow for all other messages - with retry, on the request thread
+        return jsonify(turn.complete(*turn.step_result()))
+    except Exception as e:
+        return jsonify(error_payload(e, session)), 500
+    finally:
+        phase_seconds.observe(time.perf_counter() - start_time, phase='request', step=step)
+
+def sse_event(event, data):
+    """Formats one Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_commit_serializer():
+    """Signs the session snapshot handed back to the browser at the end of a stream"""
+    return URLSafeTimedSerializer(app.secret_key, salt='chat-stream-commit',
+                                  serializer=TaggedJSONSerializer())
+
+def stream_commit_token(base_nonce, snapshot):
+    """
+    Signed session_token for /chat/commit: the session after a streamed turn, bound to the
+    commit nonce the live session had when the turn started
+    """
+    return stream_commit_serializer().dumps({'base': base_nonce, 'session': dict(snapshot)})
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming variant of /chat. Forwards the visible reply text as `token` events and ends
+    with a `done` event carrying the same fields as /chat, or an `error` event.
+    
+    The session cookie is written before the body starts streaming, so the turn runs
+    against a copy of the session. Server-side sessions are saved to the store when the
+    turn finishes; with cookie sessions the `done` event carries a signed `session_token`
+    that the browser posts to /chat/commit to persist the updated state.
+    """
+    # Initialize the live session first so a new visitor's cookie goes out with the headers
+    base_nonce = SessionState(session).commit_nonce
+    state = SessionState(dict(session))
+    server_side_sid = session.sid if isinstance(app.session_interface, ServerSideSessionInterface) else None
+    data = request.get_json()
+    try:
+        turn = ChatTurn(state, data.get('user_input', ''))
+    except Exception as e:
+        return jsonify(error_payload(e, state.session)), 500
+    
+    def generate():
+        start_time = time.perf_counter()
+        try:
+            if turn.is_greeting:
+                payload = turn.welcome()
+                yield sse_event('token', {'text': payload['main_response']})
+            else:
+                events = queue.Queue()
+                step_future = turn.submit_step(on_text=events.put)
+                step_future.add_done_callback(lambda _: events.put(None))
+                
+                # Forward visible text as it arrives; None marks the end of the step call.
+                # The parser holds back evaluation blocks, markers and step headers.
+                parser = ResponseStreamParser()
+                while True:
+                    text = events.get()
+                    if text is None:
+                        break
+                    visible = parser.feed(text)
+                    if visible:
+                        yield sse_event('token', {'text': visible})
+                visible = parser.close()
+                if visible:
+                    yield sse_event('token', {'text': visible})
+                
+                payload = turn.complete(*step_future.result())
+            
+            if server_side_sid:
+                # Server-side sessions can be written directly once the turn finishes
+                app.session_interface.save_state(app, server_side_sid, state.session)
+            else:
+                payload['session_token'] = stream_commit_token(base_nonce, state.session)
+            yield sse_event('done', payload)
+        except Exception as e:
+            yield sse_event('error', error_payload(e, state.session))
+        finally:
+            phase_seconds.observe(time.perf_counter() - start_time, phase='request', step=turn.current_step)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/chat/commit', methods=['POST'])
+def commit_stream():
+    """
+    Persists the session snapshot produced by a /chat/stream turn. A token is only accepted
+    while the session is still in the state the turn started from, so it can't be replayed
+    later to roll the session back, applied twice, or applied to another session.
+    """
+    data = request.get_json()
+    try:
+        token = stream_commit_serializer().loads(data.get('session_token', ''), max_age=STREAM_COMMIT_MAX_AGE)
+        base_nonce, snapshot = token['base'], token['session']
+    except (BadSignature, KeyError, TypeError):
+        return jsonify({'status': 'error', 'message': 'Invalid session token'}), 400
+    
+    if SessionState(session).commit_nonce != base_nonce:
+        return jsonify({'status': 'error', 'message': 'Session changed since this turn started'}), 409
+    session.clear()
+    session.update(snapshot)
+    return jsonify({'status': 'success'})
+
+def update_sentiment(state, sentiment_future, sentiment_deadline, inline_sentiment=None):
+    """
+    Folds the turn's sentiment score into the session EMA and returns the score: the inline
+    score from the step reply when there is one, else the background score
+    """
+    if inline_sentiment is not None:
+        sentiment_future.cancel()
+        sentiment_score = inline_sentiment
+    else:
+        # Time the turn spends blocked on the score, after the step call has finished
+        with phase_seconds.time(phase='sentiment_wait', step=state.current_step):
+            sentiment_score = resolve_sentiment(sentiment_future, sentiment_deadline, state.sentiment_ema)
+    alpha = 0.3  # Smoothing factor for EMA
+    state.sentiment_ema = alpha * sentiment_score + (1 - alpha) * state.sentiment_ema
+    return sentiment_score
 
 def get_step_info(step_number):
     """Returns information about the current step"""
@@ -425,6 +763,7 @@ def set_step():
     # Ensure they can only go to a completed step or the current step
     if step in state.completed_steps or step == state.current_step:
         state.current_step = step
+        state.rotate_commit_nonce()
         return jsonify({
             'status': 'success',
             'current_step': step,
@@ -488,6 +827,29 @@ def serve_frontend():
         # Return a basic HTML response in case the static file can't be found
         return '<html><body><h1>5-Step Process</h1><p>There was an error loading the application. Please check the server logs.</p></body></html>'
     
+# Components that keep their own counters are read when /metrics is scraped
+metrics_registry.register_collector(snapshot_collector(
+    'fivestep_circuit_breaker', circuit_breaker.snapshot, 'Anthropic API circuit breaker',
+    counters=('times_opened', 'rejected', 'rate_limited'), states={'state': ('closed', 'open', 'half-open')}))
+metrics_registry.register_collector(snapshot_collector(
+    'fivestep_rate_limiter', rate_limiter.snapshot, 'Adaptive rate limiter',
+    counters=('admitted', 'delayed', 'timed_out', 'rate_limited')))
+metrics_registry.register_collector(snapshot_collector(
+    'fivestep_hedging', lambda: engine.hedger.snapshot() if engine.hedger is not None else None,
+    'Hedged step calls', counters=('requests', 'hedged', 'hedge_wins', 'primary_wins', 'over_budget')))
+metrics_registry.register_collector(snapshot_collector(
+    'fivestep_prefetch', lambda: prefetcher.snapshot() if prefetcher is not None else None,
+    'Speculative next-step turns', counters=('started', 'hits', 'misses', 'stale', 'expired', 'failed')))
+metrics_registry.register_collector(keyed_collector(
+    'fivestep_route', model_router.snapshot, 'route', 'Model route',
+    {'requests': ('requests_total', 'counter'), 'total_seconds': ('seconds_total', 'counter'),
+     'mean_seconds': ('mean_seconds', 'gauge')}))
+
+@app.route('/metrics')
+def metrics():
+    """Per-process metrics in the Prometheus text exposition format"""
+    return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/api/health')
 def health_check():
     """Enhanced health check endpoint to verify API and system status"""
@@ -541,7 +903,17 @@ def health_check():
         "api": api_status,
         "environment_variables": env_status,
         "session_config": session_config_summary,
-        "sentiment_analysis": "enabled"
+        "sentiment_analysis": sentiment_scorer.name,
+        "structured_output": engine.structured_output,
+        "circuit_breaker": circuit_breaker.snapshot(),
+        "rate_limiter": rate_limiter.snapshot(),
+        "hedging": engine.hedger.snapshot() if engine.hedger is not None else None,
+        # Speculative next-step turns: started, served (hits) and discarded
+        "prefetch": prefetcher.snapshot() if prefetcher is not None else None,
+        # Requests and mean latency per model route
+        "model_routes": model_router.snapshot(),
+        # Token usage per step, including prompt cache reads/writes
+        "usage": usage_summary()
     })
 
 # The following makes the app work both locally and on Vercel
@@ -0,0 +1,348 @@
+"""
+ASGI entry point for serving the coach from an async server.
+
+    pip install uvicorn
+    uvicorn asgi:application --workers 2
+
+The chat endpoints (/chat and /chat/stream) run natively on the event loop with an
+anthropic.AsyncAnthropic client, so a slow Claude call holds a coroutine instead of a worker
+thread. Every Claude call goes through one ConcurrencyLimiter per process; when all slots are
+busy and the wait queue is full, requests get a 503 straight away. GET /api/queue reports the
+limiter's counters. All other routes are served by the Flask app through a thread.
+
+Sessions are read and written with the Flask app's session interface, so the WSGI and ASGI
+entry points share cookies and server-side stores.
+"""
+import io
+import sys
+import json
+import time
+import asyncio
+import logging
+
+from werkzeug.wrappers import Request as WerkzeugRequest, Response as WerkzeugResponse
+
+from app import (app as flask_app, SessionState, ChatTurn, error_payload, get_step_info, prefetcher, sse_event,
+                 stream_commit_token)
+from anthropic_client import create_async_client, keep_warm_async, warm_up_async
+from concurrency import ConcurrencyLimiter, QueueFullError
+from metrics import phase_seconds, registry as metrics_registry, snapshot_collector
+from rate_limiter import rate_limiter
+from config import (ANTHROPIC_API_KEY, ASYNC_MAX_CONCURRENCY, ASYNC_MAX_QUEUE, CLIENT_TRANSPORT,
+                    CLIENT_WARM_UP, CLIENT_KEEP_WARM_INTERVAL, PREFETCH_WAIT_TIMEOUT, RATE_LIMIT_ADAPTIVE)
+from session_store import ServerSideSessionInterface
+from steps.engine import engine
+from stream_parser import ResponseStreamParser
+
+logger = logging.getLogger(__name__)
+
+async_client = create_async_client(ANTHROPIC_API_KEY, rate_limiter=rate_limiter if RATE_LIMIT_ADAPTIVE else None,
+                                   **CLIENT_TRANSPORT)
+
+# Shared by every request handled by this process
+limiter = ConcurrencyLimiter(ASYNC_MAX_CONCURRENCY, ASYNC_MAX_QUEUE)
+# /metrics is served by the Flask app, in this process
+metrics_registry.register_collector(snapshot_collector(
+    'fivestep_async_queue', limiter.snapshot, 'Async Claude call limiter', counters=('admitted', 'rejected')))
+
+BUSY_MESSAGE = "The coach is helping a lot of people right now. Please try again in a moment."
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    """
+    Build a WSGI environ for an ASGI HTTP request.
+
+    Args:
+        scope: ASGI connection scope
+        body: Complete request body
+
+    Returns:
+        dict: PEP 3333 environ
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f"HTTP_{name}"
+        if key in environ:
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            value = f"{environ[key]}{separator}{value}"
+        environ[key] = value
+    return environ
+
+
+def call_flask(environ: dict):
+    """Run the Flask app for one request and buffer its response (called in a thread)"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return body
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+async def send_response(send, status: int, headers, body: bytes) -> None:
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status: int, payload, headers=()) -> None:
+    body = json.dumps(payload).encode('utf-8')
+    await send_response(send, status, [('Content-Type', 'application/json'), *headers], body)
+
+
+async def open_session(environ: dict):
+    """Open the Flask session for a request (stores may block, so this runs in a thread)"""
+    interface = flask_app.session_interface
+    session = await asyncio.to_thread(interface.open_session, flask_app, WerkzeugRequest(environ))
+    if session is None:
+        session = interface.make_null_session(flask_app)
+    return session
+
+
+async def session_headers(session):
+    """Set-Cookie and Vary headers the session interface would add to a Flask response"""
+    response = WerkzeugResponse()
+    await asyncio.to_thread(flask_app.session_interface.save_session, flask_app, session, response)
+    return [(name, value) for name, value in response.headers.items() if name in ('Set-Cookie', 'Vary')]
+
+
+async def await_sentiment(turn: ChatTurn) -> None:
+    """
+    Wait, without blocking the event loop, until the turn's sentiment score is ready or its
+    deadline passes, so ChatTurn.welcome/complete pick it up without waiting themselves.
+    """
+    remaining = turn.sentiment_deadline - time.monotonic()
+    if remaining > 0 and not turn.sentiment_future.done():
+        with phase_seconds.time(phase='sentiment_wait', step=turn.current_step):
+            await asyncio.wait([asyncio.wrap_future(turn.sentiment_future)], timeout=remaining)
+
+
+async def run_step(turn: ChatTurn, on_text=None):
+    """
+    The turn's step result: its prefetched reply when it has one, otherwise (or if the
+    prefetch failed) an async step call through the limiter.
+    """
+    if turn.prefetched is not None:
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(turn.prefetched), PREFETCH_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Prefetched turn not done within {PREFETCH_WAIT_TIMEOUT:g}s, running the step instead")
+            prefetcher.record_failure()
+        except Exception as e:
+            logger.warning(f"Prefetched turn failed, running the step instead: {str(e)}")
+            prefetcher.record_failure()
+        else:
+            return turn.serve_prefetched(result, on_text)
+    return await limiter.run(
+        engine.run_async(turn.current_step, turn.user_input, turn.history, turn.goal, async_client, on_text=on_text)
+    )
+
+
+def busy_payload(error: QueueFullError, state_source) -> dict:
+    """Payload for a turn rejected by the limiter, shaped like error_payload"""
+    logger.warning(f"Rejected chat turn: {str(error)}")
+    current_step = state_source.get('current_step', 1)
+    return {
+        'main_response': BUSY_MESSAGE,
+        'evaluation_summary': f"Server busy: {str(error)}",
+        'completed_steps': state_source.get('completed_steps', []),
+        'current_step': current_step,
+        'step_info': get_step_info(current_step),
+        'sentiment_score': 0,
+        'sentiment_ema': state_source.get('sentiment_ema', 0),
+    }
+
+
+async def chat(environ: dict, send) -> None:
+    """Async variant of the Flask /chat endpoint"""
+    start_time = time.perf_counter()
+    step = ''
+    session = await open_session(environ)
+    try:
+        state = SessionState(session)
+        data = json.loads(environ['wsgi.input'].getvalue() or b'{}')
+        turn = ChatTurn(state, data.get('user_input', ''))
+        step = turn.current_step
+
+        if turn.is_greeting:
+            await await_sentiment(turn)
+            payload = turn.welcome()
+        else:
+            result = await run_step(turn)
+            if result.sentiment_score is None:
+                await await_sentiment(turn)
+            # Completing a step may archive its transcript, which can block
+            payload = await asyncio.to_thread(turn.complete, *result)
+        status, headers = 200, []
+    except QueueFullError as e:
+        payload, status, headers = busy_payload(e, session), 503, [('Retry-After', '1')]
+    except Exception as e:
+        payload, status, headers = error_payload(e, session), 500, []
+
+    await send_json(send, status, payload, headers + await session_headers(session))
+    phase_seconds.observe(time.perf_counter() - start_time, phase='request', step=step)
+
+
+async def chat_stream(environ: dict, send) -> None:
+    """
+    Async variant of the Flask /chat/stream endpoint, with the same events and the same
+    session handling: the turn runs against a copy of the session, then server-side sessions
+    are saved to the store and cookie sessions get a signed session_token for /chat/commit.
+    """
+    start_time = time.perf_counter()
+    session = await open_session(environ)
+    # Initialize the live session first so a new visitor's cookie goes out with the headers
+    base_nonce = SessionState(session).commit_nonce
+    state = SessionState(dict(session))
+    server_side_sid = session.sid if isinstance(flask_app.session_interface, ServerSideSessionInterface) else None
+    headers = await session_headers(session)
+    try:
+        data = json.loads(environ['wsgi.input'].getvalue() or b'{}')
+        turn = ChatTurn(state, data.get('user_input', ''))
+    except Exception as e:
+        await send_json(send, 500, error_payload(e, state.session), headers)
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': encode_headers([('Content-Type', 'text/event-stream; charset=utf-8'),
+                                   ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no'), *headers]),
+    })
+
+    async def emit(event, payload):
+        await send({'type': 'http.response.body', 'body': sse_event(event, payload).encode('utf-8'),
+                    'more_body': True})
+
+    try:
+        if turn.is_greeting:
+            await await_sentiment(turn)
+            payload = turn.welcome()
+            await emit('token', {'text': payload['main_response']})
+        else:
+            events = asyncio.Queue()
+            step_task = asyncio.create_task(run_step(turn, on_text=events.put_nowait))
+            step_task.add_done_callback(lambda _: events.put_nowait(None))
+
+            # Forward visible text as it arrives; None marks the end of the step call.
+            # The parser holds back evaluation blocks, markers and step headers.
+            parser = ResponseStreamParser()
+            while True:
+                text = await events.get()
+                if text is None:
+                    break
+                visible = parser.feed(text)
+                if visible:
+                    await emit('token', {'text': visible})
+            visible = parser.close()
+            if visible:
+                await emit('token', {'text': visible})
+
+            result = step_task.result()
+            if result.sentiment_score is None:
+                await await_sentiment(turn)
+            payload = await asyncio.to_thread(turn.complete, *result)
+
+        if server_side_sid:
+            # Server-side sessions can be written directly once the turn finishes
+            await asyncio.to_thread(flask_app.session_interface.save_state, flask_app, server_side_sid,
+                                    state.session)
+        else:
+            payload['session_token'] = stream_commit_token(base_nonce, state.session)
+        await emit('done', payload)
+    except QueueFullError as e:
+        await emit('error', busy_payload(e, state.session))
+    except Exception as e:
+        await emit('error', error_payload(e, state.session))
+    await send({'type': 'http.response.body', 'body': b''})
+    phase_seconds.observe(time.perf_counter() - start_time, phase='request', step=turn.current_step)
+
+
+async def lifespan(receive, send) -> None:
+    keep_warm_task = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if CLIENT_WARM_UP:
+                # Open the API connection before the first turn arrives
+                await warm_up_async(async_client)
+            if CLIENT_KEEP_WARM_INTERVAL > 0:
+                keep_warm_task = asyncio.create_task(keep_warm_async(async_client, CLIENT_KEEP_WARM_INTERVAL))
+            logger.info(f"ASGI app started (max {ASYNC_MAX_CONCURRENCY} concurrent Claude calls, "
+                        f"queue of {ASYNC_MAX_QUEUE})")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if keep_warm_task is not None:
+                keep_warm_task.cancel()
+            await async_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+NATIVE_ROUTES = {
+    ('POST', '/chat'): chat,
+    ('POST', '/chat/stream'): chat_stream,
+}
+
+
+async def application(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    route = (scope['method'], scope['path'])
+    if route in NATIVE_ROUTES:
+        await NATIVE_ROUTES[route](environ, send)
+    elif route == ('GET', '/api/queue'):
+        await send_json(send, 200, limiter.snapshot())
+    else:
+        status, headers, body = await asyncio.to_thread(call_flask, environ)
+        await send_response(send, status, headers, body)
@@ -0,0 +1,155 @@
+"""
+First-request latency of the Anthropic client, before and after transport tuning and warm-up.
+
+Scenarios (each on a fresh client, repeated --repeats times):
+    cold           - default client, first request opens the connection
+    warmed         - tuned client after warm_up(), first request reuses the connection
+    idle/default   - default client, warmed, then idle for --idle seconds (SDK keepalive is 5s)
+    idle/tuned     - tuned client, warmed, then idle for --idle seconds (CLIENT_KEEPALIVE_EXPIRY)
+
+By default the requests go to a local stand-in server that sleeps --handshake-ms on every new
+connection, standing in for DNS + TCP + TLS setup. Pass --base-url https://api.anthropic.com
+(with a real ANTHROPIC_API_KEY) to measure the real thing; each timed request is a
+one-token messages.create call.
+
+Usage:
+    python benchmarks/bench_client_warmup.py [--repeats 3] [--idle 6] [--handshake-ms 150]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import anthropic
+
+# config requires these to be set
+os.environ.setdefault("SECRET_KEY", "bench-client-warmup")
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench-client-warmup")
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from anthropic_client import create_client, warm_up
+from config import ANTHROPIC_API_KEY, CLIENT_TRANSPORT, DEFAULT_MODEL
+
+MESSAGE = {
+    "id": "msg_bench", "type": "message", "role": "assistant", "model": DEFAULT_MODEL,
+    "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn", "stop_sequence": None,
+    "usage": {"input_tokens": 1, "output_tokens": 1},
+}
+MODELS = {
+    "data": [{"type": "model", "id": DEFAULT_MODEL, "display_name": DEFAULT_MODEL,
+              "created_at": "2024-06-20T00:00:00Z"}],
+    "has_more": False, "first_id": DEFAULT_MODEL, "last_id": DEFAULT_MODEL,
+}
+
+
+def start_local_server(handshake_seconds: float) -> ThreadingHTTPServer:
+    """Keep-alive HTTP server answering messages and models requests"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            # Runs once per connection, like a TLS handshake
+            time.sleep(handshake_seconds)
+            super().setup()
+
+        def _reply(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply(MODELS)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._reply(MESSAGE)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed_request(client) -> float:
+    start_time = time.perf_counter()
+    client.messages.create(model=DEFAULT_MODEL, max_tokens=1,
+                           messages=[{"role": "user", "content": "Hi"}])
+    return time.perf_counter() - start_time
+
+
+def default_client(base_url, api_key):
+    return anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=0)
+
+
+def tuned_client(base_url, api_key):
+    return create_client(api_key, base_url=base_url, **CLIENT_TRANSPORT)
+
+
+def run_scenario(make_client, base_url, api_key, warm, idle):
+    client = make_client(base_url, api_key)
+    try:
+        if warm:
+            warm_up(client)
+        if idle:
+            time.sleep(idle)
+        return timed_request(client)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh clients per scenario")
+    parser.add_argument("--idle", type=float, default=6.0, help="Idle seconds for the idle scenarios")
+    parser.add_argument("--handshake-ms", type=float, default=150.0,
+                        help="Simulated connection setup time of the local server")
+    parser.add_argument("--base-url", help="Measure against this API instead of the local server")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = start_local_server(args.handshake_ms / 1000)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        print(f"Local server at {base_url}, {args.handshake_ms:.0f} ms per new connection")
+    print(f"Tuned transport: {CLIENT_TRANSPORT}\n")
+
+    scenarios = [
+        ("cold", default_client, False, 0),
+        ("warmed", tuned_client, True, 0),
+        ("idle/default", default_client, True, args.idle),
+        ("idle/tuned", tuned_client, True, args.idle),
+    ]
+    print(f"{'scenario':<14} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for name, make_client, warm, idle in scenarios:
+        # Idle scenarios wait in parallel so the benchmark does not take repeats * idle seconds
+        results = [None] * args.repeats
+        threads = [
+            threading.Thread(target=lambda i=i: results.__setitem__(
+                i, run_scenario(make_client, base_url, ANTHROPIC_API_KEY, warm, idle)))
+            for i in range(args.repeats)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        timings = [seconds * 1000 for seconds in results]
+        print(f"{name:<14} {statistics.median(timings):>10.1f} {min(timings):>8.1f} {max(timings):>8.1f}")
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Microbenchmarks for the per-turn utils and session code, with a stored baseline.
+
+Every chat turn runs these on the request thread:
+    build_messages          - context assembly for every step call (token counts cached, as
+                              in a running process)
+    session_add_message     - SessionState.add_message, including its str(history) size check
+    session_dumps/loads     - Flask's signed cookie session serialization, on every response/request
+    remove_step_headers     - reply post-processing steps, measured separately (extract_goal on a
+    extract_evaluation        reply with no goal, the usual case)
+    extract_goal
+    process_response        - all of the reply post-processing in one call, as the step engine runs it
+
+History cases use synthetic conversations of 10, 50 and 200 messages, stored verbatim as the
+session keeps them; reply cases use a short (~600
+chars) and a long (~12000 chars, about MAX_TOKENS) reply with step header, footer and
+evaluation block.
+
+Each case is calibrated to a number of calls per round (like pytest-benchmark), timed over
+--rounds rounds, and reported as min/median/mean per call. The default run compares each
+case's fastest round (the least noisy statistic) against benchmarks/hot_paths_baseline.json
+and exits with status 1 if any case is slower by more than --tolerance. Timings depend on the
+machine: record the baseline on the machine that runs the comparison (e.g. the deploy CI
+runner). Shared runners vary by up to ~40% between runs, hence the wide default tolerance;
+the regressions this is for (an extra pass over the history, a slower encoding) show up as
+multiples.
+
+Usage:
+    python benchmarks/bench_hot_paths.py [--tolerance 0.5] [--rounds 25] [--filter extract]
+    python benchmarks/bench_hot_paths.py --update    # rewrite the baseline after intended changes
+"""
+import os
+import sys
+import json
+import random
+import gc
+import logging
+import argparse
+import platform
+import statistics
+import time
+
+# app imports config, which requires these to be set; keep the import free of network and disk
+os.environ.setdefault("SECRET_KEY", "bench-hot-paths")
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench-hot-paths")
+os.environ.setdefault("CLIENT_WARM_UP", "false")
+os.environ.setdefault("TRANSCRIPT_ARCHIVE", "memory")
+
+from flask.sessions import SecureCookieSessionInterface
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from app import SessionState, app
+from context import build_messages
+from bench_session_encoding import message
+from utils import extract_evaluation, extract_goal, process_response, remove_step_headers
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hot_paths_baseline.json")
+
+HISTORY_SIZES = (10, 50, 200)
+REPLY_SIZES = {"short": (500, 700), "long": (11000, 13000)}
+
+# Smallest batch of calls timed together, so timer resolution doesn't dominate fast cases
+MIN_ROUND_SECONDS = 0.005
+
+
+def build_history(rng: random.Random, messages: int):
+    """A conversation of the given length as the session stores it"""
+    history = []
+    for index in range(messages):
+        if index % 2 == 0:
+            history.append({'role': 'user', 'content': message(rng, 80, 400)})
+        else:
+            history.append({'role': 'assistant', 'content': message(rng, 400, 1200)})
+    return history
+
+
+def build_reply(rng: random.Random, min_chars: int, max_chars: int) -> str:
+    return (f"STEP 2: IDENTIFY PROBLEMS\n\n{message(rng, min_chars, max_chars)}\n\n"
+            f"<evaluation>{message(rng, 100, 300)}</evaluation>\n\nCURRENT STEP: 2 - IDENTIFY PROBLEMS")
+
+
+def build_session(history):
+    return {
+        '_permanent': True,
+        'current_step': 3,
+        'completed_steps': [1, 2],
+        'history': history,
+        'goal': "Cut our release cycle from four weeks to two by the end of the quarter",
+        'step_evaluations': {'1': "Clear, measurable goal.", '2': "Identified testing as the bottleneck."},
+        'sentiment_ema': 1.8,
+    }
+
+
+def build_cases(seed: int):
+    """Case name -> zero-argument function running one call"""
+    rng = random.Random(seed)
+    cases = {}
+    # The default cookie backend's serializer: tagged JSON, zlib when smaller, HMAC-signed
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+
+    for size in HISTORY_SIZES:
+        history = build_history(rng, size)
+        session = build_session(history)
+        cookie = serializer.dumps(session)
+        # add_message writes the history back, so it gets a session of its own
+        live_session = build_session(history)
+        state = SessionState(live_session)
+        user_message = message(rng, 80, 400)
+
+        def add_message(state=state, session=live_session, history=history, content=user_message):
+            session['history'] = history
+            state.add_message('user', content)
+
+        cases[f"build_messages[{size}]"] = lambda history=history, content=user_message: \
+            build_messages(history, content, step=3)
+        cases[f"session_add_message[{size}]"] = add_message
+        cases[f"session_dumps[{size}]"] = lambda session=session: serializer.dumps(session)
+        cases[f"session_loads[{size}]"] = lambda cookie=cookie: serializer.loads(cookie)
+
+    for label, (min_chars, max_chars) in REPLY_SIZES.items():
+        reply = build_reply(rng, min_chars, max_chars)
+        cases[f"remove_step_headers[{label}]"] = lambda reply=reply: remove_step_headers(reply)
+        cases[f"extract_evaluation[{label}]"] = lambda reply=reply: extract_evaluation(reply)
+        cases[f"extract_goal[{label}]"] = lambda reply=reply: extract_goal(reply)
+        cases[f"process_response[{label}]"] = lambda reply=reply: process_response(reply)
+    return cases
+
+
+def measure(func, rounds: int):
+    """Per-call seconds for each round, pytest-benchmark style"""
+    loops = 1
+    while True:
+        start_time = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= MIN_ROUND_SECONDS:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(MIN_ROUND_SECONDS / elapsed * 1.2))
+
+    # Collections triggered by earlier cases would land in random rounds
+    gc.collect()
+    gc.disable()
+    try:
+        timings = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            for _ in range(loops):
+                func()
+            timings.append((time.perf_counter() - start_time) / loops)
+    finally:
+        gc.enable()
+    return timings
+
+
+def machine_info():
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "system": platform.system()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative slowdown of the fastest round")
+    parser.add_argument("--rounds", type=int, default=25, help="Timed rounds per case")
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--update", action="store_true", help="Write the current timings as the new baseline")
+    args = parser.parse_args()
+
+    # add_message logs a warning whenever it drops history to fit the cookie
+    logging.disable(logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    if baseline and not args.update and baseline.get("machine") != machine_info():
+        print(f"Warning: baseline was recorded on {baseline.get('machine')}, this is {machine_info()}")
+
+    results = {}
+    failures = []
+    print(f"{'case':<32}{'min us':>11}{'median us':>11}{'mean us':>11}{'stddev':>9}{'ops/s':>12}{'vs base':>9}")
+    for name, func in build_cases(args.seed).items():
+        if args.filter not in name:
+            continue
+        timings = measure(func, args.rounds)
+        median = statistics.median(timings)
+        results[name] = {"min_us": round(min(timings) * 1e6, 3), "median_us": round(median * 1e6, 3)}
+
+        change = ""
+        expected = baseline.get("results", {}).get(name)
+        if expected and not args.update:
+            ratio = min(timings) * 1e6 / expected["min_us"]
+            change = f"{ratio - 1:+.0%}"
+            if ratio > 1 + args.tolerance:
+                failures.append(f"{name}: min {min(timings) * 1e6:.2f}us vs baseline {expected['min_us']}us "
+                                f"({change}, tolerance {args.tolerance:.0%})")
+        print(f"{name:<32}{min(timings) * 1e6:>11.2f}{median * 1e6:>11.2f}{statistics.mean(timings) * 1e6:>11.2f}"
+              f"{statistics.pstdev(timings) / statistics.mean(timings):>9.1%}{1 / median:>12,.0f}{change:>9}")
+
+    if args.update:
+        merged = dict(baseline.get("results", {}), **results) if args.filter else results
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({"machine": machine_info(), "results": dict(sorted(merged.items()))}, f, indent=2)
+            f.write("\n")
+        print(f"\nBaseline written to {BASELINE_PATH}")
+        return
+
+    if not baseline:
+        print("\nNo baseline yet; run with --update to record one")
+        return
+    missing = sorted(set(results) - set(baseline.get("results", {})))
+    if missing:
+        print(f"\nNot in baseline: {', '.join(missing)}")
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"\nAll hot paths within {args.tolerance:.0%} of baseline")
+
+
+if __name__ == "__main__":
+    main()
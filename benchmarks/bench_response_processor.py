@@ -0,0 +1,156 @@
+"""
+Checks utils.process_response against the chain of post-processing calls it replaces and
+times both.
+
+The chain, as run per turn before process_response:
+    extract_evaluation -> extract_sentiment -> completion marker check -> extract_goal
+    (step 1 completions) -> remove_step_headers
+The legacy extract_goal and remove_step_headers below are the versions that compiled their
+patterns on every call; utils now shares precompiled patterns with process_response, so
+both the legacy and the current chain are timed.
+
+For every sample and fuzz input, process_response must give the same response, visible
+text, evaluation, sentiment, completion flag and goal as the legacy chain. Exits with status
+1 on any mismatch.
+
+Usage:
+    python benchmarks/bench_response_processor.py [--iterations 2000] [--fuzz 50000]
+"""
+import os
+import re
+import sys
+import random
+import argparse
+import timeit
+
+# utils imports config, which requires these to be set
+os.environ.setdefault("SECRET_KEY", "bench-response-processor")
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench-response-processor")
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bench_stream_parser import FUZZ_FRAGMENTS, PARAGRAPH, SAMPLES
+from config import STEP_COMPLETE_MARKER
+from utils import (GOAL_COMPLETION_MARKERS, extract_evaluation, extract_goal, extract_sentiment, process_response,
+                   remove_step_headers)
+
+MARKERS = tuple(GOAL_COMPLETION_MARKERS)
+
+GOAL_SAMPLES = {
+    "goal": "STEP 1: HAVE CLEAR GOALS\n\nGoal confirmed: Ship a release every two weeks by the end of "
+            "the quarter. Let's move on to what stands in the way.\n\nSTEP_COMPLETE\n\n"
+            "<evaluation>Specific, measurable goal with a deadline.</evaluation>\n\n"
+            "CURRENT STEP: 1 - HAVE CLEAR GOALS",
+    "goal_long": "STEP 1: HAVE CLEAR GOALS\n\n" + PARAGRAPH * 24 + "So your goal is: cut the release "
+                 "cycle to two weeks! STEP_COMPLETE\n\n<evaluation>" + "Clear goal. " * 30
+                 + "</evaluation>\n\n<sentiment>3</sentiment>\n\nCURRENT STEP: 1 - HAVE CLEAR GOALS",
+}
+
+GOAL_FRAGMENTS = [
+    "Goal confirmed: ", "Goal confirmed:", "Goal confirmed", "goal is: ", "focusing on ", "aiming to ",
+    "Ship it", ".", "!", "I'll help", "Let's begin", "Now let's", "Moving to next step",
+    "confirmed your goal", "goal is confirmed", "a", "b c",
+]
+
+
+def legacy_extract_goal(response):
+    patterns = [
+        r'Goal confirmed: (.+?)(?:\.|\!)',
+        r'goal is: (.+?)(?:\.|\!)',
+        r'focusing on (.+?)(?:\.|\!)',
+        r'aiming to (.+?)(?:\.|\!)'
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, response)
+        if match:
+            goal = match.group(1).strip()
+            for cutoff in ["I'll help", "Let's begin", "Let's move", "Now let's", "Your insight"]:
+                if cutoff in goal:
+                    goal = goal.split(cutoff)[0].strip()
+            return goal
+    if "Goal confirmed" in response:
+        parts = response.split("Goal confirmed:")
+        if len(parts) > 1:
+            goal_part = parts[1].strip()
+            end_index = goal_part.find('.')
+            if end_index != -1:
+                goal = goal_part[:end_index].strip()
+            else:
+                end_index = goal_part.find('Moving to next step')
+                if end_index != -1:
+                    goal = goal_part[:end_index].strip()
+                else:
+                    goal = goal_part.strip()
+            for cutoff in ["I'll help", "Let's begin", "Let's move", "Now let's", "Your insight"]:
+                if cutoff in goal:
+                    goal = goal.split(cutoff)[0].strip()
+            return goal
+    return None
+
+
+def legacy_remove_step_headers(response):
+    response = re.sub(r'^STEP \d+: [A-Z\s]+', '', response)
+    response = re.sub(r'CURRENT STEP: \d+ - [A-Z\s]+$', '', response)
+    response = response.replace(STEP_COMPLETE_MARKER, "")
+    return re.sub(r'\n\s*\n\s*\n', '\n\n', response).strip()
+
+
+def chain(response, goal_function=legacy_extract_goal, headers_function=legacy_remove_step_headers):
+    cleaned, evaluation = extract_evaluation(response)
+    cleaned, sentiment = extract_sentiment(cleaned)
+    is_complete = any(marker in cleaned for marker in MARKERS)
+    goal = goal_function(cleaned) if is_complete else None
+    return cleaned, headers_function(cleaned), evaluation, sentiment, is_complete, goal
+
+
+def current_chain(response):
+    return chain(response, extract_goal, remove_step_headers)
+
+
+def single_pass(response):
+    processed = process_response(response, MARKERS)
+    return (processed.response, processed.visible, processed.evaluation, processed.sentiment,
+            processed.is_complete, processed.goal)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="Timing iterations per case")
+    parser.add_argument("--fuzz", type=int, default=50000, help="Random responses to check for equivalence")
+    args = parser.parse_args()
+
+    samples = dict(SAMPLES, **GOAL_SAMPLES)
+    rng = random.Random(0)
+    failures = 0
+    for name, response in samples.items():
+        if single_pass(response) != chain(response) or current_chain(response) != chain(response):
+            failures += 1
+            print(f"MISMATCH: sample '{name}'")
+
+    fragments = FUZZ_FRAGMENTS + GOAL_FRAGMENTS
+    for _ in range(args.fuzz):
+        response = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 14)))
+        if response.find("</evaluation>") < response.find("<evaluation>") and "</evaluation>" in response:
+            continue  # A closing tag before the opening tag is outside the supported input
+        expected = chain(response)
+        if single_pass(response) != expected or current_chain(response) != expected:
+            failures += 1
+            print(f"MISMATCH: fuzz input {response!r}")
+
+    print(f"Equivalence: {'OK' if not failures else f'{failures} mismatches'} "
+          f"({len(samples)} samples, {args.fuzz} fuzz inputs)\n")
+
+    print(f"{'sample':<12}{'chars':>7}{'legacy us':>11}{'current us':>12}{'single us':>11}{'speedup':>9}")
+    for name, response in samples.items():
+        # Fastest of five runs, to keep noise from other processes out of the comparison
+        times = [min(timeit.repeat(lambda: function(response), number=args.iterations, repeat=5)) / args.iterations
+                 for function in (chain, current_chain, single_pass)]
+        print(f"{name:<12}{len(response):>7}{times[0] * 1e6:>11.1f}{times[1] * 1e6:>12.1f}"
+              f"{times[2] * 1e6:>11.1f}{times[0] / times[2]:>8.1f}x")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
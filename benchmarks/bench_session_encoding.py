@@ -0,0 +1,118 @@
+"""
+Compares cookie size per conversation turn for Flask's default session encoding and the
+compact encoding in cookie_session.py, and times encoding + decoding.
+
+A synthetic conversation is grown one turn (user + assistant message) at a time without any
+history truncation, so the table shows how many turns each encoding can hold before it
+outgrows one cookie, and the compact encoding's multi-cookie budget.
+
+Usage:
+    python benchmarks/bench_session_encoding.py [--turns 25] [--seed 7] [--codec zlib]
+"""
+import os
+import sys
+import random
+import argparse
+import timeit
+
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cookie_session import COOKIE_CHUNK_SIZE, CompactCookieSessionInterface, decode_session, encode_session
+
+# Vocabulary for synthetic messages; random word order keeps compression ratios realistic
+WORDS = (
+    "the a and to of in that it is for on with as at this be we my our team work time "
+    "project goal goals problem problems because think feel want need would could should "
+    "really about more most some every week month quarter plan plans data report review "
+    "meeting meetings manager customer customers release deadline deadlines process change "
+    "changes priority priorities handoff handoffs platform group sprint backlog support "
+    "ticket tickets hours days three two five people hire hiring budget cost costs revenue "
+    "growth focus stress energy morning evening habit habits schedule calendar track "
+    "progress result results outcome outcomes root cause causes design option options "
+    "experiment test measure metric metrics improve reduce increase clear clarity owner "
+    "ownership decision decisions risk risks next step steps first then finally what why how"
+).split()
+
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + rng.choice(".?.!.")
+
+
+def message(rng: random.Random, min_chars: int, max_chars: int) -> str:
+    target = rng.randint(min_chars, max_chars)
+    text = ""
+    while len(text) < target:
+        text += sentence(rng) + (" " if rng.random() < 0.8 else "\n\n")
+    return text.strip()
+
+
+def build_session(rng: random.Random, turns: int):
+    """Yield (turn, session dict) for a conversation growing one turn at a time"""
+    session = {
+        '_permanent': True,
+        'current_step': 1,
+        'completed_steps': [],
+        'history': [],
+        'goal': "",
+        'step_evaluations': {},
+        'sentiment_ema': 0.0,
+    }
+    for turn in range(1, turns + 1):
+        session['history'].append({'role': 'user', 'content': message(rng, 80, 400)})
+        session['history'].append({'role': 'assistant', 'content': message(rng, 400, 1200)})
+        session['sentiment_ema'] = 0.3 * rng.randint(-10, 10) + 0.7 * session['sentiment_ema']
+        if turn == 2:
+            session['goal'] = message(rng, 40, 120)
+        if turn % 5 == 0 and session['current_step'] < 5:
+            step = session['current_step']
+            session['completed_steps'].append(step)
+            session['step_evaluations'][str(step)] = message(rng, 100, 300)
+            session['current_step'] = step + 1
+        yield turn, session
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=25, help="Conversation turns to simulate")
+    parser.add_argument("--seed", type=int, default=7, help="Random seed for the synthetic conversation")
+    parser.add_argument("--codec", choices=("zlib", "zstd"), default="zlib", help="Compact encoding codec")
+    parser.add_argument("--iterations", type=int, default=200, help="Timing iterations at the final turn")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.secret_key = "benchmark-secret-key"
+    default_serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    compact = CompactCookieSessionInterface(codec=args.codec, max_cookies=args.turns)
+
+    print(f"{'turn':>4} {'history chars':>13} {'default bytes':>13} {'compact bytes':>13} "
+          f"{'cookies':>7} {'saving':>7}")
+    default_overflow = compact_overflow = None
+    for turn, data in build_session(random.Random(args.seed), args.turns):
+        history_chars = len(str(data['history']))
+        default_size = len(default_serializer.dumps(data))
+        chunks = compact.serialize(app, data)
+        compact_size = sum(len(chunk) for chunk in chunks)
+        print(f"{turn:>4} {history_chars:>13} {default_size:>13} {compact_size:>13} "
+              f"{len(chunks):>7} {1 - compact_size / default_size:>7.1%}")
+        if default_overflow is None and default_size > COOKIE_CHUNK_SIZE:
+            default_overflow = turn
+        if compact_overflow is None and len(chunks) > 1:
+            compact_overflow = turn
+
+    print(f"\nFirst turn over one cookie ({COOKIE_CHUNK_SIZE} bytes): "
+          f"default {default_overflow or 'never'}, compact {compact_overflow or 'never'}")
+
+    default_time = timeit.timeit(
+        lambda: default_serializer.loads(default_serializer.dumps(data)), number=args.iterations)
+    compact_time = timeit.timeit(
+        lambda: decode_session(encode_session(data, compact.codec)), number=args.iterations)
+    print(f"Encode + decode at turn {args.turns}: default {default_time / args.iterations * 1e3:.3f} ms, "
+          f"compact ({compact.codec}) {compact_time / args.iterations * 1e3:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Checks ResponseStreamParser against the batch post-processing in utils.py and times both.
+
+For every sample response and chunk size, the text emitted by the parser must equal
+remove_step_headers(extract_sentiment(extract_evaluation(response)[0])[0]) and the captured
+evaluation and sentiment must match. Exits with status 1 on any mismatch.
+
+Usage:
+    python benchmarks/bench_stream_parser.py [--iterations 2000] [--fuzz 20000]
+"""
+import os
+import sys
+import random
+import argparse
+import timeit
+
+# utils imports config, which requires these to be set
+os.environ.setdefault("SECRET_KEY", "bench-stream-parser")
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench-stream-parser")
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import extract_evaluation, extract_sentiment, remove_step_headers
+from stream_parser import ResponseStreamParser
+
+PARAGRAPH = (
+    "That's a really useful observation. It sounds like the handoffs between your team and "
+    "the platform group are where most of the time goes, and that the frustration comes from "
+    "not knowing when work will be picked up.\n\n"
+    "- Reviews wait an average of three days\n"
+    "- Priorities change mid-sprint\n"
+    "- Nobody owns the release checklist\n\n"
+)
+
+SAMPLES = {
+    "plain": PARAGRAPH * 2 + "Which of these causes you the most pain right now?",
+    "evaluation": PARAGRAPH + "What else gets in the way?\n\n<evaluation>The user has named two "
+                  "concrete problems; ownership looks like a root issue.</evaluation>",
+    "complete": "STEP 2: IDENTIFY PROBLEMS\n\n" + PARAGRAPH + "STEP_COMPLETE\n\nNow that we've "
+                "identified your key challenges, let's explore why these problems exist.\n\n"
+                "<evaluation>Two key problems identified.</evaluation>\n\n"
+                "CURRENT STEP: 2 - IDENTIFY PROBLEMS",
+    "long": (PARAGRAPH * 12) + "<evaluation>" + ("Detailed assessment. " * 40) + "</evaluation>\n\n\n\n"
+            + "CURRENT STEP: 4 - DESIGN A PLAN",
+    "sentiment": PARAGRAPH + "What else gets in the way?\n\n<evaluation>Two problems named."
+                 "</evaluation>\n\n<sentiment>-4</sentiment>",
+    "welcome": "STEP 1: HAVE CLEAR GOALS\n\n Hi there! What goal would you like to focus on today?\n\n"
+               "CURRENT STEP: 1 - HAVE CLEAR GOALS",
+}
+
+FUZZ_FRAGMENTS = [
+    "STEP 1: HAVE CLEAR GOALS", "\n", "\n\n\n", " ", " \n \n\n ", "Hi there", "text",
+    "<evaluation>", "</evaluation>", "<eval", "note", "STEP_COMPLETE", "STEP_", "COMPLETE",
+    "<sentiment>", "</sentiment>", "<sent", "-3",
+    "CURRENT STEP: 5 - PUSH THROUGH", "CURRENT STEP: ", "5", " - ", "ABC", "C", "S", "\t",
+]
+
+
+def batch(response):
+    cleaned, evaluation = extract_evaluation(response)
+    cleaned, sentiment = extract_sentiment(cleaned)
+    return remove_step_headers(cleaned), evaluation, sentiment
+
+
+def chunked(response, size, rng=None):
+    if rng is None:
+        return [response[i:i + size] for i in range(0, len(response), size)]
+    chunks, i = [], 0
+    while i < len(response):
+        step = rng.randint(1, size)
+        chunks.append(response[i:i + step])
+        i += step
+    return chunks
+
+
+def stream(chunks):
+    parser = ResponseStreamParser()
+    visible = [parser.feed(chunk) for chunk in chunks]
+    visible.append(parser.close())
+    return "".join(visible), parser.evaluation, parser.sentiment
+
+
+def check(response, chunks):
+    return stream(chunks) == batch(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="Timing iterations per case")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Random responses to check for equivalence")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    failures = 0
+    for name, response in SAMPLES.items():
+        for size in (1, 4, 16, 64, len(response)):
+            if not check(response, chunked(response, size)):
+                failures += 1
+                print(f"MISMATCH: sample '{name}' with chunk size {size}")
+
+    for _ in range(args.fuzz):
+        response = "".join(rng.choice(FUZZ_FRAGMENTS) for _ in range(rng.randint(0, 12)))
+        if response.find("</evaluation>") < response.find("<evaluation>") and "</evaluation>" in response:
+            continue  # A closing tag before the opening tag is outside the supported input
+        if not check(response, chunked(response, 8, rng)):
+            failures += 1
+            print(f"MISMATCH: fuzz input {response!r}")
+
+    print(f"Equivalence: {'OK' if not failures else f'{failures} mismatches'} "
+          f"({len(SAMPLES)} samples x 5 chunkings, {args.fuzz} fuzz inputs)\n")
+
+    print(f"{'sample':<12}{'chars':>7}{'batch us':>11}{'stream/1 us':>13}{'stream/4 us':>13}{'stream/16 us':>14}")
+    for name, response in SAMPLES.items():
+        batch_time = timeit.timeit(lambda: batch(response), number=args.iterations) / args.iterations
+        row = f"{name:<12}{len(response):>7}{batch_time * 1e6:>11.1f}"
+        for size in (1, 4, 16):
+            chunks = chunked(response, size)
+            stream_time = timeit.timeit(lambda: stream(chunks), number=args.iterations) / args.iterations
+            row += f"{stream_time * 1e6:>13.1f}" if size != 16 else f"{stream_time * 1e6:>14.1f}"
+        print(row)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
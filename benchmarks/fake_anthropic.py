@@ -0,0 +1,361 @@
+"""
+Local stand-in for the Anthropic Messages API, for load tests that should not use real quota.
+
+Serves POST /v1/messages (JSON or SSE streaming, text or tool-use replies), POST
+/v1/messages/count_tokens and GET /v1/models with:
+    - configurable latency: fixed, uniform or lognormal time to first token, plus a delay
+      per streamed chunk
+    - injected 429 (rate_limit_error) and 529 (overloaded_error) responses with retry-after
+    - optional anthropic-ratelimit-requests-* headers for a requests-per-minute limit
+    - scripted replies: a user message containing COMPLETE_TRIGGER gets a STEP_COMPLETE reply
+      with a "Goal confirmed:" line; every reply carries an <evaluation> block, and a
+      <sentiment> tag when the request asks for one. Sentiment scoring requests get a number.
+    - a prompt cache: each cache_control breakpoint writes its prefix (tools, system, messages
+      up to that block) for CACHE_TTL seconds, and a later request reads the longest written
+      prefix found at one of its breakpoints or up to CACHE_LOOKBACK blocks before it, as the
+      API does. Usage reports cache_read_input_tokens and cache_creation_input_tokens
+      accordingly (tokens estimated at ~4 characters each).
+
+Point the app at it with ANTHROPIC_BASE_URL=http://127.0.0.1:PORT. benchmarks/load_test.py
+starts one in-process unless --target is given.
+
+Usage:
+    python benchmarks/fake_anthropic.py [--port 8090] [--latency lognormal:1.2:0.5]
+                                        [--chunk-delay 0.02] [--rate-429 0.02] [--rate-529 0.01]
+"""
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETE_TRIGGER = "[complete]"
+MODEL_ID = "claude-3-5-sonnet-20240620"
+
+CACHE_TTL = 300  # Seconds a cached prefix lives, refreshed on every read
+CACHE_LOOKBACK = 20  # Blocks before a breakpoint that are also checked for a cached prefix
+CACHE_MIN_TOKENS = 1024  # Shorter prefixes are not cached
+
+FILLER_WORDS = (
+    "that", "makes", "sense", "so", "the", "main", "thing", "getting", "in", "your", "way", "is",
+    "how", "work", "moves", "between", "teams", "what", "happens", "when", "priorities", "change",
+    "let's", "look", "at", "which", "part", "causes", "most", "pain", "right", "now",
+)
+
+
+class LatencyModel:
+    """Samples response latencies: 'fixed:S', 'uniform:LOW:HIGH' or 'lognormal:MEDIAN:SIGMA'"""
+
+    def __init__(self, spec: str, rng: random.Random):
+        kind, *values = spec.split(":")
+        self.kind = kind
+        self.values = [float(value) for value in values]
+        self.rng = rng
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if expected.get(kind) != len(self.values):
+            raise ValueError(f"Invalid latency spec '{spec}'")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.values[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.values)
+        median, sigma = self.values
+        return self.rng.lognormvariate(0, sigma) * median
+
+
+class FakeAnthropic:
+    """Reply logic and counters shared by the request handlers"""
+
+    def __init__(self, latency: str = "lognormal:1.0:0.4", chunk_delay: float = 0.01,
+                 chunk_words: int = 4, reply_words: int = 80, rate_429: float = 0.0,
+                 rate_529: float = 0.0, retry_after: float = 1.0, rpm: int = 0, seed: int = 0):
+        """
+        Args:
+            latency: Time to first token (whole reply time for non-streamed requests)
+            chunk_delay: Seconds between streamed chunks
+            chunk_words: Words per streamed text delta
+            reply_words: Words of filler per coaching reply
+            rate_429: Fraction of message requests answered with 429
+            rate_529: Fraction of message requests answered with 529
+            retry_after: retry-after header on injected errors
+            rpm: Requests-per-minute limit reported in rate-limit headers (0 sends none)
+            seed: Random seed
+        """
+        self.rng = random.Random(seed)
+        self.latency = LatencyModel(latency, self.rng)
+        self.chunk_delay = chunk_delay
+        self.chunk_words = chunk_words
+        self.reply_words = reply_words
+        self.rate_429 = rate_429
+        self.rate_529 = rate_529
+        self.retry_after = retry_after
+        self.rpm = rpm
+        self.counts = Counter()
+        self._recent = deque()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def injected_error(self):
+        """(status, error type) to fail this request with, or None"""
+        with self._lock:
+            roll = self.rng.random()
+        if roll < self.rate_429:
+            return 429, "rate_limit_error"
+        if roll < self.rate_429 + self.rate_529:
+            return 529, "overloaded_error"
+        return None
+
+    def rate_limit_headers(self):
+        if not self.rpm:
+            return {}
+        now = time.monotonic()
+        with self._lock:
+            self._recent.append(now)
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            remaining = max(self.rpm - len(self._recent), 0)
+        return {"anthropic-ratelimit-requests-limit": str(self.rpm),
+                "anthropic-ratelimit-requests-remaining": str(remaining)}
+
+    def prompt_cache(self, request: dict):
+        """(cache read, cache write) tokens for a messages request, updating the cache"""
+        blocks = [("tool", tool) for tool in request.get("tools", [])]
+        system = request.get("system") or []
+        blocks += [("system", block) for block in ([{"type": "text", "text": system}]
+                                                   if isinstance(system, str) else system)]
+        for message in request.get("messages", []):
+            content = message["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            blocks += [(message["role"], block) for block in content]
+
+        # Running hash and token count of the prompt up to and including each block
+        digest = hashlib.sha256(request.get("model", MODEL_ID).encode())  # Caches are per model
+        tokens, prefixes, breakpoints = 0, [], []
+        for index, (role, block) in enumerate(blocks):
+            if isinstance(block, dict) and "cache_control" in block:
+                breakpoints.append(index)
+                block = {key: value for key, value in block.items() if key != "cache_control"}
+            text = json.dumps([role, block], sort_keys=True)
+            digest.update(text.encode())
+            tokens += len(text) // 4
+            prefixes.append((digest.hexdigest(), tokens))
+
+        now = time.monotonic()
+        read = write = 0
+        with self._lock:
+            for breakpoint in breakpoints:
+                for index in range(breakpoint, max(breakpoint - CACHE_LOOKBACK, 0) - 1, -1):
+                    key, length = prefixes[index]
+                    if self._cache.get(key, 0) > now:
+                        self._cache[key] = now + CACHE_TTL
+                        read = max(read, length)
+                        break
+            for breakpoint in breakpoints:
+                key, length = prefixes[breakpoint]
+                if length >= CACHE_MIN_TOKENS and self._cache.get(key, 0) <= now:
+                    self._cache[key] = now + CACHE_TTL
+                    write = max(write, length)
+            for key in [key for key, expiry in self._cache.items() if expiry <= now]:
+                del self._cache[key]
+        return read, max(write - read, 0)
+
+    def filler(self, words: int) -> str:
+        with self._lock:
+            return " ".join(self.rng.choice(FILLER_WORDS) for _ in range(words)).capitalize() + "."
+
+    def reply(self, request: dict):
+        """(kind, content blocks, output tokens) for a messages request"""
+        system = request.get("system", "")
+        system_text = system if isinstance(system, str) else " ".join(block.get("text", "") for block in system)
+        last_user = _text(request["messages"][-1]["content"]) if request.get("messages") else ""
+        complete = COMPLETE_TRIGGER in last_user
+
+        if "rationality vs emotionality" in system_text and request.get("max_tokens", 0) <= 20 \
+                and not request.get("tools"):
+            with self._lock:
+                score = self.rng.randint(-10, 10)
+            return "sentiment", [{"type": "text", "text": str(score)}], 2
+
+        message = self.filler(self.reply_words)
+        evaluation = "The user has made good progress." if complete else "The user is still exploring."
+        if request.get("tools"):
+            fields = {"message": message, "evaluation": evaluation, "is_complete": complete}
+            if complete:
+                fields["goal"] = "Ship a release every two weeks"
+            if "sentiment" in request["tools"][0]["input_schema"]["properties"]:
+                fields["sentiment"] = 2
+            block = {"type": "tool_use", "id": "toolu_fake", "name": request["tools"][0]["name"], "input": fields}
+            return "structured", [block], self.reply_words + 20
+
+        text = message
+        if complete:
+            text = ("Goal confirmed: Ship a release every two weeks\n\nSTEP_COMPLETE\n\n" + text
+                    + "\n\nNow, let's identify what obstacles might be in your way.")
+        text += f"\n\n<evaluation>{evaluation}</evaluation>"
+        if "<sentiment>" in system_text:
+            text += "\n<sentiment>2</sentiment>"
+        return "step", [{"type": "text", "text": text}], self.reply_words + 20
+
+
+def _text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def _message(content, input_tokens: int, output_tokens: int, model: str,
+             cache_read: int = 0, cache_write: int = 0) -> dict:
+    return {
+        "id": "msg_fake", "type": "message", "role": "assistant", "model": model, "content": content,
+        "stop_reason": "tool_use" if content[0]["type"] == "tool_use" else "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": max(input_tokens - cache_read - cache_write, 0), "output_tokens": output_tokens,
+                  "cache_read_input_tokens": cache_read, "cache_creation_input_tokens": cache_write},
+    }
+
+
+def make_handler(fake: FakeAnthropic):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream(self, message, headers):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            def event(name, payload):
+                self._send_chunk(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode())
+
+            start = dict(message, content=[], stop_reason=None,
+                         usage=dict(message["usage"], output_tokens=1))
+            event("message_start", {"type": "message_start", "message": start})
+            event("content_block_start", {"type": "content_block_start", "index": 0,
+                                          "content_block": {"type": "text", "text": ""}})
+            words = message["content"][0]["text"].split(" ")
+            for index in range(0, len(words), fake.chunk_words):
+                piece = " ".join(words[index:index + fake.chunk_words])
+                if index + fake.chunk_words < len(words):
+                    piece += " "
+                event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                              "delta": {"type": "text_delta", "text": piece}})
+                time.sleep(fake.chunk_delay)
+            event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            event("message_delta", {"type": "message_delta",
+                                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+            event("message_stop", {"type": "message_stop"})
+            self._send_chunk(b"")
+
+        def do_GET(self):
+            fake.count("models")
+            self._send_json(200, {"data": [{"type": "model", "id": MODEL_ID, "display_name": MODEL_ID,
+                                            "created_at": "2024-06-20T00:00:00Z"}],
+                                  "has_more": False, "first_id": MODEL_ID, "last_id": MODEL_ID})
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            request = json.loads(raw or b"{}")
+            input_tokens = len(raw) // 4 + 1
+            if self.path.startswith("/v1/messages/count_tokens"):
+                fake.count("count_tokens")
+                self._send_json(200, {"input_tokens": input_tokens})
+                return
+
+            headers = fake.rate_limit_headers()
+            error = fake.injected_error()
+            if error is not None:
+                status, error_type = error
+                fake.count(f"error_{status}")
+                headers["retry-after"] = str(fake.retry_after)
+                self._send_json(status, {"type": "error", "error": {"type": error_type, "message": "Injected"}},
+                                headers)
+                return
+
+            kind, content, output_tokens = fake.reply(request)
+            fake.count(kind + ("_stream" if request.get("stream") else ""))
+            cache_read, cache_write = fake.prompt_cache(request)
+            message = _message(content, input_tokens, output_tokens, request.get("model", MODEL_ID),
+                               cache_read, cache_write)
+            time.sleep(fake.latency.sample())
+            if request.get("stream"):
+                self._stream(message, headers)
+            else:
+                self._send_json(200, message, headers)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_server(fake: FakeAnthropic, port: int = 0) -> ThreadingHTTPServer:
+    """Serve the fake API on 127.0.0.1 from a background thread"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options shared with load_test.py"""
+    parser.add_argument("--latency", default="lognormal:1.0:0.4",
+                        help="Time to first token: fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="Seconds between streamed chunks")
+    parser.add_argument("--reply-words", type=int, default=80, help="Words per coaching reply")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--rate-529", type=float, default=0.0, help="Fraction of requests failing with 529")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after on injected errors")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests-per-minute limit to report in headers")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def fake_from_arguments(args) -> FakeAnthropic:
+    return FakeAnthropic(latency=args.latency, chunk_delay=args.chunk_delay, reply_words=args.reply_words,
+                         rate_429=args.rate_429, rate_529=args.rate_529, retry_after=args.retry_after,
+                         rpm=args.rpm, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = fake_from_arguments(args)
+    server = start_server(fake, args.port)
+    print(f"Fake Anthropic API at http://127.0.0.1:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(f"Requests served: {dict(fake.counts)}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+End-to-end load test: simulated users walking through all five steps against a local fake
+Anthropic API, so no real quota is used.
+
+Each virtual user runs whole sessions one after another:
+    POST /chat "hello" -> --turns-per-step turns per step (the last one completes the step)
+    -> GET /progress after each step -> POST /set_step back to step 1 -> GET /get_summary
+    -> POST /reset
+With --stream the turns go through /chat/stream (time to first token is reported too) and
+cookie sessions are persisted with POST /chat/commit. With --continue-rate, that fraction of
+steps 2-5 open with a plain continuation ("Sounds good, let's continue."), the turns
+SPECULATIVE_PREFETCH answers from a reply generated in the background. In-process runs also
+report token usage per call site, including the fake API's prompt cache reads and writes.
+
+By default the fake API (benchmarks/fake_anthropic.py) and the Flask app (werkzeug, threaded)
+both run in-process. To compare serving configurations, start the fake API and the app
+yourself and pass --target:
+
+    python benchmarks/fake_anthropic.py --port 8090 --latency lognormal:1.0:0.4 &
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8090 TRANSCRIPT_ARCHIVE=memory \\
+        gunicorn -w 4 --threads 8 wsgi:app -b 127.0.0.1:8000 &
+    python benchmarks/load_test.py --target http://127.0.0.1:8000 --users 32 --duration 60
+
+(or uvicorn asgi:app for the async app). Session cookies are kept per virtual user and sent
+over plain HTTP even though the app marks them Secure.
+
+Usage:
+    python benchmarks/load_test.py [--users 8] [--sessions 2 | --duration 60] [--stream]
+                                   [--turns-per-step 2] [--continue-rate 0.5] [--latency fixed:0.2]
+                                   [--rate-429 0.05]
+                                   [--target URL] [--json results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from http.cookies import SimpleCookie
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from fake_anthropic import COMPLETE_TRIGGER, add_arguments, fake_from_arguments, start_server
+
+USER_MESSAGES = [
+    "I want our team to ship a release every two weeks instead of every two months.",
+    "Mostly it's the manual testing at the end, it takes forever and blocks everything.",
+    "I think nobody owns the test environment, so it is always broken when we need it.",
+    "I'm frustrated, honestly, we keep talking about it and nothing changes.",
+    "We could automate the smoke tests first and give one person the environment.",
+    "I can check in every Friday with the team lead and track the release dates.",
+]
+CONTINUE_MESSAGE = "Sounds good, let's continue."
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Results:
+    """Latencies and outcomes per endpoint, shared by the virtual users"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.sessions = 0
+        self.failed_sessions = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, outcome="ok"):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if outcome == "error":
+                self.errors[endpoint] += 1
+            elif outcome == "rejected":
+                self.rejected[endpoint] += 1
+
+    def session_done(self, ok):
+        with self._lock:
+            if ok:
+                self.sessions += 1
+            else:
+                self.failed_sessions += 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[endpoint] = {
+                "count": len(values),
+                "errors": self.errors[endpoint],
+                "rejected": self.rejected[endpoint],
+                **{f"p{int(q * 100)}_ms": round(percentile(values, q) * 1000, 1) for q in (0.5, 0.9, 0.95, 0.99)},
+                "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+            }
+        requests = sum(len(values) for name, values in self.latencies.items() if not name.endswith(" ttft"))
+        errors = sum(self.errors.values())
+        rejected = sum(self.rejected.values())
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests": requests,
+            "throughput_rps": round(requests / elapsed, 2) if elapsed else 0.0,
+            "sessions_completed": self.sessions,
+            "sessions_failed": self.failed_sessions,
+            "sessions_per_s": round(self.sessions / elapsed, 3) if elapsed else 0.0,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "rejected_rate": round(rejected / requests, 4) if requests else 0.0,
+            "endpoints": endpoints,
+        }
+
+
+class VirtualUser:
+    """One browser: an HTTP client with its own cookie jar"""
+
+    def __init__(self, base_url, results, args, seed):
+        self.client = httpx.Client(base_url=base_url, timeout=args.timeout)
+        self.results = results
+        self.args = args
+        self.rng = random.Random(seed)
+        self.cookies = {}
+
+    def _store_cookies(self, response):
+        # Parsed by hand: httpx's cookie jar would not send the app's Secure cookies over http
+        for header in response.headers.get_list("set-cookie"):
+            for name, morsel in SimpleCookie(header).items():
+                if not morsel.value or morsel["max-age"] == "0" or "1970" in morsel["expires"]:
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+
+    def request(self, method, path, endpoint=None, **kwargs):
+        """Send one request and record its latency; returns the response, or None on failure"""
+        endpoint = endpoint or f"{method} {path}"
+        headers = {"Cookie": "; ".join(f"{name}={value}" for name, value in self.cookies.items())}
+        start_time = time.perf_counter()
+        try:
+            response = self.client.request(method, path, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self.results.record(endpoint, time.perf_counter() - start_time, "error")
+            return None
+        self._store_cookies(response)
+        outcome = "ok" if response.is_success else "rejected" if response.status_code == 503 else "error"
+        self.results.record(endpoint, time.perf_counter() - start_time, outcome)
+        return response if response.is_success else None
+
+    def stream_chat(self, user_input):
+        """One /chat/stream turn, committing the session token; returns the done payload or None"""
+        headers = {"Cookie": "; ".join(f"{name}={value}" for name, value in self.cookies.items())}
+        start_time = time.perf_counter()
+        first_token = None
+        payload = None
+        outcome = "error"
+        try:
+            with self.client.stream("POST", "/chat/stream", json={"user_input": user_input},
+                                    headers=headers) as response:
+                self._store_cookies(response)
+                if response.status_code == 503:
+                    outcome = "rejected"
+                elif response.is_success:
+                    event = None
+                    for line in response.iter_lines():
+                        if line.startswith("event: "):
+                            event = line[len("event: "):]
+                        elif line.startswith("data: "):
+                            if event == "token" and first_token is None:
+                                first_token = time.perf_counter() - start_time
+                            elif event == "done":
+                                payload = json.loads(line[len("data: "):])
+                                outcome = "ok"
+                            elif event == "error":
+                                break
+        except httpx.HTTPError:
+            pass
+        self.results.record("POST /chat/stream", time.perf_counter() - start_time, outcome)
+        if first_token is not None:
+            self.results.record("POST /chat/stream ttft", first_token)
+        if payload is None:
+            return None
+
+        token = payload.pop("session_token", None)
+        if token and self.request("POST", "/chat/commit", json={"session_token": token}) is None:
+            return None
+        return payload
+
+    def chat(self, user_input):
+        if self.args.stream:
+            return self.stream_chat(user_input)
+        response = self.request("POST", "/chat", json={"user_input": user_input})
+        return response.json() if response is not None else None
+
+    def run_session(self):
+        """Walk through all five steps; returns whether every step completed"""
+        if self.chat("hello") is None:
+            return False
+        for step in range(1, 6):
+            for turn in range(self.args.turns_per_step):
+                message = self.rng.choice(USER_MESSAGES)
+                if turn == 0 and step > 1 and self.rng.random() < self.args.continue_rate:
+                    message = CONTINUE_MESSAGE
+                if turn == self.args.turns_per_step - 1:
+                    message += f" {COMPLETE_TRIGGER}"
+                if self.chat(message) is None:
+                    return False
+            progress = self.request("GET", "/progress")
+            if progress is None or step not in progress.json().get("completed_steps", []):
+                return False
+        if self.request("POST", "/set_step", json={"step": 1}) is None:
+            return False
+        if self.request("GET", "/get_summary") is None:
+            return False
+        return self.request("POST", "/reset") is not None
+
+    def run(self, sessions, deadline):
+        completed = 0
+        while (sessions and completed < sessions) or (not sessions and time.monotonic() < deadline):
+            self.results.session_done(self.run_session())
+            completed += 1
+        self.client.close()
+
+
+def start_app():
+    """Serve app.py with werkzeug's threaded server; returns (server, base URL)"""
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from werkzeug.serving import make_server
+    from app import app
+
+    # Per-request INFO logs from werkzeug, httpx and the app would drown the report
+    logging.disable(logging.INFO)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def print_report(summary, fake=None):
+    print(f"\n{summary['requests']} requests in {summary['elapsed_s']}s: "
+          f"{summary['throughput_rps']} req/s, {summary['sessions_per_s']} sessions/s")
+    print(f"Sessions: {summary['sessions_completed']} completed, {summary['sessions_failed']} failed; "
+          f"error rate {summary['error_rate']:.2%}, rejected (503) {summary['rejected_rate']:.2%}\n")
+    print(f"{'endpoint':<26}{'count':>7}{'errors':>8}{'503':>6}{'p50 ms':>10}{'p90 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"{endpoint:<26}{stats['count']:>7}{stats['errors']:>8}{stats['rejected']:>6}"
+              f"{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    if "prefetch" in summary:
+        print(f"\nPrefetch: {summary['prefetch']}")
+    if summary.get("usage"):
+        print(f"\n{'usage':<26}{'requests':>9}{'input':>10}{'cache read':>12}{'cache write':>12}{'hit ratio':>10}")
+        for label, stats in sorted(summary["usage"].items()):
+            print(f"{label:<26}{stats['requests']:>9}{stats['input_tokens']:>10}"
+                  f"{stats['cache_read_input_tokens']:>12}{stats['cache_creation_input_tokens']:>12}"
+                  f"{stats['cache_hit_ratio']:>10.1%}")
+    if fake is not None:
+        print(f"\nFake API requests: {dict(sorted(fake.counts.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users")
+    parser.add_argument("--sessions", type=int, default=2, help="Sessions per user (ignored with --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="Run for this many seconds instead")
+    parser.add_argument("--turns-per-step", type=int, default=2, help="Turns per step, the last one completes it")
+    parser.add_argument("--continue-rate", type=float, default=0.0,
+                        help="Fraction of steps 2-5 opened with a plain continuation message")
+    parser.add_argument("--stream", action="store_true", help="Use /chat/stream instead of /chat")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request client timeout")
+    parser.add_argument("--target", help="Base URL of an already running app (skips the in-process servers)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = None
+    if args.target:
+        base_url = args.target.rstrip("/")
+    else:
+        fake = fake_from_arguments(args)
+        fake_server = start_server(fake)
+        os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{fake_server.server_address[1]}"
+        os.environ.setdefault("SECRET_KEY", "load-test")
+        os.environ.setdefault("ANTHROPIC_API_KEY", "load-test")
+        os.environ.setdefault("TRANSCRIPT_ARCHIVE", "memory")
+        os.environ.setdefault("CLIENT_WARM_UP", "false")
+        app_server, base_url = start_app()
+
+    results = Results()
+    sessions = 0 if args.duration else args.sessions
+    deadline = time.monotonic() + args.duration
+    users = [VirtualUser(base_url, results, args, seed=args.seed + index) for index in range(args.users)]
+    threads = [threading.Thread(target=user.run, args=(sessions, deadline)) for user in users]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = results.summary(time.perf_counter() - start_time)
+    summary["config"] = {name: value for name, value in vars(args).items() if name != "json"}
+
+    if not args.target:
+        from app import prefetcher
+        from utils import usage_summary
+        if prefetcher is not None:
+            summary["prefetch"] = prefetcher.snapshot()
+        # Token usage per call site, with the fake API's prompt cache reads and writes
+        summary["usage"] = usage_summary()
+
+    print_report(summary, fake)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    if not args.target:
+        app_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
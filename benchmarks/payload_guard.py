@@ -0,0 +1,153 @@
+"""
+Prompt-size regression guard for the step handlers.
+
+Runs every handle_stepN against a RecordingClient (a fake Anthropic client that records each
+request and returns a canned reply) on fixed conversations, then checks that:
+    - no request repeats a message back to back (the old step 1 history duplication)
+    - no handler modifies the history it was given
+    - each request's size stays within tolerance of benchmarks/payload_baseline.json
+
+Exits with status 1 on any failure.
+
+Usage:
+    python benchmarks/payload_guard.py [--tolerance 0.05]
+    python benchmarks/payload_guard.py --update    # rewrite the baseline after intended changes
+"""
+import os
+import sys
+import copy
+import json
+import argparse
+from types import SimpleNamespace
+
+# The step modules import config, which requires these to be set
+os.environ.setdefault("SECRET_KEY", "payload-guard")
+os.environ.setdefault("ANTHROPIC_API_KEY", "payload-guard")
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from steps.step1 import handle_step1
+from steps.step2 import handle_step2
+from steps.step3 import handle_step3
+from steps.step4 import handle_step4
+from steps.step5 import handle_step5
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payload_baseline.json")
+
+HANDLERS = {1: handle_step1, 2: handle_step2, 3: handle_step3, 4: handle_step4, 5: handle_step5}
+
+GOAL = "Cut our release cycle from four weeks to two by the end of the quarter"
+
+CANNED_REPLY = (
+    "That helps. What happens between a change being ready and it reaching customers?\n\n"
+    "<evaluation>The user is describing their release process.</evaluation>"
+)
+
+
+class RecordingClient:
+    """Stands in for anthropic.Anthropic, recording every messages.create request"""
+
+    def __init__(self, reply: str = CANNED_REPLY):
+        self.reply = reply
+        self.requests = []
+        self.messages = self
+
+    def create(self, **request):
+        self.requests.append(copy.deepcopy(request))
+        return SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=self.reply)],
+            usage=SimpleNamespace(input_tokens=0, output_tokens=0,
+                                  cache_read_input_tokens=0, cache_creation_input_tokens=0),
+        )
+
+
+def conversation(turns: int):
+    """A fixed history of alternating user and assistant messages"""
+    history = []
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"Turn {turn}: our reviews wait about three days "
+                                                   f"and priorities change mid-sprint. " * 3})
+        history.append({"role": "assistant", "content": f"Reply {turn}: that sounds frustrating. "
+                                                        f"Which of those costs you the most time? " * 8})
+    return history
+
+
+SCENARIOS = {
+    "first_turn": 0,
+    "short": 3,
+    "long": 30,
+}
+
+
+def measure():
+    """Run every handler on every scenario; returns (sizes, failures)"""
+    sizes = {}
+    failures = []
+    for step, handler in HANDLERS.items():
+        for scenario, turns in SCENARIOS.items():
+            name = f"step{step}/{scenario}"
+            history = conversation(turns)
+            original = copy.deepcopy(history)
+            client = RecordingClient()
+            handler("We keep missing release dates.", history, GOAL, client)
+
+            if history != original:
+                failures.append(f"{name}: handler modified the history it was given")
+            if len(client.requests) != 1:
+                failures.append(f"{name}: expected 1 request, got {len(client.requests)}")
+                continue
+
+            request = client.requests[0]
+            messages = request["messages"]
+            for previous, current in zip(messages, messages[1:]):
+                if previous == current:
+                    failures.append(f"{name}: message repeated back to back ({current['role']})")
+                    break
+
+            sizes[name] = {
+                "bytes": len(json.dumps(request, sort_keys=True)),
+                "messages": len(messages),
+            }
+    return sizes, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Allowed relative growth in request bytes")
+    parser.add_argument("--update", action="store_true", help="Write the current sizes as the new baseline")
+    args = parser.parse_args()
+
+    sizes, failures = measure()
+
+    if args.update:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(sizes, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+    else:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        print(f"{'request':<20} {'baseline':>9} {'current':>9} {'change':>8} {'messages':>8}")
+        for name, size in sizes.items():
+            expected = baseline.get(name)
+            if expected is None:
+                failures.append(f"{name}: missing from baseline (run with --update)")
+                continue
+            change = size["bytes"] / expected["bytes"] - 1
+            print(f"{name:<20} {expected['bytes']:>9} {size['bytes']:>9} {change:>8.1%} {size['messages']:>8}")
+            if change > args.tolerance:
+                failures.append(f"{name}: request grew {change:.1%} "
+                                f"({expected['bytes']} -> {size['bytes']} bytes)")
+            if size["messages"] > expected["messages"]:
+                failures.append(f"{name}: {size['messages']} messages, baseline {expected['messages']}")
+
+    if failures:
+        print("\nFAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nAll request payloads within tolerance")
+
+
+if __name__ == "__main__":
+    main()
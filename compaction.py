@@ -0,0 +1,137 @@
+"""
+Step-boundary history compaction.
+
+When a step completes, its raw turns are replaced in the session history by a synthetic
+pair: a user message carrying a <completed_step> block (step name, goal and the step's
+evaluation summary) followed by the step's closing assistant message, so the conversation
+still reads naturally into the next step. The raw turns are written to a transcript archive
+so nothing is lost.
+"""
+import re
+import json
+import sqlite3
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from session_store import MemoryStore, RedisStore, SessionStore, SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+_SUMMARY_PATTERN = re.compile(r'<completed_step number="(\d+)"')
+
+
+def is_step_summary(message: Dict[str, str]) -> bool:
+    """Whether a history message is a synthetic completed-step block"""
+    return message.get('role') == 'user' and bool(_SUMMARY_PATTERN.match(message.get('content', '')))
+
+
+def current_step_start(history: List[Dict[str, str]]) -> int:
+    """Index of the first message after the most recent completed-step pair"""
+    for index in range(len(history) - 1, -1, -1):
+        if is_step_summary(history[index]):
+            return index + 2
+    return 0
+
+
+def format_step_summary(step: int, name: str, goal: Optional[str], evaluation: str) -> str:
+    """Build the synthetic user message standing in for a completed step"""
+    lines = [f'<completed_step number="{step}" name="{name}">']
+    if goal:
+        lines.append(f"Goal: {goal}")
+    lines.append(f"Summary: {evaluation}")
+    lines.append("</completed_step>")
+    return "\n".join(lines)
+
+
+def compact_step_history(history: List[Dict[str, str]], step: int, name: str, goal: Optional[str],
+                         evaluation: str) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """
+    Replace the turns of a just-completed step with a compact summary pair.
+
+    Args:
+        history: Session history ending with the step's closing assistant message
+        step: Number of the completed step
+        name: Name of the completed step
+        goal: The user's goal, if known
+        evaluation: Evaluation summary stored for the step
+
+    Returns:
+        Tuple of (new history, raw messages that were replaced). The history is returned
+        unchanged, with no replaced messages, when there is nothing to compact.
+    """
+    start = current_step_start(history)
+    transcript = history[start:]
+    if not evaluation or len(transcript) < 2 or transcript[-1].get('role') != 'assistant':
+        return history, []
+
+    compacted = history[:start] + [
+        {'role': 'user', 'content': format_step_summary(step, name, goal, evaluation)},
+        transcript[-1],
+    ]
+    return compacted, transcript
+
+
+class TranscriptArchive:
+    """Keeps raw transcripts of compacted steps in a SessionStore"""
+
+    def __init__(self, store: SessionStore, ttl: int, key_prefix: str = 'transcript:'):
+        """
+        Args:
+            store: Backing key/value store
+            ttl: Seconds to keep archived transcripts
+            key_prefix: Prefix separating transcripts from other keys in a shared store
+        """
+        self.store = store
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def _key(self, archive_id: str, step: int) -> str:
+        return f"{self.key_prefix}{archive_id}:{step}"
+
+    def load(self, archive_id: str, step: int) -> List[List[Dict[str, str]]]:
+        """All archived transcripts of a step, oldest first (a revisited step has several)"""
+        data = self.store.get(self._key(archive_id, step))
+        return json.loads(data) if data else []
+
+    def save(self, archive_id: str, step: int, messages: List[Dict[str, str]]) -> None:
+        """Append a step transcript to the archive"""
+        transcripts = self.load(archive_id, step)
+        transcripts.append(messages)
+        self.store.set(self._key(archive_id, step), json.dumps(transcripts).encode(), self.ttl)
+
+
+TRANSCRIPT_ARCHIVES = ('none', 'memory', 'sqlite', 'redis')
+
+
+def create_transcript_archive(backend: str, ttl: int, sqlite_path: str = 'transcripts.sqlite3',
+                              redis_url: str = 'redis://localhost:6379/0') -> Optional[TranscriptArchive]:
+    """
+    Build the transcript archive for a backend.
+
+    Args:
+        backend: One of TRANSCRIPT_ARCHIVES
+        ttl: Seconds to keep archived transcripts
+        sqlite_path: Database file for the sqlite backend
+        redis_url: Connection URL for the redis backend
+
+    Returns:
+        A TranscriptArchive, or None when archiving is disabled or unavailable
+    """
+    if backend == 'none':
+        return None
+    try:
+        if backend == 'memory':
+            store = MemoryStore()
+        elif backend == 'sqlite':
+            store = SQLiteStore(sqlite_path)
+        elif backend == 'redis':
+            store = RedisStore(redis_url)
+        else:
+            raise ValueError(
+                f"Unknown TRANSCRIPT_ARCHIVE '{backend}'. Expected one of: {', '.join(TRANSCRIPT_ARCHIVES)}"
+            )
+    except (RuntimeError, OSError, sqlite3.Error) as e:
+        # Read-only filesystems (e.g. serverless) must not stop the app from starting
+        logger.error(f"Transcript archive '{backend}' unavailable, compacted turns will not be kept: {str(e)}")
+        return None
+    return TranscriptArchive(store, ttl)
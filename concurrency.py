@@ -0,0 +1,90 @@
+"""
+Process-wide concurrency limiting for the async serving path.
+
+ConcurrencyLimiter admits at most max_concurrent coroutines at once and lets up to
+max_waiting more queue for a slot; beyond that, new work is rejected immediately with
+QueueFullError instead of piling up unbounded latency. Counters for in-flight work, queue
+depth and waiting time are kept for monitoring.
+"""
+import time
+import asyncio
+from typing import Any, Awaitable, Dict
+
+
+class QueueFullError(Exception):
+    """Raised when the limiter's wait queue is full"""
+
+
+class ConcurrencyLimiter:
+    """Semaphore with a bounded wait queue and queue-depth metrics (one per event loop)"""
+
+    def __init__(self, max_concurrent: int, max_waiting: int):
+        """
+        Args:
+            max_concurrent: Coroutines allowed to run at the same time
+            max_waiting: Coroutines allowed to wait for a slot before new ones are rejected
+        """
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_in_flight = 0
+        self.peak_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+
+    async def run(self, coro: Awaitable) -> Any:
+        """
+        Run a coroutine once a slot is free.
+
+        Args:
+            coro: Coroutine to run; it is closed unstarted if rejected or cancelled while queued
+
+        Returns:
+            The coroutine's result
+
+        Raises:
+            QueueFullError: If every slot is busy and the wait queue is full
+        """
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            coro.close()
+            raise QueueFullError(f"{self.waiting} requests already waiting for one of "
+                                 f"{self.max_concurrent} slots")
+
+        queued_at = time.monotonic()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        except BaseException:
+            coro.close()
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.admitted += 1
+        self.wait_seconds_total += time.monotonic() - queued_at
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await coro
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def snapshot(self) -> Dict[str, float]:
+        """Current limits and counters"""
+        return {
+            'max_concurrent': self.max_concurrent,
+            'max_waiting': self.max_waiting,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'peak_in_flight': self.peak_in_flight,
+            'peak_waiting': self.peak_waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'mean_wait_seconds': round(self.wait_seconds_total / self.admitted, 4) if self.admitted else 0.0,
+        }
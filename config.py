@@ -33,7 +33,33 @@ if not ANTHROPIC_API_KEY:
 # Model Configuration
 DEFAULT_MODEL = "claude-3-5-sonnet-20240620"
 MAX_TOKENS = 4000
-MAX_HISTORY_MESSAGES = 50  # Maximum number of messages to keep in history
+FAST_MODEL = os.environ.get('FAST_MODEL', 'claude-3-5-haiku-20241022')
+
+# Model Routing
+# Each route names a call type ('step' or 'sentiment') and optionally a step and coaching stage;
+# the most specific matching route picks the model and max_tokens. Step calls no route matches
+# use DEFAULT_MODEL and MAX_TOKENS. Routing changes the model users talk to, so it is opt-in:
+# set MODEL_ROUTING=true to apply MODEL_ROUTES.
+MODEL_ROUTING = os.environ.get('MODEL_ROUTING', 'false').lower() == 'true'
+MODEL_ROUTES = [
+    # Short goal-clarifying turns
+    {'call': 'step', 'step': 1, 'model': FAST_MODEL, 'max_tokens': 1024},
+    # Opening question of problem identification
+    {'call': 'step', 'step': 2, 'stage': 'initial_question', 'model': FAST_MODEL, 'max_tokens': 1024},
+    # Single-number rationality score
+    {'call': 'sentiment', 'model': FAST_MODEL, 'max_tokens': 10},
+]
+
+# Context Window Configuration
+# Input-token budget (system prompt + messages) for each step request; older turns are
+# compressed, then dropped, to stay within it. Later steps get more room for earlier context.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 12000))
+CONTEXT_STEP_TOKEN_BUDGETS = {1: 8000, 2: 10000, 3: 12000, 4: 12000, 5: 12000}
+# Older turns are compressed, then dropped, this many messages at a time, so the start of the
+# request stays the same (and in the prompt cache) for several turns between trims
+CONTEXT_TRIM_BLOCK = int(os.environ.get('CONTEXT_TRIM_BLOCK', 10))
+# Measure each message once with the token-counting API instead of estimating (~4 chars/token)
+CONTEXT_EXACT_TOKEN_COUNT = os.environ.get('CONTEXT_EXACT_TOKEN_COUNT', 'false').lower() == 'true'
 
 # Session Configuration
 SESSION_CONFIG = {
@@ -45,6 +71,38 @@ SESSION_CONFIG = {
     'SESSION_COOKIE_SAMESITE': 'Lax',
 }
 
+# Seconds a /chat/stream session_token can be posted to /chat/commit; the browser commits
+# right after the stream ends
+STREAM_COMMIT_MAX_AGE = int(os.environ.get('STREAM_COMMIT_MAX_AGE', 300))
+
+# Session Storage Configuration
+# 'cookie' keeps the whole session in the signed cookie (Flask default, works on Vercel).
+# 'compact' is also cookie-only, with short keys and compression, split over several cookies.
+# 'memory', 'sqlite' and 'redis' keep it server-side and put only an opaque id in the cookie.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cookie')
+SESSION_LRU_MAX_ENTRIES = int(os.environ.get('SESSION_LRU_MAX_ENTRIES', 10000))
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', 'sessions.sqlite3')
+SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_COMPRESSION = os.environ.get('SESSION_COMPRESSION', 'zlib')  # 'zstd' needs zstandard
+# Keep the total Cookie header well under common 8KB proxy limits
+SESSION_COOKIE_MAX_CHUNKS = int(os.environ.get('SESSION_COOKIE_MAX_CHUNKS', 2))
+# Cookie sessions must stay under ~4KB per cookie, so the oldest exchanges are dropped past this many
+# characters. Server-side sessions have no such limit.
+SESSION_HISTORY_CHAR_LIMIT = {
+    'cookie': 3500,
+    'compact': 7000 * SESSION_COOKIE_MAX_CHUNKS,
+}.get(SESSION_BACKEND)
+
+# Step Compaction Configuration
+# On step completion, replace the step's turns in history with a summary built from its
+# evaluation, optionally keeping the raw turns in a transcript archive ('none', 'memory',
+# 'sqlite', 'redis'). Archiving stores users' raw conversations for TRANSCRIPT_TTL, so it is opt-in.
+COMPACT_COMPLETED_STEPS = os.environ.get('COMPACT_COMPLETED_STEPS', 'true').lower() == 'true'
+TRANSCRIPT_ARCHIVE = os.environ.get('TRANSCRIPT_ARCHIVE', 'none')
+TRANSCRIPT_SQLITE_PATH = os.environ.get('TRANSCRIPT_SQLITE_PATH', 'transcripts.sqlite3')
+TRANSCRIPT_REDIS_URL = os.environ.get('TRANSCRIPT_REDIS_URL', SESSION_REDIS_URL)
+TRANSCRIPT_TTL = int(os.environ.get('TRANSCRIPT_TTL', 30 * 24 * 3600))  # Seconds
+
 # Step Definitions
 STEPS = [
     {"number": 1, "name": "Have Clear Goals", "description": "Define a specific, measurable goal"},
@@ -57,6 +115,88 @@ STEPS = [
 # Step Completion Marker
 STEP_COMPLETE_MARKER = "STEP_COMPLETE"
 
+# Anthropic HTTP Client Configuration
+# Idle connections are kept for CLIENT_KEEPALIVE_EXPIRY seconds (the SDK default is 5), so turns
+# after a pause reuse the open TLS connection. HTTP/2 needs pip install 'httpx[http2]'.
+CLIENT_MAX_CONNECTIONS = int(os.environ.get('CLIENT_MAX_CONNECTIONS', 100))
+CLIENT_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('CLIENT_MAX_KEEPALIVE_CONNECTIONS', 20))
+CLIENT_KEEPALIVE_EXPIRY = float(os.environ.get('CLIENT_KEEPALIVE_EXPIRY', 60.0))
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', 5.0))
+CLIENT_READ_TIMEOUT = float(os.environ.get('CLIENT_READ_TIMEOUT', 180.0))
+CLIENT_HTTP2 = os.environ.get('CLIENT_HTTP2', 'false').lower() == 'true'
+# Open a connection at startup, and optionally ping every N seconds while idle (0 disables;
+# keep it below CLIENT_KEEPALIVE_EXPIRY). Pings list one model and cost no tokens.
+CLIENT_WARM_UP = os.environ.get('CLIENT_WARM_UP', 'true').lower() == 'true'
+CLIENT_KEEP_WARM_INTERVAL = float(os.environ.get('CLIENT_KEEP_WARM_INTERVAL', 0))
+
+# Transport settings shared by the sync (app.py) and async (asgi.py) clients
+CLIENT_TRANSPORT = {
+    'max_connections': CLIENT_MAX_CONNECTIONS,
+    'max_keepalive_connections': CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+    'keepalive_expiry': CLIENT_KEEPALIVE_EXPIRY,
+    'connect_timeout': CLIENT_CONNECT_TIMEOUT,
+    'read_timeout': CLIENT_READ_TIMEOUT,
+    'http2': CLIENT_HTTP2,
+}
+
 # API Request Retry Configuration
 MAX_RETRIES = 2
-RETRY_DELAY = 2  # seconds between retries
\ No newline at end of file
+RETRY_DELAY = 2  # Backoff ceiling in seconds for the first retry, doubling on each retry
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 20))  # Longest single wait, including retry-after
+RETRY_DEADLINE = float(os.environ.get('RETRY_DEADLINE', 30))  # No retry starts this many seconds after the first attempt
+# After this many consecutive transient API failures, calls fail fast for CIRCUIT_RESET_TIMEOUT
+# seconds, then a single trial call decides whether to resume
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+
+# Concurrency Configuration
+EXECUTOR_MAX_WORKERS = int(os.environ.get('EXECUTOR_MAX_WORKERS', 16))  # Shared pool for background sentiment scoring
+SENTIMENT_TIMEOUT = float(os.environ.get('SENTIMENT_TIMEOUT', 3.0))  # Per-request deadline in seconds
+# Async serving (asgi.py): Claude calls allowed at once per process, and requests allowed to
+# wait for one before new requests get a 503
+ASYNC_MAX_CONCURRENCY = int(os.environ.get('ASYNC_MAX_CONCURRENCY', 100))
+ASYNC_MAX_QUEUE = int(os.environ.get('ASYNC_MAX_QUEUE', 400))
+
+# Hedged Requests (opt-in)
+# A non-streamed step call still unanswered after the recent HEDGE_PERCENTILE latency gets a
+# duplicate request (to HEDGE_FALLBACK_MODEL if set); the first reply wins and the other is
+# cancelled. At most HEDGE_BUDGET of calls are hedged.
+HEDGE_REQUESTS = os.environ.get('HEDGE_REQUESTS', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.1))
+HEDGE_FALLBACK_MODEL = os.environ.get('HEDGE_FALLBACK_MODEL', '')
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 10.0))  # Seconds, until latencies are known
+
+# Client-side Rate Limiting
+# Follow the API's anthropic-ratelimit-* headers and queue requests (coaching turns before
+# sentiment scoring) instead of sending them into 429s
+RATE_LIMIT_ADAPTIVE = os.environ.get('RATE_LIMIT_ADAPTIVE', 'true').lower() == 'true'
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 20))  # Seconds a coaching turn may queue
+
+# Structured Step Replies
+# Non-streamed turns (/chat) answer through a step_reply tool call with separate message,
+# evaluation, is_complete and goal fields, instead of markers and tags parsed out of the text
+STRUCTURED_OUTPUT = os.environ.get('STRUCTURED_OUTPUT', 'false').lower() == 'true'
+
+# Speculative Prefetch (opt-in)
+# When a turn completes a step, generate the next step's opening turn in the background as if
+# the user had replied PREFETCH_INPUT. If the next message is a simple continuation ("ok",
+# "yes, let's go"), that reply is served without waiting; any other message discards it,
+# though its tokens are already spent.
+SPECULATIVE_PREFETCH = os.environ.get('SPECULATIVE_PREFETCH', 'false').lower() == 'true'
+PREFETCH_INPUT = os.environ.get('PREFETCH_INPUT', "Yes, let's continue.")
+PREFETCH_TTL = float(os.environ.get('PREFETCH_TTL', 600))  # Seconds a prefetched turn stays usable
+PREFETCH_MAX_ENTRIES = int(os.environ.get('PREFETCH_MAX_ENTRIES', 1000))  # Sessions per process
+PREFETCH_MAX_WORKERS = int(os.environ.get('PREFETCH_MAX_WORKERS', 4))  # Own pool, apart from sentiment scoring
+# Longest a continuation turn waits for its still-running prefetch before making its own call
+PREFETCH_WAIT_TIMEOUT = float(os.environ.get('PREFETCH_WAIT_TIMEOUT', 15))
+
+# Metrics
+# Per-phase latency, token and retry metrics, served in Prometheus text format at /metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Sentiment Scoring Configuration
+# 'llm' scores each message with a short Claude request; 'lexicon' scores in-process with no API call;
+# 'inline' has each step reply carry the score in a hidden <sentiment> tag (lexicon when it is missing).
+# Use scripts/calibrate_sentiment.py to compare the two on a recorded corpus before switching.
+SENTIMENT_BACKEND = os.environ.get('SENTIMENT_BACKEND', 'llm')
@@ -0,0 +1,213 @@
+"""
+Token-budgeted context assembly for the step handlers.
+
+build_messages() turns the stored history plus the new user input into the messages sent to
+Claude, keeping the estimated input tokens (system prompt + messages) within a per-step
+budget. Recent turns are kept verbatim; once the budget runs short, older turns are
+compressed and the oldest are dropped, a block of messages at a time so the request's prefix
+stays cacheable.
+
+Token counts come from a local estimate (~4 characters per token) unless exact counting is
+enabled, in which case each message is measured once with the token-counting API. Either way
+counts are cached per message, so a turn only pays for messages it has not seen before.
+"""
+import math
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Union
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_STEP_TOKEN_BUDGETS, CONTEXT_TRIM_BLOCK, DEFAULT_MODEL
+from utils import compress_content
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and turn framing added around each message
+COMPRESSED_BLOCKS = 4  # Trimmed blocks kept in compressed form before the oldest are dropped
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for English text"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def system_text(system: Union[str, List[Dict[str, Any]], None]) -> str:
+    """Flatten a system prompt given as a string or a list of text blocks"""
+    if not system:
+        return ""
+    if isinstance(system, str):
+        return system
+    return "".join(block.get("text", "") for block in system)
+
+
+class TokenCounter:
+    """Per-message token counts with an LRU cache, optionally exact via the API"""
+
+    def __init__(self, client=None, model: str = DEFAULT_MODEL, max_entries: int = 8192):
+        """
+        Args:
+            client: Anthropic client for exact counts, or None to only estimate
+            model: Model whose tokenizer exact counts should use
+            max_entries: Number of message counts to remember
+        """
+        self.client = client
+        self.model = model
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._baseline = None
+
+    def _api_count(self, messages, system=None) -> int:
+        request = {"model": self.model, "messages": messages}
+        if system:
+            request["system"] = system
+        return self.client.messages.count_tokens(**request).input_tokens
+
+    def _exact(self, role: str, content: str) -> int:
+        # The API counts a whole request, so measure against a minimal one
+        probe = {"role": "user", "content": "."}
+        if self._baseline is None:
+            self._baseline = self._api_count([probe])
+        if role == "system":
+            return max(self._api_count([probe], system=content) - self._baseline, 0)
+        if role == "assistant":
+            return max(self._api_count([probe, {"role": role, "content": content}]) - self._baseline, 1)
+        # A lone user message replaces the probe rather than adding to it
+        tokens = self._api_count([{"role": role, "content": content}]) - self._baseline
+        return max(tokens + MESSAGE_OVERHEAD_TOKENS, 1)
+
+    def count(self, role: str, content: str) -> int:
+        """
+        Tokens a message adds to a request.
+
+        Args:
+            role: 'user', 'assistant' or 'system'
+            content: Message text
+
+        Returns:
+            Exact count when a client is configured and the API call succeeds, else an estimate
+        """
+        key = (role, content)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        tokens = None
+        if self.client is not None:
+            try:
+                tokens = self._exact(role, content)
+            except Exception as e:
+                logger.warning(f"Token counting failed, using estimate: {str(e)}")
+        if tokens is None:
+            tokens = estimate_tokens(content) + (0 if role == "system" else MESSAGE_OVERHEAD_TOKENS)
+
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+
+_token_counter = TokenCounter()
+
+
+def configure_token_counter(client=None, model: str = DEFAULT_MODEL) -> None:
+    """Use exact token counts through the given client, or estimates when client is None"""
+    global _token_counter
+    _token_counter = TokenCounter(client, model)
+
+
+def token_budget(step: int) -> int:
+    """Input-token budget for a step's requests"""
+    return CONTEXT_STEP_TOKEN_BUDGETS.get(step, CONTEXT_TOKEN_BUDGET)
+
+
+def build_messages(history: Optional[List[Dict[str, str]]], user_input: str, step: int,
+                   system: Union[str, List[Dict[str, Any]], None] = None,
+                   budget: Optional[int] = None,
+                   counter: Optional[TokenCounter] = None,
+                   block: int = CONTEXT_TRIM_BLOCK) -> List[Dict[str, str]]:
+    """
+    Assemble the messages for a step request within the step's token budget.
+
+    History is trimmed a block of messages at a time, counted from its start: at trim level k
+    the first k blocks are compressed and all but the newest COMPRESSED_BLOCKS of those are
+    dropped. The lowest level that fits is used. A longer history never needs a lower level,
+    so the request only changes at its start when the level goes up, every few turns, and the
+    turns in between read the same history prefix from the prompt cache.
+
+    Args:
+        history: Stored conversation history (never modified)
+        user_input: The new user message, always included
+        step: Current step number, selects the budget
+        system: System prompt sent with the request, counted against the budget
+        budget: Override for the step's budget
+        counter: Override for the shared token counter
+        block: Messages per trim level
+
+    Returns:
+        New list of messages, oldest first, starting with a user message
+    """
+    counter = counter or _token_counter
+    budget = token_budget(step) if budget is None else budget
+    history = history or []
+    block = max(block, 1)
+
+    fixed = counter.count("user", user_input)
+    text = system_text(system)
+    if text:
+        fixed += counter.count("system", text)
+
+    # Every level below the one that keeps the newest turns that fit verbatim is over budget
+    used = fixed
+    fits = len(history)
+    costs = {}
+    for index in range(len(history) - 1, -1, -1):
+        costs[index] = counter.count(history[index]["role"], history[index]["content"])
+        if used + costs[index] > budget:
+            break
+        used += costs[index]
+        fits = index
+    level = -(-fits // block)
+    verbatim_start = min(level * block, len(history))
+    keep_start = min(max(level - COMPRESSED_BLOCKS, 0) * block, verbatim_start)
+    used = fixed + sum(costs[index] for index in range(verbatim_start, len(history)))
+
+    compressed = {}
+
+    def compress(index):
+        """Compress history[index]; returns its compressed token count"""
+        role = history[index]["role"]
+        compressed[index] = compress_content(role, history[index]["content"])
+        costs[index] = counter.count(role, compressed[index])
+        return costs[index]
+
+    used += sum(compress(index) for index in range(keep_start, verbatim_start))
+    # Raise the trim level until the request fits; with everything dropped it is just the input
+    while used > budget and keep_start < len(history):
+        level += 1
+        end = min(level * block, len(history))
+        for index in range(verbatim_start, end):
+            used -= costs[index]
+            used += compress(index)
+        verbatim_start = end
+        start = min(max(level - COMPRESSED_BLOCKS, 0) * block, verbatim_start)
+        used -= sum(costs[index] for index in range(keep_start, start))
+        keep_start = start
+
+    selected = [{"role": history[index]["role"], "content": compressed[index]}
+                for index in range(keep_start, verbatim_start)]
+    selected += [{"role": message["role"], "content": message["content"]}
+                 for message in history[verbatim_start:]]
+    # Requests must open with a user turn
+    start = next((i for i, message in enumerate(selected) if message["role"] == "user"), len(selected))
+    messages = selected[start:]
+    messages.append({"role": "user", "content": user_input})
+
+    if level:
+        dropped = len(history) - (len(messages) - 1)
+        logger.info(f"Step {step} context over budget: compressed {verbatim_start - keep_start} older "
+                    f"turns, dropped {dropped} (~{used} of {budget} tokens)")
+    return messages
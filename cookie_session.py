@@ -0,0 +1,238 @@
+"""
+Compact cookie sessions.
+
+Flask's default cookie session stores JSON with the full key names, base64 encoded. For this
+app almost all of that is conversation history, so the compact encoding:
+    - replaces the known session keys with one-letter keys
+    - stores history messages as [role_code, content] pairs
+    - compresses the result (zlib, or zstd when the `zstandard` package is installed)
+    - signs it with a timestamped signature
+    - splits it across several cookies (session, session.1, ...) when it outgrows one
+"""
+import json
+import zlib
+import logging
+from typing import Any, Dict, List
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, TimestampSigner
+from itsdangerous.encoding import base64_decode, base64_encode
+
+logger = logging.getLogger(__name__)
+
+# Short keys for the fields SessionState manages
+KEY_CODES = {
+    'current_step': 's',
+    'completed_steps': 'c',
+    'history': 'h',
+    'goal': 'g',
+    'step_evaluations': 'e',
+    'sentiment_ema': 'm',
+    'archive_id': 'a',
+    'commit_nonce': 'n',
+    '_permanent': 'p',
+}
+KEY_NAMES = {code: key for key, code in KEY_CODES.items()}
+EXTRA_KEY = 'x'  # Holds any other session keys unchanged
+
+ROLE_CODES = {'user': 0, 'assistant': 1}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+# One-byte prefixes identifying how the payload was compressed
+CODEC_RAW = b'r'
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b's'
+
+# Bytes of signed value per cookie, leaving room for the name and attributes under 4KB
+COOKIE_CHUNK_SIZE = 3800
+
+_tagger = TaggedJSONSerializer()
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _pack_message(message: Dict[str, Any]) -> Any:
+    if len(message) == 2 and message.get('role') in ROLE_CODES and 'content' in message:
+        return [ROLE_CODES[message['role']], message['content']]
+    return message  # Unusual shapes are kept as-is
+
+
+def _unpack_message(message: Any) -> Dict[str, Any]:
+    if isinstance(message, list):
+        return {'role': ROLE_NAMES[message[0]], 'content': message[1]}
+    return message
+
+
+def pack_session(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert session data to the short-key representation"""
+    packed = {}
+    extra = {}
+    for key, value in data.items():
+        code = KEY_CODES.get(key)
+        if code is None:
+            extra[key] = value
+            continue
+        if key == 'history':
+            value = [_pack_message(message) for message in value]
+        elif key == 'sentiment_ema' and isinstance(value, float):
+            value = round(value, 4)  # Full float precision is meaningless for theming
+        packed[code] = value
+    if extra:
+        packed[EXTRA_KEY] = extra
+    return packed
+
+
+def unpack_session(packed: Dict[str, Any]) -> Dict[str, Any]:
+    """Inverse of pack_session"""
+    data = dict(packed.get(EXTRA_KEY, {}))
+    for code, value in packed.items():
+        key = KEY_NAMES.get(code)
+        if key is None:
+            continue
+        if key == 'history':
+            value = [_unpack_message(message) for message in value]
+        data[key] = value
+    return data
+
+
+def compress(raw: bytes, codec: str = 'zlib') -> bytes:
+    """Compress with the requested codec, falling back to raw bytes when that is smaller"""
+    if codec == 'zstd' and zstandard is not None:
+        candidate = CODEC_ZSTD + zstandard.ZstdCompressor(level=19).compress(raw)
+    else:
+        candidate = CODEC_ZLIB + zlib.compress(raw, 9)
+    return candidate if len(candidate) < len(raw) + 1 else CODEC_RAW + raw
+
+
+def decompress(payload: bytes) -> bytes:
+    codec, body = payload[:1], payload[1:]
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(body)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Session was compressed with zstd but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(body)
+    if codec == CODEC_RAW:
+        return body
+    raise ValueError(f"Unknown session codec {codec!r}")
+
+
+def encode_session(data: Dict[str, Any], codec: str = 'zlib') -> bytes:
+    """Serialize, compress and base64 encode session data (unsigned)"""
+    # Unlike Flask's serializer, keep non-ASCII text as UTF-8 rather than \uXXXX escapes
+    raw = json.dumps(_tagger.tag(pack_session(data)), separators=(',', ':'), ensure_ascii=False)
+    return base64_encode(compress(raw.encode('utf-8'), codec))
+
+
+def decode_session(value: bytes) -> Dict[str, Any]:
+    """Inverse of encode_session"""
+    return unpack_session(_tagger.loads(decompress(base64_decode(value)).decode('utf-8')))
+
+
+def split_value(value: str, chunk_size: int = COOKIE_CHUNK_SIZE) -> List[str]:
+    return [value[i:i + chunk_size] for i in range(0, len(value), chunk_size)] or ['']
+
+
+class CompactCookieSessionInterface(SessionInterface):
+    """Cookie session interface using the compact, compressed, multi-cookie encoding"""
+
+    salt = 'fivestep-compact-session'
+
+    def __init__(self, codec: str = 'zlib', max_cookies: int = 2):
+        """
+        Args:
+            codec: 'zlib' or 'zstd' (zstd needs the optional zstandard package)
+            max_cookies: Most cookies a session may be split across
+        """
+        if codec == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed, compressing sessions with zlib")
+            codec = 'zlib'
+        self.codec = codec
+        self.max_cookies = max_cookies
+
+    def _signer(self, app):
+        return TimestampSigner(app.secret_key, salt=self.salt)
+
+    def _chunk_name(self, app, index: int) -> str:
+        name = self.get_cookie_name(app)
+        return name if index == 0 else f"{name}.{index}"
+
+    def open_session(self, app, request):
+        session = SecureCookieSession()
+        session.cookie_count = 0
+
+        head = request.cookies.get(self.get_cookie_name(app))
+        if not head:
+            return session
+
+        count_text, _, first = head.partition(':')
+        count = int(count_text) if count_text.isdigit() else 0
+        # The count is unsigned; never let it drive more lookups or deletions than we'd ever set
+        if count < 1 or count > self.max_cookies:
+            return session
+        session.cookie_count = count
+        parts = [first] + [request.cookies.get(self._chunk_name(app, i)) for i in range(1, count)]
+        if any(part is None for part in parts):
+            return session
+
+        try:
+            max_age = int(app.permanent_session_lifetime.total_seconds())
+            data = decode_session(self._signer(app).unsign(''.join(parts), max_age=max_age))
+        except (BadSignature, ValueError, KeyError, IndexError, zlib.error):
+            return session
+
+        session = SecureCookieSession(data)
+        session.cookie_count = count
+        return session
+
+    def serialize(self, app, data: Dict[str, Any]) -> List[str]:
+        """
+        Sign and split session data into cookie values. If the session would need more than
+        max_cookies cookies, the oldest history messages are dropped until it fits.
+        """
+        signer = self._signer(app)
+        history = list(data.get('history', []))
+        while True:
+            chunks = split_value(signer.sign(encode_session(data, self.codec)).decode('ascii'))
+            if len(chunks) <= self.max_cookies or len(history) <= 2:
+                return chunks
+            logger.warning("Compact session exceeds cookie budget, dropping oldest history")
+            history = history[2:]
+            data = dict(data, history=history)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        previous_count = min(getattr(session, 'cookie_count', 0), self.max_cookies)
+
+        if not session:
+            if session.modified:
+                for index in range(max(previous_count, 1)):
+                    response.delete_cookie(self._chunk_name(app, index), domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not self.should_set_cookie(app, session):
+            return
+
+        chunks = self.serialize(app, dict(session))
+        chunks[0] = f"{len(chunks)}:{chunks[0]}"
+        for index, chunk in enumerate(chunks):
+            response.set_cookie(
+                self._chunk_name(app, index),
+                chunk,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+        # Remove leftover chunks from a previously larger session
+        for index in range(len(chunks), previous_count):
+            response.delete_cookie(self._chunk_name(app, index), domain=domain, path=path)
@@ -0,0 +1,197 @@
+"""
+Hedged requests for step calls.
+
+When a step call has not answered within the recent latency percentile, a Hedger sends a
+duplicate request (optionally to a faster fallback model), keeps whichever answers first
+and cancels the other. Attempts stream internally so a cancelled attempt can be closed as
+soon as its next chunk arrives, rather than being billed for a full reply nobody reads.
+
+Hedges are capped at a fraction of all hedged-path requests so a slow API is not hit with
+twice the traffic. Only non-streamed turns are hedged: once text has reached the user,
+switching to another reply is not possible.
+"""
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Optional
+
+from utils import create_message_text, create_message_text_async
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeCancelled(Exception):
+    """Raised inside an attempt that lost the race"""
+
+
+class LatencyTracker:
+    """Recent call latencies per label, for percentile-based hedge delays"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, label: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(label, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, label: str, percentile: float, min_samples: int) -> Optional[float]:
+        """The latency percentile for a label, or None with fewer than min_samples samples"""
+        with self._lock:
+            samples = sorted(self._samples.get(label, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(int(len(samples) * percentile / 100), len(samples) - 1)
+        return samples[index]
+
+
+class Hedger:
+    """Runs step calls with a delayed duplicate request and first-success-wins semantics"""
+
+    def __init__(self, percentile: float = 95, budget: float = 0.1, fallback_model: Optional[str] = None,
+                 default_delay: float = 10.0, min_samples: int = 20, max_workers: int = 64):
+        """
+        Args:
+            percentile: Latency percentile after which the hedge is sent
+            budget: Largest fraction of requests that may be hedged
+            fallback_model: Model for the hedge request (None uses the primary's model)
+            default_delay: Hedge delay in seconds until min_samples latencies are known
+            min_samples: Latencies needed per step before the percentile is used
+            max_workers: Threads for sync attempts (each sync call uses up to two)
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.fallback_model = fallback_model
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.latency = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fivestep-hedge')
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.over_budget = 0
+
+    def delay(self, label: str) -> float:
+        observed = self.latency.percentile(label, self.percentile, self.min_samples)
+        return self.default_delay if observed is None else observed
+
+    def _hedge_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.fallback_model:
+            return dict(request, model=self.fallback_model)
+        return request
+
+    def _claim_hedge(self) -> bool:
+        """Count a hedge if the budget allows one"""
+        with self._lock:
+            if self.hedged + 1 > self.budget * self.requests:
+                self.over_budget += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def create_message_text(self, client, usage_label: str, prompt_version: Optional[str] = None,
+                            stage: Optional[str] = None, **request: Any) -> str:
+        """
+        Hedged version of utils.create_message_text (without on_text).
+
+        Args:
+            client: Anthropic client
+            usage_label: Usage label, also the key for latency tracking
+            prompt_version: Prompt hash logged alongside the usage
+            stage: Coaching stage the usage metrics are labelled with
+            **request: Arguments for client.messages.create
+
+        Returns:
+            Text of the first successful reply
+
+        Raises:
+            The primary attempt's error, if every attempt failed
+        """
+        self._count('requests')
+        start_time = time.monotonic()
+        cancelled = {'primary': threading.Event(), 'hedge': threading.Event()}
+
+        def attempt(name, attempt_request):
+            def check(_text):
+                if cancelled[name].is_set():
+                    raise HedgeCancelled()
+            return create_message_text(client, check, usage_label=usage_label,
+                                       prompt_version=prompt_version, stage=stage, **attempt_request)
+
+        futures = {self._executor.submit(attempt, 'primary', request): 'primary'}
+        done, _ = wait(futures, timeout=self.delay(usage_label))
+        if not done and self._claim_hedge():
+            logger.info(f"Hedging {usage_label} after {time.monotonic() - start_time:.1f}s")
+            futures[self._executor.submit(attempt, 'hedge', self._hedge_request(request))] = 'hedge'
+
+        errors = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                    continue
+                for other in cancelled:
+                    if other != name:
+                        cancelled[other].set()
+                if len(futures) > 1:
+                    self._count('hedge_wins' if name == 'hedge' else 'primary_wins')
+                self.latency.record(usage_label, time.monotonic() - start_time)
+                return future.result()
+        raise errors.get('primary') or errors['hedge']
+
+    async def create_message_text_async(self, client, usage_label: str, prompt_version: Optional[str] = None,
+                                        stage: Optional[str] = None, **request: Any) -> str:
+        """Same as create_message_text, for anthropic.AsyncAnthropic; losers are cancelled outright"""
+        self._count('requests')
+        start_time = time.monotonic()
+        tasks = {asyncio.ensure_future(create_message_text_async(
+            client, usage_label=usage_label, prompt_version=prompt_version, stage=stage, **request)): 'primary'}
+        done, _ = await asyncio.wait(tasks, timeout=self.delay(usage_label))
+        if not done and self._claim_hedge():
+            logger.info(f"Hedging {usage_label} after {time.monotonic() - start_time:.1f}s")
+            tasks[asyncio.ensure_future(create_message_text_async(
+                client, usage_label=usage_label, prompt_version=prompt_version, stage=stage,
+                **self._hedge_request(request)))] = 'hedge'
+
+        errors = {}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = tasks[task]
+                    if task.exception() is not None:
+                        errors[name] = task.exception()
+                        continue
+                    if len(tasks) > 1:
+                        self._count('hedge_wins' if name == 'hedge' else 'primary_wins')
+                    self.latency.record(usage_label, time.monotonic() - start_time)
+                    return task.result()
+            raise errors.get('primary') or errors['hedge']
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'primary_wins': self.primary_wins,
+                'over_budget': self.over_budget,
+                'hedge_rate': round(self.hedged / self.requests, 3) if self.requests else 0.0,
+            }
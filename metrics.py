@@ -0,0 +1,284 @@
+"""
+In-process metrics with Prometheus text exposition.
+
+Histograms and counters are kept per label set behind one lock each; an observation is a
+bisect into the bucket bounds and a few additions, cheap enough to leave on in production.
+Components that already keep their own counters (circuit breaker, rate limiter, hedger, model
+router, async queue) are not instrumented twice: collectors registered with the registry read
+their snapshots when /metrics is scraped.
+
+Metrics are per process. With several gunicorn or uvicorn workers, each worker reports its own
+and Prometheus sums them.
+"""
+import time
+import bisect
+import threading
+import contextlib
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import METRICS_ENABLED
+
+# Seconds; covers sub-millisecond local work up to long Sonnet replies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# A collector returns (name, type, help, [(labels, value), ...]) families
+Family = Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, Dict[str, Any], float]]:
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, dict(zip(self.label_names, key)), value) for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Observe the wall time of the with block, also when it raises"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self) -> List[Tuple[str, Dict[str, Any], float]]:
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(float(bound))), cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class _NullMetric:
+    """Stands in for a metric while metrics are disabled"""
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        pass
+
+    def observe(self, value: float, **labels: Any) -> None:
+        pass
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        yield
+
+
+class MetricsRegistry:
+    """Holds metrics and collectors and renders them in the Prometheus text format"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def counter(self, name: str, help_text: str, label_names: Iterable[str] = ()):
+        if not self.enabled:
+            return _NullMetric()
+        return self._metrics.setdefault(name, Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS):
+        if not self.enabled:
+            return _NullMetric()
+        return self._metrics.setdefault(name, Histogram(name, help_text, label_names, buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[Family]]) -> None:
+        """
+        Add a function called on every scrape.
+
+        Args:
+            collector: Returns (name, type, help, [(labels, value), ...]) metric families
+        """
+        if self.enabled:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for collector in self._collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(enabled=METRICS_ENABLED)
+
+# Wall time of each part of a turn: the whole request, sentiment scoring and waiting for it,
+# the step call (including retries) and applying the result to the session
+phase_seconds = registry.histogram(
+    "fivestep_phase_seconds", "Wall time per phase of a chat turn", ("phase", "step", "stage"))
+# Every Messages API call
+api_request_seconds = registry.histogram(
+    "fivestep_api_request_seconds", "Messages API call latency", ("call", "stage", "model"))
+tokens = registry.counter(
+    "fivestep_tokens_total", "Tokens used by Messages API calls (kind: input, output, cache_read, cache_write)",
+    ("call", "stage", "model", "kind"))
+api_retries = registry.counter(
+    "fivestep_api_retries_total", "Messages API calls retried after a transient error", ("error",))
+# Structured turns whose reply had no valid step_reply call (fallback: text, retry)
+structured_reply_failures = registry.counter(
+    "fivestep_structured_reply_failures_total", "Structured step replies without a valid step_reply call",
+    ("step", "fallback"))
+
+
+def observe_api_call(call: str, usage: Any, duration: float, model: Optional[str] = None,
+                     stage: Optional[str] = None) -> None:
+    """
+    Record one Messages API call's latency and token usage.
+
+    Args:
+        call: Call site (e.g. "step2" or "sentiment")
+        usage: The usage object from the API response
+        duration: Wall time of the request in seconds
+        model: Model the request was sent to
+        stage: Coaching stage, for steps that have stages
+    """
+    labels = {"call": call, "stage": stage or "", "model": model or ""}
+    api_request_seconds.observe(duration, **labels)
+    for kind, attribute in (("input", "input_tokens"), ("output", "output_tokens"),
+                            ("cache_read", "cache_read_input_tokens"),
+                            ("cache_write", "cache_creation_input_tokens")):
+        count = getattr(usage, attribute, 0) or 0
+        if count:
+            tokens.inc(count, kind=kind, **labels)
+
+
+def snapshot_collector(prefix: str, snapshot: Callable[[], Optional[Dict[str, Any]]],
+                       help_text: str, counters: Iterable[str] = (),
+                       states: Optional[Dict[str, Iterable[str]]] = None) -> Callable[[], List[Family]]:
+    """
+    Collector exposing the numeric fields of a component's snapshot() as gauges.
+
+    Args:
+        prefix: Metric name prefix, e.g. "fivestep_rate_limiter"
+        snapshot: Returns a flat dict (None when the component is off)
+        help_text: Help text, suffixed with the field name
+        counters: Fields that only ever increase, exposed as counters
+        states: Fields holding a state name, mapped to their possible values; exposed as one
+                gauge per value that is 1 for the current state
+
+    Returns:
+        Collector for MetricsRegistry.register_collector
+    """
+    counters = set(counters)
+    states = states or {}
+
+    def collect() -> List[Family]:
+        values = snapshot()
+        if values is None:
+            return []
+        families = []
+        for field, value in values.items():
+            if field in states:
+                families.append((f"{prefix}_{field}", "gauge", f"{help_text} {field}",
+                                 [({field: option}, int(value == option)) for option in states[field]]))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric_type = "counter" if field in counters else "gauge"
+                name = f"{prefix}_{field}_total" if field in counters else f"{prefix}_{field}"
+                families.append((name, metric_type, f"{help_text} {field}", [({}, value)]))
+        return families
+
+    return collect
+
+
+def keyed_collector(prefix: str, snapshot: Callable[[], Dict[str, Dict[str, Any]]], label: str,
+                    help_text: str, fields: Dict[str, Tuple[str, str]]) -> Callable[[], List[Family]]:
+    """
+    Collector for snapshots keyed by name (e.g. per-route stats), one labelled series per key.
+
+    Args:
+        prefix: Metric name prefix
+        snapshot: Returns {key: {field: value}}
+        label: Label name for the key
+        help_text: Help text, suffixed with the field name
+        fields: Field name -> (metric name suffix, "counter" or "gauge")
+
+    Returns:
+        Collector for MetricsRegistry.register_collector
+    """
+    def collect() -> List[Family]:
+        values = snapshot()
+        families = []
+        for field, (suffix, metric_type) in fields.items():
+            name = f"{prefix}_{suffix}"
+            samples = [({label: key}, stats[field]) for key, stats in sorted(values.items()) if field in stats]
+            if samples:
+                families.append((name, metric_type, f"{help_text} {field}", samples))
+        return families
+
+    return collect
@@ -0,0 +1,140 @@
+"""
+Speculative prefetch of the next step's opening turn.
+
+When a turn completes a step, the next step's first reply is generated in the background as
+if the user had answered with a simple continuation ("Yes, let's continue."), using the
+updated history and goal, so the new step starts in its opening stage (e.g. step 2's
+initial_question). The pending reply is kept per session in this process. If the user's next
+message is a simple continuation ("ok", "sure, let's go") and the session hasn't changed
+since, that turn is answered with the prefetched reply instead of a new API call.
+
+Any other message, a changed session (/set_step, /reset, another tab) or an expired entry
+discards the prefetch. A discarded call that is still queued is cancelled; one already sent
+is left to finish and its reply dropped, so every miss costs one step call's tokens.
+
+The cache is per process: with several workers, a session's next request may land on a
+worker that holds no prefetch for it.
+"""
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional
+
+# Whole messages that only acknowledge and move on, possibly several chained ("ok, thanks! let's go")
+_CONTINUATION_PATTERN = re.compile(
+    r"(?:(?:ok(?:ay)?|k|yes|yeah|yep|yup|sure|great|cool|perfect|alright|all right|got it|sounds good|"
+    r"thanks|thank you|ready|i'?m ready|definitely|absolutely|please|go ahead|go on|continue|next|"
+    r"move on|keep going|let'?s (?:go|do it|do this|continue|move on|keep going|get started|start))"
+    r"(?![\w'])[\s,.!]*)+"
+)
+# Longer messages say something the prefetched reply can't have taken into account
+MAX_CONTINUATION_LENGTH = 60
+
+
+def is_continuation(user_input: str) -> bool:
+    """Whether a message only acknowledges the previous reply and asks to go on"""
+    text = user_input.strip().lower().replace("’", "'")
+    return 0 < len(text) <= MAX_CONTINUATION_LENGTH and _CONTINUATION_PATTERN.fullmatch(text) is not None
+
+
+class _Entry(NamedTuple):
+    fingerprint: Hashable
+    future: Future
+    created: float
+
+
+class StepPrefetcher:
+    """Per-session cache of speculatively generated opening turns, with hit and miss counts"""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 600.0):
+        """
+        Args:
+            max_entries: Sessions with a pending prefetch; the oldest is dropped past this
+            ttl: Seconds a prefetched reply stays usable
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.failed = 0
+
+    def start(self, session_key: str, fingerprint: Hashable, submit: Callable[[], Future]) -> None:
+        """
+        Start a prefetch for a session, replacing any earlier one.
+
+        Args:
+            session_key: Stable id of the session
+            fingerprint: Session state the prefetch was made for; claim() must see the same
+            submit: Starts the step call and returns its future
+        """
+        future = submit()
+        with self._lock:
+            previous = self._entries.pop(session_key, None)
+            self._entries[session_key] = _Entry(fingerprint, future, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                evicted.cancel()
+            self.started += 1
+        if previous is not None:
+            previous.future.cancel()
+
+    def claim(self, session_key: str, fingerprint: Hashable, user_input: str) -> Optional[Future]:
+        """
+        Take a session's prefetch for this turn, if it can answer it.
+
+        Args:
+            session_key: Stable id of the session
+            fingerprint: The session state now
+            user_input: The user's message
+
+        Returns:
+            Future for the prefetched step result, or None; the entry is removed either way.
+            Report what became of a returned future with record_hit or record_failure.
+        """
+        with self._lock:
+            entry = self._entries.pop(session_key, None)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl:
+                self.expired += 1
+            elif entry.fingerprint != fingerprint:
+                self.stale += 1
+            elif not is_continuation(user_input):
+                self.misses += 1
+            elif entry.future.done() and (entry.future.cancelled() or entry.future.exception() is not None):
+                self.failed += 1
+            else:
+                return entry.future
+        entry.future.cancel()
+        return None
+
+    def record_hit(self) -> None:
+        """Count a claimed prefetch whose reply was served"""
+        with self._lock:
+            self.hits += 1
+
+    def record_failure(self) -> None:
+        """Count a claimed prefetch that failed or didn't finish in time; the turn falls back to a normal call"""
+        with self._lock:
+            self.failed += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            claimed = self.hits + self.misses + self.stale + self.expired + self.failed
+            return {
+                'pending': len(self._entries),
+                'started': self.started,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'expired': self.expired,
+                'failed': self.failed,
+                'hit_rate': round(self.hits / claimed, 3) if claimed else 0.0,
+            }
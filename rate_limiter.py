@@ -0,0 +1,331 @@
+"""
+Adaptive client-side rate limiting for Anthropic Messages API calls.
+
+One AdaptiveRateLimiter per process keeps a token bucket for each rate limit the API reports
+in its anthropic-ratelimit-* response headers (requests, input tokens and output tokens per
+minute). Each bucket's size and remaining capacity follow the headers of every response, so
+other workers' use is accounted for too. On top of that the refill rate is scaled AIMD-style:
+every successful response adds a little back, every 429 halves it and pauses admissions for
+the server's retry-after.
+
+Callers acquire capacity before sending a request. Requests that do not fit wait in a queue
+ordered by priority, then arrival, so coaching turns (PRIORITY_COACHING) always go ahead of
+sentiment scoring (PRIORITY_SENTIMENT). Until the first headers arrive, nothing is limited.
+"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_COACHING = 0
+PRIORITY_SENTIMENT = 1
+
+# Anthropic limits are per minute and replenish continuously
+LIMIT_WINDOW_SECONDS = 60.0
+
+# Bucket name -> header prefix
+RATE_LIMIT_HEADERS = {
+    'requests': 'anthropic-ratelimit-requests',
+    'input_tokens': 'anthropic-ratelimit-input-tokens',
+    'output_tokens': 'anthropic-ratelimit-output-tokens',
+}
+
+# How often async waiters re-check their place in the queue
+ASYNC_POLL_SECONDS = 0.05
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request could not be admitted within its maximum wait"""
+
+
+def estimate_request_tokens(request: Dict[str, Any]) -> int:
+    """
+    Rough input-token count of a Messages API request (about 4 characters per token).
+
+    Args:
+        request: Arguments for client.messages.create
+
+    Returns:
+        Estimated input tokens
+    """
+    def text_length(content) -> int:
+        if isinstance(content, str):
+            return len(content)
+        if isinstance(content, list):
+            return sum(len(block.get('text', '')) for block in content if isinstance(block, dict))
+        return 0
+
+    characters = text_length(request.get('system', ''))
+    characters += sum(text_length(message.get('content', '')) for message in request.get('messages', []))
+    return characters // 4 + 1
+
+
+class TokenBucket:
+    """Continuously refilling bucket; unlimited until a capacity is known"""
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float, scale: float) -> None:
+        if self.capacity is not None:
+            rate = self.capacity / LIMIT_WINDOW_SECONDS * scale
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, scale: float) -> float:
+        """Seconds until amount is available (amounts above capacity wait for a full bucket)"""
+        if self.capacity is None:
+            return 0.0
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / (self.capacity / LIMIT_WINDOW_SECONDS * scale)
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.tokens -= min(amount, self.capacity)
+
+    def give(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def sync(self, limit: float, remaining: float) -> None:
+        """Adopt the server's view: its limit, and never more remaining than it reports"""
+        if self.capacity is None:
+            self.tokens = remaining
+        self.capacity = limit
+        self.tokens = min(self.tokens, remaining, limit)
+
+
+class Reservation:
+    """
+    Capacity taken for one request; settle it with the reply's usage to refund the rest, or
+    release it if the request failed
+    """
+
+    def __init__(self, limiter: 'AdaptiveRateLimiter', output_tokens: int):
+        self.limiter = limiter
+        self.output_tokens = output_tokens
+
+    def settle(self, usage=None) -> None:
+        """
+        Return reserved output tokens the reply did not use.
+
+        Args:
+            usage: The reply's usage (anything with output_tokens); None refunds nothing
+        """
+        used = getattr(usage, 'output_tokens', None)
+        if used is not None and used < self.output_tokens:
+            self.limiter.refund(output_tokens=self.output_tokens - used)
+        self.output_tokens = 0
+
+    def release(self) -> None:
+        """Return all reserved output tokens (no-op once settled); for requests that failed"""
+        if self.output_tokens:
+            self.limiter.refund(output_tokens=self.output_tokens)
+        self.output_tokens = 0
+
+
+class AdaptiveRateLimiter:
+    """Priority-queued token buckets fed by anthropic-ratelimit-* headers, scaled AIMD-style"""
+
+    def __init__(self, increase: float = 0.05, decrease: float = 0.5, min_scale: float = 0.1):
+        """
+        Args:
+            increase: Added to the rate scale after each successful response
+            decrease: Factor applied to the rate scale after each 429
+            min_scale: Lowest rate scale
+        """
+        self.increase = increase
+        self.decrease = decrease
+        self.min_scale = min_scale
+        self.scale = 1.0
+        self.buckets = {name: TokenBucket() for name in RATE_LIMIT_HEADERS}
+        self._cond = threading.Condition()
+        self._waiters: List[tuple] = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self.admitted = 0
+        self.delayed = 0
+        self.timed_out = 0
+        self.rate_limited = 0
+
+    # Feedback from responses
+
+    def observe_response(self, response) -> None:
+        """
+        httpx response hook: sync the buckets from Messages API rate-limit headers and adapt
+        the rate scale to successes and 429s.
+        """
+        if not response.request.url.path.endswith('/v1/messages'):
+            return
+        headers = response.headers
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            for name, prefix in RATE_LIMIT_HEADERS.items():
+                limit = headers.get(f'{prefix}-limit')
+                remaining = headers.get(f'{prefix}-remaining')
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    self.buckets[name].sync(float(limit), float(remaining))
+                except ValueError:
+                    continue
+
+            if response.status_code == 429:
+                self.rate_limited += 1
+                self.scale = max(self.min_scale, self.scale * self.decrease)
+                try:
+                    pause = float(headers.get('retry-after', 1))
+                except ValueError:
+                    pause = 1.0
+                self._paused_until = max(self._paused_until, now + pause)
+                logger.warning(f"Rate limited by the API; rate scale now {self.scale:.2f}, "
+                               f"pausing admissions for {pause:.1f}s")
+            elif response.status_code < 400:
+                self.scale = min(1.0, self.scale + self.increase)
+            self._cond.notify_all()
+
+    async def observe_response_async(self, response) -> None:
+        """observe_response for httpx.AsyncClient event hooks"""
+        self.observe_response(response)
+
+    def refund(self, output_tokens: int = 0) -> None:
+        with self._cond:
+            self.buckets['output_tokens'].give(output_tokens)
+            self._cond.notify_all()
+
+    # Admission
+
+    def _refill(self, now: float) -> None:
+        for bucket in self.buckets.values():
+            bucket.refill(now, self.scale)
+
+    def _try_admit(self, ticket: tuple, amounts: Dict[str, float]) -> float:
+        """Admit the ticket if it is first in line and fits; returns 0 if admitted, else seconds to wait"""
+        now = time.monotonic()
+        self._refill(now)
+        if self._waiters[0] is not ticket:
+            return ASYNC_POLL_SECONDS
+        wait = max([self._paused_until - now] +
+                   [self.buckets[name].wait_time(amount, self.scale) for name, amount in amounts.items()])
+        if wait > 0:
+            return wait
+        for name, amount in amounts.items():
+            self.buckets[name].take(amount)
+        heapq.heappop(self._waiters)
+        self.admitted += 1
+        return 0.0
+
+    def _enqueue(self, priority: int) -> tuple:
+        ticket = (priority, next(self._sequence))
+        heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _abandon(self, ticket: tuple) -> None:
+        if ticket in self._waiters:
+            self._waiters.remove(ticket)
+            heapq.heapify(self._waiters)
+        self._cond.notify_all()
+
+    def acquire(self, priority: int, input_tokens: int, output_tokens: int,
+                timeout: Optional[float] = None) -> Reservation:
+        """
+        Wait until a request fits within the rate limits, then take its capacity.
+
+        Args:
+            priority: PRIORITY_COACHING or PRIORITY_SENTIMENT (lower goes first)
+            input_tokens: Estimated input tokens of the request
+            output_tokens: max_tokens of the request, refunded on settle
+            timeout: Longest wait in seconds (None waits indefinitely)
+
+        Returns:
+            Reservation to settle with the reply's usage
+
+        Raises:
+            RateLimitTimeout: If the request could not be admitted in time
+        """
+        amounts = {'requests': 1, 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._enqueue(priority)
+            waited = False
+            try:
+                while True:
+                    wait = self._try_admit(ticket, amounts)
+                    if wait == 0:
+                        self.delayed += waited
+                        self._cond.notify_all()
+                        return Reservation(self, output_tokens)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timed_out += 1
+                            raise RateLimitTimeout(f"No rate-limit capacity within {timeout:.1f}s")
+                        wait = min(wait, remaining)
+                    waited = True
+                    self._cond.wait(wait)
+            except BaseException:
+                self._abandon(ticket)
+                raise
+
+    async def acquire_async(self, priority: int, input_tokens: int, output_tokens: int,
+                            timeout: Optional[float] = None) -> Reservation:
+        """Same as acquire, waiting on the event loop instead of blocking the thread"""
+        amounts = {'requests': 1, 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._enqueue(priority)
+        waited = False
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(ticket, amounts)
+                    if wait == 0:
+                        self.delayed += waited
+                        self._cond.notify_all()
+                        return Reservation(self, output_tokens)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise RateLimitTimeout(f"No rate-limit capacity within {timeout:.1f}s")
+                    wait = min(wait, remaining)
+                waited = True
+                # Sync admissions don't wake the event loop, so re-check at least this often
+                await asyncio.sleep(min(wait, ASYNC_POLL_SECONDS))
+        except BaseException:
+            with self._cond:
+                self._abandon(ticket)
+            raise
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'scale': round(self.scale, 3),
+                'waiting': len(self._waiters),
+                'admitted': self.admitted,
+                'delayed': self.delayed,
+                'timed_out': self.timed_out,
+                'rate_limited': self.rate_limited,
+                'buckets': {
+                    name: None if bucket.capacity is None else {
+                        'capacity': bucket.capacity,
+                        'available': round(bucket.tokens, 1),
+                    }
+                    for name, bucket in self.buckets.items()
+                },
+            }
+
+
+# Shared by every API call in the process
+rate_limiter = AdaptiveRateLimiter()
@@ -0,0 +1,302 @@
+"""
+Retry policy and circuit breaker for Anthropic API calls.
+
+RetryPolicy retries only errors that can succeed on a later attempt (rate limits, overload,
+5xx, timeouts, connection failures), waits for the server's retry-after when one is sent and
+full-jitter exponential backoff otherwise, and never lets a call's retries run past a total
+deadline. Every attempt is reported to a CircuitBreaker shared by the process: after a run of
+consecutive outage errors (5xx, 529 overload, timeouts, connection failures) the breaker opens
+and calls fail immediately with CircuitOpenError until a single trial call succeeds, so an
+outage does not tie up request threads sleeping between retries. Rate limits (429) are counted
+but never open the circuit; the rate limiter slows traffic down for those.
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+import email.utils
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import anthropic
+
+from metrics import api_retries
+from config import (MAX_RETRIES, RETRY_DELAY, RETRY_MAX_DELAY, RETRY_DEADLINE,
+                    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: timeout, conflict, rate limit and server-side failures (529 is overload)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Anthropic API circuit open after repeated failures; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an API error is transient, i.e. the same request could succeed later"""
+    if isinstance(error, (anthropic.APITimeoutError, anthropic.APIConnectionError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def is_outage(error: Exception) -> bool:
+    """Whether a transient error means the API is unavailable, rather than that we sent too much"""
+    if isinstance(error, (anthropic.APITimeoutError, anthropic.APIConnectionError)):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and error.status_code >= 500
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds the server asked us to wait before retrying.
+
+    Args:
+        error: Exception raised by an API call
+
+    Returns:
+        The retry-after-ms or retry-after header value in seconds, or None if there is none
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    # retry-after may also be an HTTP date
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    closed    - calls go through; failure_threshold outage errors in a row open the circuit
+    open      - calls fail with CircuitOpenError until reset_timeout has passed
+    half-open - one trial call goes through; success closes the circuit, failure reopens it
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        """
+        Args:
+            failure_threshold: Consecutive outage errors that open the circuit
+            reset_timeout: Seconds to fail fast before allowing a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.rejected += 1
+            remaining = self.reset_timeout - (now - self._opened_at)
+            raise CircuitOpenError(max(remaining, 1.0))
+
+    def record_success(self) -> None:
+        """The API answered (including with a non-retryable error such as a bad request)"""
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Anthropic API circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """The API failed with an outage error (5xx, overload, timeout, connection failure)"""
+        with self._lock:
+            self._failures += 1
+            reopen = self._trial_in_flight
+            self._trial_in_flight = False
+            if reopen or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.error(f"Anthropic API circuit opened after {self._failures} consecutive failures")
+
+    def record_rate_limited(self) -> None:
+        """The API is up but refused the call for our rate (429 and the like); doesn't count as a failure"""
+        with self._lock:
+            self.rate_limited += 1
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """A call ended without reaching the API (e.g. cancelled); let another trial through"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self._state(time.monotonic()),
+                'consecutive_failures': self._failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'rate_limited': self.rate_limited,
+            }
+
+
+class RetryPolicy:
+    """Retries transient API errors within a deadline, reporting every attempt to a breaker"""
+
+    def __init__(self, max_retries: int = MAX_RETRIES, base_delay: float = RETRY_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, deadline: float = RETRY_DEADLINE,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            max_retries: Retries after the first attempt
+            base_delay: Backoff ceiling for the first retry, doubling on each retry
+            max_delay: Longest single wait between attempts
+            deadline: Seconds from the first attempt after which no retry is started
+            breaker: Circuit breaker to consult and update (none by default)
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Seconds to wait before retry number attempt + 1 (full jitter unless the server said)"""
+        server_delay = retry_after(error)
+        if server_delay is not None:
+            return server_delay
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _next_delay(self, attempt: int, error: Exception, start_time: float,
+                    retry_if: Optional[Callable[[Exception], bool]]) -> Optional[float]:
+        """Record a failed attempt and return the wait before retrying, or None to give up"""
+        if not is_retryable(error):
+            # The API answered; retrying the same request cannot help
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return None
+        if self.breaker is not None and not is_outage(error):
+            self.breaker.record_rate_limited()
+        elif self.breaker is not None:
+            self.breaker.record_failure()
+            if self.breaker.state != 'closed':
+                # This failure opened the circuit; the retry would be rejected anyway
+                return None
+        if attempt >= self.max_retries or (retry_if is not None and not retry_if(error)):
+            return None
+
+        delay = self.backoff(attempt, error)
+        if delay > self.max_delay or time.monotonic() - start_time + delay > self.deadline:
+            logger.warning(f"Not retrying {type(error).__name__}: a {delay:.1f}s wait is past "
+                           f"the retry limits")
+            return None
+        logger.warning(f"Retrying after {type(error).__name__} in {delay:.1f}s "
+                       f"(retry {attempt + 1} of {self.max_retries})")
+        api_retries.inc(error=type(error).__name__)
+        return delay
+
+    def call(self, func: Callable[[], Any], retry_if: Optional[Callable[[Exception], bool]] = None) -> Any:
+        """
+        Call func, retrying transient API errors.
+
+        Args:
+            func: Function making one API call
+            retry_if: Optional check; a retryable error is re-raised at once when it returns False
+
+        Returns:
+            func's result
+
+        Raises:
+            CircuitOpenError: If the breaker is open
+            anthropic.APIError: The last error, once retrying stops
+        """
+        start_time = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = func()
+            except anthropic.APIError as e:
+                delay = self._next_delay(attempt, e, start_time, retry_if)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            except BaseException:
+                if self.breaker is not None:
+                    self.breaker.release_trial()
+                raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+    async def call_async(self, func: Callable[[], Awaitable],
+                         retry_if: Optional[Callable[[Exception], bool]] = None) -> Any:
+        """Same as call, for a coroutine function; waits without blocking the event loop"""
+        start_time = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = await func()
+            except anthropic.APIError as e:
+                delay = self._next_delay(attempt, e, start_time, retry_if)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            except BaseException:
+                if self.breaker is not None:
+                    self.breaker.release_trial()
+                raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+
+# Shared by every API call in the process, so one outage trips it for all requests
+circuit_breaker = CircuitBreaker()
@@ -0,0 +1,109 @@
+"""
+Model routing for API calls.
+
+MODEL_ROUTES in config maps (call type, step, coaching stage) to a model and max_tokens, so
+short clarifying turns and scoring can go to a fast, cheap model and diagnosis and planning
+turns to a larger one. A route matches on the fields it names; when several match, the most
+specific wins (later routes win ties). Calls no route matches keep their own defaults.
+
+Every routed call's model and latency are logged and accumulated per route, so cost can be
+tuned against speed.
+"""
+import logging
+import threading
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+from config import MODEL_ROUTES, MODEL_ROUTING
+
+logger = logging.getLogger(__name__)
+
+CALL_TYPES = ('step', 'sentiment')
+MATCH_FIELDS = ('call', 'step', 'stage')
+
+
+class Route(NamedTuple):
+    """Where a call goes"""
+    name: str
+    model: str
+    max_tokens: int
+
+
+def route_name(rule: Dict[str, Any]) -> str:
+    """Default name of a route, e.g. 'step2/initial_question' or 'sentiment'"""
+    if rule.get('name'):
+        return rule['name']
+    name = rule['call'] if rule.get('step') is None else f"{rule['call']}{rule['step']}"
+    return name if rule.get('stage') is None else f"{name}/{rule['stage']}"
+
+
+class ModelRouter:
+    """Resolves calls to routes and keeps per-route latency"""
+
+    def __init__(self, routes: Iterable[Dict[str, Any]]):
+        """
+        Args:
+            routes: Dicts with 'call' ('step' or 'sentiment'), optional 'step', 'stage' and
+                    'name', and the 'model' and 'max_tokens' to use
+
+        Raises:
+            ValueError: If a route is malformed
+        """
+        self.routes = []
+        for index, rule in enumerate(routes):
+            unknown = set(rule) - set(MATCH_FIELDS) - {'name', 'model', 'max_tokens'}
+            if rule.get('call') not in CALL_TYPES or unknown:
+                raise ValueError(f"Invalid model route {index}: {rule}")
+            if not rule.get('model') or not isinstance(rule.get('max_tokens'), int) or rule['max_tokens'] < 1:
+                raise ValueError(f"Model route {index} needs a model and a positive max_tokens: {rule}")
+            specificity = sum(rule.get(field) is not None for field in MATCH_FIELDS)
+            route = Route(route_name(rule), rule['model'], rule['max_tokens'])
+            self.routes.append((specificity, index, rule, route))
+        # Most specific first; among equals, the later route first
+        self.routes.sort(key=lambda entry: (-entry[0], -entry[1]))
+        self._cache: Dict[tuple, Optional[Route]] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    def route(self, call: str, step: Optional[int] = None, stage: Optional[str] = None) -> Optional[Route]:
+        """
+        Route for a call.
+
+        Args:
+            call: 'step' or 'sentiment'
+            step: Step number, for step calls
+            stage: Coaching stage, for steps that have stages
+
+        Returns:
+            The most specific matching Route, or None if no route matches
+        """
+        key = (call, step, stage)
+        if key not in self._cache:
+            values = dict(zip(MATCH_FIELDS, key))
+            self._cache[key] = next(
+                (route for _, _, rule, route in self.routes
+                 if all(rule.get(field) is None or rule[field] == values[field] for field in MATCH_FIELDS)),
+                None
+            )
+        return self._cache[key]
+
+    def record(self, route: Route, seconds: float) -> None:
+        """Log a routed call's latency and add it to the route's totals"""
+        logger.info(f"Route {route.name}: {route.model} max_tokens={route.max_tokens} time={seconds:.2f}s")
+        with self._lock:
+            stats = self._stats.setdefault(route.name, {
+                'model': route.model, 'max_tokens': route.max_tokens, 'requests': 0, 'total_seconds': 0.0,
+            })
+            stats['requests'] += 1
+            stats['total_seconds'] += seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Requests and mean latency per route"""
+        with self._lock:
+            summary = {name: dict(stats) for name, stats in self._stats.items()}
+        for stats in summary.values():
+            stats['mean_seconds'] = round(stats['total_seconds'] / stats['requests'], 3)
+        return summary
+
+
+# Router shared by the step engine and the sentiment scorer
+model_router = ModelRouter(MODEL_ROUTES if MODEL_ROUTING else [])
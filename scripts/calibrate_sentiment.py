@@ -0,0 +1,156 @@
+"""
+Compare the in-process lexicon sentiment scorer against the LLM scorer on a recorded corpus.
+
+The corpus is a JSONL file with one object per line:
+    {"text": "...", "llm_score": 4}
+
+Lines without an "llm_score" are scored with the LLM backend when --record is given
+(requires ANTHROPIC_API_KEY; --rescore scores every line again), and the completed corpus is
+written to --output so later runs don't spend API calls. Lines whose LLM call fails are left
+without a score rather than recorded as the scorer's neutral fallback.
+
+The sample corpus ships with scores assigned against the bands of the LLM scoring prompt, so
+the comparison runs offline out of the box; re-record them with --rescore to compare against
+the model currently configured.
+
+Usage:
+    python scripts/calibrate_sentiment.py scripts/sentiment_corpus_sample.jsonl
+    python scripts/calibrate_sentiment.py scripts/sentiment_corpus_sample.jsonl --record --rescore --output corpus.jsonl
+    python scripts/calibrate_sentiment.py corpus.jsonl
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sentiment import LexiconSentimentScorer, LLMSentimentScorer
+
+
+def score_band(score):
+    """Map a score onto the five bands described in the LLM scoring prompt"""
+    if score <= -7:
+        return "highly emotional"
+    if score <= -3:
+        return "moderately emotional"
+    if score <= 2:
+        return "balanced"
+    if score <= 6:
+        return "moderately rational"
+    return "highly rational"
+
+
+def pearson(xs, ys):
+    """Pearson correlation, or None when either series is constant"""
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+    if var_x == 0 or var_y == 0:
+        return None
+    return cov / math.sqrt(var_x * var_y)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def record_llm_scores(corpus, rescore=False):
+    """Fill in missing llm_score values (all of them with rescore) using the LLM backend"""
+    import anthropic
+    from config import ANTHROPIC_API_KEY
+
+    scorer = LLMSentimentScorer(anthropic.Anthropic(api_key=ANTHROPIC_API_KEY))
+    latencies = []
+    failed = 0
+    for entry in corpus:
+        if "llm_score" in entry and not rescore:
+            continue
+        start = time.perf_counter()
+        try:
+            # score() would turn a failed call into a neutral 0, which isn't the model's answer
+            llm_score = scorer.request_score(entry["text"])
+        except Exception as e:
+            failed += 1
+            entry.pop("llm_score", None)
+            print(f"Skipped (LLM call failed: {type(e).__name__}): {entry['text'][:60]}", file=sys.stderr)
+            continue
+        entry["llm_score"] = llm_score
+        latencies.append(time.perf_counter() - start)
+    if failed:
+        print(f"{failed} entries left without an llm_score", file=sys.stderr)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="JSONL corpus with 'text' and optional 'llm_score' fields")
+    parser.add_argument("--record", action="store_true", help="Score entries missing llm_score with the LLM backend")
+    parser.add_argument("--rescore", action="store_true", help="With --record, score entries that have an llm_score too")
+    parser.add_argument("--output", help="Where to write the corpus after --record")
+    parser.add_argument("--show", type=int, default=10, help="Number of largest disagreements to print")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    llm_latencies = []
+    if args.record:
+        llm_latencies = record_llm_scores(corpus, args.rescore)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                for entry in corpus:
+                    f.write(json.dumps(entry) + "\n")
+
+    scored = [entry for entry in corpus if "llm_score" in entry]
+    if not scored:
+        sys.exit("No entries have an llm_score. Run with --record to create them.")
+
+    lexicon = LexiconSentimentScorer()
+    lexicon_scores = []
+    lexicon_latencies = []
+    for entry in scored:
+        start = time.perf_counter()
+        lexicon_scores.append(lexicon.score(entry["text"]))
+        lexicon_latencies.append(time.perf_counter() - start)
+    llm_scores = [entry["llm_score"] for entry in scored]
+
+    errors = [lex - llm for lex, llm in zip(lexicon_scores, llm_scores)]
+    mae = sum(abs(e) for e in errors) / len(errors)
+    rmse = math.sqrt(sum(e * e for e in errors) / len(errors))
+    correlation = pearson(lexicon_scores, llm_scores)
+    band_agreement = sum(score_band(a) == score_band(b) for a, b in zip(lexicon_scores, llm_scores)) / len(scored)
+    # The UI themes on the sign of the EMA (Athena vs Dionysus), so sign agreement matters most
+    sign_agreement = sum((a >= 0) == (b >= 0) for a, b in zip(lexicon_scores, llm_scores)) / len(scored)
+
+    print(f"Entries compared:     {len(scored)}")
+    print(f"Mean absolute error:  {mae:.2f}")
+    print(f"RMSE:                 {rmse:.2f}")
+    print(f"Pearson r:            {correlation:.3f}" if correlation is not None else "Pearson r:            n/a")
+    print(f"Band agreement:       {band_agreement:.1%}")
+    print(f"Sign agreement:       {sign_agreement:.1%}")
+    print(f"Lexicon latency:      p50 {percentile(lexicon_latencies, 50) * 1e6:.1f}us  "
+          f"p99 {percentile(lexicon_latencies, 99) * 1e6:.1f}us")
+    if llm_latencies:
+        print(f"LLM latency:          p50 {percentile(llm_latencies, 50) * 1e3:.0f}ms  "
+              f"p99 {percentile(llm_latencies, 99) * 1e3:.0f}ms")
+
+    if args.show:
+        print("\nLargest disagreements (lexicon, llm, text):")
+        worst = sorted(zip(errors, lexicon_scores, llm_scores, scored), key=lambda item: -abs(item[0]))
+        for _, lex, llm, entry in worst[:args.show]:
+            print(f"  {lex:+3d} {llm:+3d}  {entry['text'][:80]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Sentiment scorers for the rationality vs emotionality scale used for avatar theming.
+
+Every scorer returns an integer from -10 (highly emotional) to +10 (highly rational).
+"""
+import re
+import abc
+import math
+import time
+import logging
+from typing import Dict, Optional
+
+from config import DEFAULT_MODEL, MAX_RETRIES, SENTIMENT_TIMEOUT
+from metrics import observe_api_call
+from rate_limiter import PRIORITY_SENTIMENT, estimate_request_tokens, rate_limiter
+from retry_policy import RetryPolicy, circuit_breaker
+from router import ModelRouter, Route, model_router
+
+logger = logging.getLogger(__name__)
+
+SCORE_MIN = -10
+SCORE_MAX = 10
+# Backoff ceiling for the first sentiment retry; the score is only used within SENTIMENT_TIMEOUT
+SENTIMENT_RETRY_DELAY = 0.5
+
+
+def clamp_score(score: int) -> int:
+    """Clamp a score into the -10..+10 range"""
+    return max(min(score, SCORE_MAX), SCORE_MIN)
+
+
+class SentimentScorer(abc.ABC):
+    """Interface for rationality vs emotionality scorers"""
+
+    name = "base"
+    # Local scorers run in-process and are cheap enough to call inline
+    is_local = False
+
+    @abc.abstractmethod
+    def score(self, text: str) -> int:
+        """
+        Score a user message.
+
+        Args:
+            text: The user's message
+
+        Returns:
+            Score from -10 (highly emotional) to +10 (highly rational)
+        """
+
+
+class LLMSentimentScorer(SentimentScorer):
+    """Scores each message with a short Claude request (one extra API call per turn)"""
+
+    name = "llm"
+
+    SYSTEM_PROMPT = """
+    Analyze the following text and rate it on a rationality vs emotionality scale from -10 to +10:
+    - -10 to -7: Highly emotional (dominated by feelings, passions, subjective experiences)
+    - -6 to -3: Moderately emotional (contains emotional language but with some reasoning)
+    - -2 to +2: Balanced (contains both emotional and rational elements in equilibrium)
+    - +3 to +6: Moderately rational (logical with some emotional components)
+    - +7 to +10: Highly rational (dominated by logic, evidence, structured reasoning)
+
+    Provide ONLY a single number score between -10 and +10 without any explanation.
+    """
+
+    def __init__(self, client, model: Optional[str] = None, router: ModelRouter = model_router):
+        """
+        Args:
+            client: Anthropic client
+            model: Model to score with; by default the 'sentiment' route's model, else DEFAULT_MODEL
+            router: Router consulted for the 'sentiment' route
+        """
+        self.client = client
+        self.route = router.route('sentiment') or Route('sentiment', DEFAULT_MODEL, 10)
+        if model is not None:
+            self.route = self.route._replace(model=model)
+        self.router = router
+        # The client makes no retries of its own; transient errors are retried here, within
+        # the sentiment deadline and through the shared circuit breaker
+        self.retry_policy = RetryPolicy(MAX_RETRIES, SENTIMENT_RETRY_DELAY, max_delay=SENTIMENT_TIMEOUT,
+                                        deadline=SENTIMENT_TIMEOUT, breaker=circuit_breaker)
+
+    def _create(self, request: dict):
+        """One scoring request, with its own rate-limiter reservation"""
+        # Waits behind coaching turns; past the sentiment deadline the score is unused anyway
+        reservation = rate_limiter.acquire(PRIORITY_SENTIMENT, estimate_request_tokens(request),
+                                           request["max_tokens"], timeout=SENTIMENT_TIMEOUT)
+        try:
+            response = self.client.messages.create(**request)
+            reservation.settle(response.usage)
+        finally:
+            reservation.release()
+        return response
+
+    def request_score(self, text: str) -> int:
+        """
+        Score a user message, retrying transient API errors.
+
+        Args:
+            text: The user's message
+
+        Returns:
+            Score from -10 (highly emotional) to +10 (highly rational)
+
+        Raises:
+            Exception: The API, rate-limiter or circuit-breaker error once retrying stops
+        """
+        request = {
+            "model": self.route.model,
+            "max_tokens": self.route.max_tokens,
+            "system": self.SYSTEM_PROMPT,
+            "messages": [{"role": "user", "content": text}],
+        }
+        start_time = time.monotonic()
+        response = self.retry_policy.call(lambda: self._create(request))
+        duration = time.monotonic() - start_time
+        self.router.record(self.route, duration)
+        observe_api_call("sentiment", response.usage, duration, self.route.model)
+        return parse_score(response.content[0].text)
+
+    def score(self, text: str) -> int:
+        try:
+            return self.request_score(text)
+        except Exception as e:
+            logger.error(f"Error analyzing sentiment: {str(e)}")
+            return 0  # Default to neutral on error
+
+
+def parse_score(score_text: str) -> int:
+    """
+    Parse a model-produced score, handling potential formatting issues.
+
+    Args:
+        score_text: Raw text returned by the model
+
+    Returns:
+        Score clamped to -10..+10, or 0 (neutral) if no number was found
+    """
+    score_text = score_text.strip()
+    try:
+        # Try direct conversion first
+        return clamp_score(int(score_text))
+    except ValueError:
+        # If that fails, search for a number pattern
+        match = re.search(r'-?\d+', score_text)
+        if match:
+            return clamp_score(int(match.group(0)))
+    return 0  # Default to neutral if parsing fails
+
+
+# Word weights for the lexicon scorer. Positive values lean rational, negative lean emotional.
+LEXICON_WEIGHTS: Dict[str, float] = {
+    # Emotional vocabulary
+    "feel": -1.5, "feeling": -1.5, "feelings": -1.5, "felt": -1.5,
+    "frustrated": -2.0, "frustrating": -2.0, "frustration": -2.0,
+    "angry": -2.5, "anger": -2.5, "furious": -3.0, "mad": -2.0, "upset": -2.0,
+    "annoyed": -1.5, "annoying": -1.5, "irritated": -1.5,
+    "stressed": -2.0, "stress": -1.5, "stressful": -2.0,
+    "anxious": -2.5, "anxiety": -2.5, "worried": -2.0, "worry": -2.0,
+    "nervous": -2.0, "scared": -2.5, "afraid": -2.5, "fear": -2.0, "terrified": -3.0,
+    "overwhelmed": -2.5, "overwhelming": -2.5, "exhausted": -2.0, "tired": -1.5,
+    "burned": -1.0, "burnout": -2.0, "desperate": -3.0, "hopeless": -3.0,
+    "sad": -2.0, "unhappy": -2.0, "depressed": -3.0, "lonely": -2.5, "hurt": -2.0,
+    "guilty": -2.0, "ashamed": -2.5, "embarrassed": -2.0,
+    "love": -2.0, "hate": -2.5, "adore": -2.0, "passion": -2.0, "passionate": -2.0,
+    "excited": -2.0, "exciting": -1.5, "thrilled": -2.5, "happy": -1.5, "joy": -2.0,
+    "proud": -1.5, "dream": -1.5, "dreams": -1.5, "wish": -1.0, "hope": -1.0,
+    "hopefully": -1.0, "heart": -1.5, "soul": -1.5,
+    "amazing": -1.5, "awesome": -1.5, "terrible": -2.0, "awful": -2.0,
+    "horrible": -2.5, "miserable": -2.5, "disaster": -1.5, "nightmare": -2.0,
+    "ugh": -2.5, "wow": -1.5, "omg": -2.5, "sucks": -2.0, "crazy": -1.5,
+    "honestly": -0.5, "really": -0.5, "totally": -0.5, "literally": -0.5,
+    "always": -0.5, "never": -0.5,
+    # Rational vocabulary
+    "because": 1.0, "therefore": 2.0, "thus": 2.0, "hence": 2.0, "consequently": 2.0,
+    "since": 0.5,
+    "data": 2.5, "evidence": 2.5, "metric": 2.5, "metrics": 2.5, "measure": 2.0,
+    "measured": 2.0, "measurable": 2.0, "kpi": 2.5, "kpis": 2.5,
+    "percent": 2.0, "percentage": 2.0, "rate": 1.0, "ratio": 2.0, "average": 1.5,
+    "analysis": 2.5, "analyze": 2.5, "analyse": 2.5, "calculate": 2.0, "estimate": 2.0,
+    "plan": 1.5, "planning": 1.5, "schedule": 1.5, "deadline": 1.5, "timeline": 2.0,
+    "milestone": 2.0, "milestones": 2.0, "quarter": 1.5, "weekly": 1.0, "daily": 1.0,
+    "budget": 2.0, "cost": 1.5, "costs": 1.5, "revenue": 2.0, "roi": 2.5,
+    "process": 1.5, "system": 1.0, "strategy": 1.5, "priority": 1.5, "prioritize": 1.5,
+    "option": 1.0, "options": 1.0, "tradeoff": 2.0, "tradeoffs": 2.0,
+    "specific": 1.5, "specifically": 1.5, "target": 1.5, "objective": 1.5,
+    "result": 1.0, "results": 1.0, "outcome": 1.0, "outcomes": 1.0,
+    "track": 1.5, "tracking": 1.5, "compare": 1.5, "comparison": 1.5,
+    "increase": 1.0, "reduce": 1.0, "decrease": 1.0, "efficiency": 1.5, "efficient": 1.5,
+    "implement": 1.5, "implementation": 1.5, "review": 1.0, "report": 1.0,
+    "hypothesis": 2.5, "test": 1.0, "experiment": 1.5, "logic": 2.5, "logical": 2.5,
+    "reason": 1.5, "reasons": 1.5, "cause": 1.0, "causes": 1.0, "factor": 1.5, "factors": 1.5,
+    "first": 0.5, "second": 0.5, "then": 0.5, "finally": 0.5,
+}
+
+_TOKEN_PATTERN = re.compile(r"[a-z]+|\d+(?:[.,]\d+)?%?|[!?]")
+_CAPS_PATTERN = re.compile(r"\b[A-Z]{3,}\b")
+_EMOJI_PATTERN = re.compile("[\U0001F300-\U0001FAFF☀-➿]")
+_FEELING_PHRASE_PATTERN = re.compile(r"\bi(?:'m| am)? (?:so|really|just|totally) \w+|\bi feel\b")
+
+
+class LexiconSentimentScorer(SentimentScorer):
+    """
+    In-process scorer built from a weighted lexicon plus a few surface features
+    (numbers, exclamation marks, shouting, emoji). Scores in well under a millisecond.
+    """
+
+    name = "lexicon"
+    is_local = True
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, scale: float = 3.0):
+        """
+        Args:
+            weights: Word weights, positive for rational and negative for emotional
+            scale: Evidence needed to move halfway to either end of the range
+        """
+        self.weights = weights if weights is not None else LEXICON_WEIGHTS
+        self.scale = scale
+
+    def score(self, text: str) -> int:
+        if not text:
+            return 0
+
+        lowered = text.lower()
+        tokens = _TOKEN_PATTERN.findall(lowered)
+        if not tokens:
+            return 0
+
+        weights = self.weights
+        evidence = 0.0
+        for token in tokens:
+            if token == "!":
+                evidence -= 1.0
+            elif token[0].isdigit():
+                # Numbers, dates and percentages point at concrete, measurable thinking
+                evidence += 1.5 if token.endswith("%") else 1.0
+            else:
+                evidence += weights.get(token, 0.0)
+
+        evidence -= 1.5 * len(_CAPS_PATTERN.findall(text))
+        evidence -= 1.5 * len(_EMOJI_PATTERN.findall(text))
+        evidence -= 1.0 * len(_FEELING_PHRASE_PATTERN.findall(lowered))
+
+        # Dampen long messages so a single essay doesn't saturate the scale
+        if len(tokens) > 10:
+            evidence /= math.sqrt(len(tokens) / 10.0)
+
+        return clamp_score(round(SCORE_MAX * math.tanh(evidence / (2 * self.scale))))
+
+
+class InlineSentimentScorer(SentimentScorer):
+    """
+    Scores each message as part of the step call: the step request asks for the score in a
+    hidden <sentiment> tag, which the step engine strips and returns with the StepResult.
+    score() is only the fallback for turns without a step call (the welcome turn) or a reply
+    without the tag, and uses the lexicon scorer.
+    """
+
+    name = "inline"
+    is_local = True
+
+    # Appended to the per-request part of the step system prompt
+    INSTRUCTION = (
+        "Also rate the user's latest message on a rationality vs emotionality scale from -10 "
+        "(highly emotional) to +10 (highly rational). End your reply with the score alone in "
+        "<sentiment></sentiment> tags, e.g. <sentiment>3</sentiment>. The tag is hidden from the user."
+    )
+
+    def __init__(self, fallback: Optional[SentimentScorer] = None):
+        """
+        Args:
+            fallback: Scorer for turns without an inline score (lexicon by default)
+        """
+        self.fallback = fallback or LexiconSentimentScorer()
+
+    def score(self, text: str) -> int:
+        return self.fallback.score(text)
+
+
+def parse_inline_score(score_text: str) -> Optional[int]:
+    """
+    Parse the content of a <sentiment> tag.
+
+    Args:
+        score_text: Text between the tags (empty when the reply had none)
+
+    Returns:
+        Score clamped to -10..+10, or None if no number was found
+    """
+    match = re.search(r'[-+]?\d+', score_text)
+    return clamp_score(int(match.group(0))) if match else None
+
+
+SENTIMENT_BACKENDS = ("llm", "lexicon", "inline")
+
+
+def get_sentiment_scorer(backend: str, client=None) -> SentimentScorer:
+    """
+    Build the scorer selected in config.
+
+    Args:
+        backend: One of SENTIMENT_BACKENDS
+        client: Anthropic client, required by the llm backend
+
+    Returns:
+        A SentimentScorer instance
+    """
+    if backend == "lexicon":
+        return LexiconSentimentScorer()
+    if backend == "inline":
+        return InlineSentimentScorer()
+    if backend == "llm":
+        if client is None:
+            raise ValueError("The llm sentiment backend requires an Anthropic client")
+        return LLMSentimentScorer(client)
+    raise ValueError(
+        f"Unknown SENTIMENT_BACKEND '{backend}'. Expected one of: {', '.join(SENTIMENT_BACKENDS)}"
+    )
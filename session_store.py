@@ -0,0 +1,263 @@
+"""
+Server-side session storage.
+
+With a server-side backend the session cookie only carries a signed, opaque session id and
+the session data lives in a store keyed by that id. This removes the ~4KB cookie ceiling on
+conversation history and keeps request/response headers small.
+
+Backends:
+    memory - in-process LRU (single process only; data is lost on restart)
+    sqlite - local SQLite file (shared by all workers on one host)
+    redis  - any Redis-protocol server (requires the optional `redis` package)
+"""
+import abc
+import time
+import secrets
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(abc.ABC):
+    """Interface for key/value stores holding serialized sessions"""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the stored value, or None if it is missing or expired"""
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        """Store a value that expires after ttl seconds"""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove a value if present"""
+
+
+class MemoryStore(SessionStore):
+    """In-process LRU store with per-entry expiry"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteStore(SessionStore):
+    """SQLite-backed store; one connection per thread, expired rows purged periodically"""
+
+    PURGE_EVERY = 500  # writes between sweeps of expired rows
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            # WAL lets several worker processes read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl)
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (key,))
+
+
+class RedisStore(SessionStore):
+    """Store for Redis or any server speaking the Redis protocol"""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "The redis session backend requires the 'redis' package. "
+                "Install it with: pip install redis"
+            )
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl):
+        self._client.set(key, value, ex=max(int(ttl), 1))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id and whether it was changed"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface storing session data in a SessionStore"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store: SessionStore, key_prefix: str = 'session:'):
+        self.store = store
+        self.key_prefix = key_prefix
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='fivestep-session-id')
+
+    def _ttl(self, app) -> int:
+        # Entries live as long as a permanent session cookie
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.get(self.key_prefix + sid)
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data.decode()), sid=sid)
+
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_state(self, app, sid: str, data: dict) -> None:
+        """Write session data for an id outside of the normal response cycle"""
+        self.store.set(self.key_prefix + sid, self.serializer.dumps(dict(data)).encode(), self._ttl(app))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        response.vary.add('Cookie')
+        if not self.should_set_cookie(app, session):
+            return
+
+        # Writing on refresh as well as on change keeps the store TTL in step with the cookie
+        self.save_state(app, session.sid, session)
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+SESSION_BACKENDS = ('cookie', 'compact', 'memory', 'sqlite', 'redis')
+
+
+def create_session_interface(backend: str, lru_max_entries: int = 10000,
+                             sqlite_path: str = 'sessions.sqlite3',
+                             redis_url: str = 'redis://localhost:6379/0',
+                             compression: str = 'zlib',
+                             cookie_max_chunks: int = 2) -> Optional[SessionInterface]:
+    """
+    Build the session interface for a backend.
+
+    Args:
+        backend: One of SESSION_BACKENDS
+        lru_max_entries: Capacity of the memory backend
+        sqlite_path: Database file for the sqlite backend
+        redis_url: Connection URL for the redis backend
+        compression: Codec for the compact cookie backend ('zlib' or 'zstd')
+        cookie_max_chunks: Most cookies the compact backend may split a session across
+
+    Returns:
+        A session interface, or None to keep Flask's default cookie sessions
+    """
+    if backend == 'cookie':
+        return None
+    if backend == 'compact':
+        from cookie_session import CompactCookieSessionInterface
+        return CompactCookieSessionInterface(codec=compression, max_cookies=cookie_max_chunks)
+    if backend == 'memory':
+        store = MemoryStore(lru_max_entries)
+    elif backend == 'sqlite':
+        store = SQLiteStore(sqlite_path)
+    elif backend == 'redis':
+        store = RedisStore(redis_url)
+    else:
+        raise ValueError(
+            f"Unknown SESSION_BACKEND '{backend}'. Expected one of: {', '.join(SESSION_BACKENDS)}"
+        )
+    logger.info(f"Using server-side '{backend}' session store")
+    return ServerSideSessionInterface(store)
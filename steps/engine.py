@@ -0,0 +1,339 @@
+"""
+Shared request/parse pipeline for the five coaching steps.
+
+Each step is declared as a StepDefinition (static prompt, optional coaching stages,
+completion markers and token limits) and registered with the StepEngine. The engine takes
+the system prompt from the prompt registry, builds token-budgeted messages, calls Claude with
+retries, extracts the evaluation block (and the inline sentiment score, when requested) and
+checks for completion the same way for every step. In structured mode, non-streamed turns
+answer through the step_reply tool instead and the fields are taken from its input; a reply
+without a valid call falls back to its text, or to one plain-text retry when it has none.
+"""
+import sys
+import os
+import time
+import logging
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context import build_messages
+from utils import (process_response, with_retry, with_async_retry, create_message,
+                   create_message_async, create_message_text, create_message_text_async, mark_history_cache)
+from config import (DEFAULT_MODEL, MAX_TOKENS, MAX_RETRIES, RETRY_DELAY, STEP_COMPLETE_MARKER,
+                    HEDGE_REQUESTS, HEDGE_PERCENTILE, HEDGE_BUDGET, HEDGE_FALLBACK_MODEL, HEDGE_DEFAULT_DELAY,
+                    SENTIMENT_BACKEND, STRUCTURED_OUTPUT)
+from hedging import Hedger
+from metrics import phase_seconds, structured_reply_failures
+from router import ModelRouter, Route, model_router
+from sentiment import InlineSentimentScorer, parse_inline_score
+from structured_output import (STRUCTURED_INSTRUCTION, SENTIMENT_FIELD_INSTRUCTION, StructuredReplyError,
+                               parse_step_reply, structured_request, tool_input)
+from .prompts import PromptRegistry, prompt_registry
+
+logger = logging.getLogger(__name__)
+
+
+class StepResult(NamedTuple):
+    """
+    Outcome of one step turn; unpacks as
+    (response, is_complete, evaluation_summary, sentiment_score, goal, visible_response)
+    """
+    response: str
+    is_complete: bool
+    evaluation_summary: str
+    # Inline sentiment score from the reply's <sentiment> tag or field, None when it had none
+    sentiment_score: Optional[int] = None
+    # Goal confirmed in a reply that completes the step, None when there is none
+    goal: Optional[str] = None
+    # Response as shown to the user, without step header, footer and markers
+    visible_response: Optional[str] = None
+
+
+class StepDefinition:
+    """Everything that differs between steps, as data"""
+
+    def __init__(self, number: int, system_prompt: str,
+                 goal_label: str = "The user's goal is",
+                 completion_markers: Iterable[str] = (STEP_COMPLETE_MARKER,),
+                 stage_function: Optional[Callable[[List[Dict[str, str]]], str]] = None,
+                 stage_prompts: Optional[Dict[str, str]] = None,
+                 model: str = DEFAULT_MODEL,
+                 max_tokens: int = MAX_TOKENS):
+        """
+        Args:
+            number: Step number (1-5)
+            system_prompt: Static system prompt, identical on every request so it can be cached
+            goal_label: Text introducing the goal in the per-request context
+            completion_markers: Any of these in a response completes the step
+            stage_function: Maps history to a coaching stage name, for steps with stages
+            stage_prompts: Prompt instructions for each coaching stage name
+            model: Claude model for this step
+            max_tokens: Reply token limit for this step
+        """
+        self.number = number
+        self.system_prompt = system_prompt
+        self.goal_label = goal_label
+        self.completion_markers = tuple(completion_markers)
+        self.stage_function = stage_function
+        self.stage_prompts = stage_prompts
+        self.model = model
+        self.max_tokens = max_tokens
+
+    @property
+    def usage_label(self) -> str:
+        return f"step{self.number}"
+
+    def stage(self, history: List[Dict[str, str]]) -> Optional[str]:
+        """Current coaching stage, or None for steps without stages"""
+        return self.stage_function(history) if self.stage_function is not None else None
+
+    def is_complete(self, response: str) -> bool:
+        return any(marker in response for marker in self.completion_markers)
+
+
+class StepEngine:
+    """
+    Runs step turns from their definitions.
+
+    Hooks:
+        request hooks  - hook(definition, request) before each API call; may adjust the request
+        response hooks - hook(definition, result, duration) after each successful turn
+    """
+
+    def __init__(self, prompts: PromptRegistry, max_retries: int = MAX_RETRIES,
+                 retry_delay: int = RETRY_DELAY, hedger: Optional[Hedger] = None,
+                 router: Optional[ModelRouter] = None, sentiment_instruction: Optional[str] = None,
+                 structured_output: bool = False):
+        """
+        Args:
+            prompts: Registry the step prompts are registered with
+            max_retries: Retries for each step call
+            retry_delay: Backoff ceiling in seconds for the first retry
+            hedger: Sends a duplicate request when a non-streamed text call is slow (off when None)
+            router: Picks model and max_tokens per step and stage (definitions decide when None)
+            sentiment_instruction: Asks for an inline <sentiment> score in every reply (off when None)
+            structured_output: Non-streamed turns reply through the step_reply tool
+        """
+        self.prompts = prompts
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.hedger = hedger
+        self.router = router
+        self.sentiment_instruction = sentiment_instruction
+        self.structured_output = structured_output
+        self.definitions: Dict[int, StepDefinition] = {}
+        self.request_hooks: List[Callable] = []
+        self.response_hooks: List[Callable] = []
+
+    def register(self, definition: StepDefinition) -> StepDefinition:
+        self.prompts.register(definition.number, definition.system_prompt, definition.goal_label,
+                              definition.stage_prompts)
+        self.definitions[definition.number] = definition
+        return definition
+
+    def add_request_hook(self, hook: Callable) -> None:
+        self.request_hooks.append(hook)
+
+    def add_response_hook(self, hook: Callable) -> None:
+        self.response_hooks.append(hook)
+
+    def route(self, definition: StepDefinition, stage: Optional[str] = None) -> Route:
+        """Model and max_tokens for a step turn; the definition's own when no route matches"""
+        route = self.router.route('step', definition.number, stage) if self.router is not None else None
+        return route or Route(definition.usage_label, definition.model, definition.max_tokens)
+
+    def build_request(self, definition: StepDefinition, user_input: str,
+                      history: List[Dict[str, str]], goal: Optional[str],
+                      stage: Optional[str] = None, structured: bool = False) -> Dict:
+        """Assemble the Messages API arguments for a step turn (a step_reply tool call if structured)"""
+        route = self.route(definition, stage)
+        system = self.prompts.system_blocks(definition.number, stage, goal)
+        # Instructions go in the per-request block, so the cached static prompt stays the same
+        if structured:
+            system[-1]["text"] += f"\n\n{STRUCTURED_INSTRUCTION}"
+            if self.sentiment_instruction:
+                system[-1]["text"] += f" {SENTIMENT_FIELD_INSTRUCTION}"
+        elif self.sentiment_instruction:
+            system[-1]["text"] += f"\n\n{self.sentiment_instruction}"
+        # Fit the history and current user input into the step's token budget
+        messages = build_messages(history, user_input, step=definition.number, system=system)
+        request = {
+            "model": route.model,
+            "max_tokens": route.max_tokens,
+            "system": system,
+            "messages": mark_history_cache(messages),
+        }
+        if structured:
+            request.update(structured_request(with_sentiment=bool(self.sentiment_instruction)))
+        return request
+
+    def _prepare(self, step: int, user_input: str, history: Optional[List[Dict[str, str]]],
+                 goal: Optional[str], structured: bool):
+        definition = self.definitions[step]
+        history = history or []
+        stage = definition.stage(history)
+        request = self.build_request(definition, user_input, history, goal, stage, structured)
+        prompt_version = self.prompts.version(definition.number, stage)
+        for hook in self.request_hooks:
+            hook(definition, request)
+        return definition, request, prompt_version, self.route(definition, stage), stage
+
+    @staticmethod
+    def parse_text(definition: StepDefinition, text: str) -> StepResult:
+        """Step result from a text reply: tags, markers, goal and headers are taken out in one pass"""
+        processed = process_response(text, definition.completion_markers)
+        return StepResult(processed.response, processed.is_complete, processed.evaluation,
+                          parse_inline_score(processed.sentiment) if processed.sentiment else None,
+                          processed.goal, processed.visible)
+
+    @staticmethod
+    def parse_structured(message) -> StepResult:
+        """
+        Step result from a step_reply tool call.
+
+        Raises:
+            StructuredReplyError: If the reply has no valid step_reply call
+        """
+        reply = parse_step_reply(tool_input(message))
+        # Fields are used as validated; the schema keeps headers out of message
+        return StepResult(reply.message, reply.is_complete, reply.evaluation, reply.sentiment, reply.goal,
+                          reply.message)
+
+    def recover_structured(self, definition: StepDefinition, message,
+                           error: StructuredReplyError) -> Optional[StepResult]:
+        """
+        Count a structured reply without a valid step_reply call and parse its text blocks instead.
+
+        Returns:
+            StepResult from the reply's text, or None when it has no text (the caller retries once
+            for a plain-text reply)
+        """
+        text = "".join(block.text for block in message.content if getattr(block, "type", None) == "text")
+        fallback = 'text' if text.strip() else 'retry'
+        logger.warning(f"Step {definition.number} structured reply unusable "
+                       f"(stop_reason={getattr(message, 'stop_reason', None)}): {str(error)}; "
+                       f"falling back to {fallback}")
+        structured_reply_failures.inc(step=definition.number, fallback=fallback)
+        return self.parse_text(definition, text) if fallback == 'text' else None
+
+    def _finish(self, definition: StepDefinition, route: Route, stage: Optional[str],
+                result: StepResult, start_time: float) -> StepResult:
+        duration = time.monotonic() - start_time
+        phase_seconds.observe(duration, phase='step', step=definition.number, stage=stage or '')
+        if self.router is not None:
+            self.router.record(route, duration)
+        for hook in self.response_hooks:
+            hook(definition, result, duration)
+        return result
+
+    def run(self, step: int, user_input: str, history: List[Dict[str, str]], goal: Optional[str],
+            client, on_text: Optional[Callable[[str], None]] = None) -> StepResult:
+        """
+        Run one turn of a step.
+
+        Args:
+            step: Step number
+            user_input: The user's message
+            history: Conversation history (not modified)
+            goal: The user's goal, if known
+            client: Anthropic client
+            on_text: Optional callback receiving reply text as it streams
+
+        Returns:
+            StepResult with the response (evaluation and sentiment tag removed), completion flag,
+            evaluation, inline sentiment score and, for structured replies, the goal
+        """
+        start_time = time.monotonic()
+        structured = self.structured_output and on_text is None
+        definition, request, prompt_version, route, stage = self._prepare(
+            step, user_input, history, goal, structured)
+        streamed = []
+
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+
+        # Once text has reached the user, a retry would show it twice
+        @with_retry(self.max_retries, self.retry_delay, retry_if=lambda error: not streamed)
+        def send():
+            if structured:
+                return create_message(client, usage_label=definition.usage_label,
+                                      prompt_version=prompt_version, stage=stage, **request)
+            if self.hedger is not None and on_text is None:
+                return self.hedger.create_message_text(client, definition.usage_label, prompt_version=prompt_version,
+                                                       stage=stage, **request)
+            return create_message_text(client, forward if on_text else None,
+                                       usage_label=definition.usage_label,
+                                       prompt_version=prompt_version, stage=stage, **request)
+
+        reply = send()
+        if not structured:
+            return self._finish(definition, route, stage, self.parse_text(definition, reply), start_time)
+        try:
+            result = self.parse_structured(reply)
+        except StructuredReplyError as e:
+            result = self.recover_structured(definition, reply, e)
+            if result is None:
+                # The call was already paid for; one plain-text retry beats failing the turn
+                definition, request, prompt_version, route, stage = self._prepare(
+                    step, user_input, history, goal, False)
+                send_text = with_retry(self.max_retries, self.retry_delay)(create_message_text)
+                result = self.parse_text(definition, send_text(
+                    client, usage_label=definition.usage_label, prompt_version=prompt_version, stage=stage,
+                    **request))
+        return self._finish(definition, route, stage, result, start_time)
+
+    async def run_async(self, step: int, user_input: str, history: List[Dict[str, str]],
+                        goal: Optional[str], client,
+                        on_text: Optional[Callable[[str], None]] = None) -> StepResult:
+        """Same as run, for an anthropic.AsyncAnthropic client"""
+        start_time = time.monotonic()
+        structured = self.structured_output and on_text is None
+        definition, request, prompt_version, route, stage = self._prepare(
+            step, user_input, history, goal, structured)
+        streamed = []
+
+        def forward(text):
+            streamed.append(text)
+            on_text(text)
+
+        @with_async_retry(self.max_retries, self.retry_delay, retry_if=lambda error: not streamed)
+        async def send():
+            if structured:
+                return await create_message_async(client, usage_label=definition.usage_label,
+                                                  prompt_version=prompt_version, stage=stage, **request)
+            if self.hedger is not None and on_text is None:
+                return await self.hedger.create_message_text_async(
+                    client, definition.usage_label, prompt_version=prompt_version, stage=stage, **request)
+            return await create_message_text_async(client, forward if on_text else None,
+                                                   usage_label=definition.usage_label,
+                                                   prompt_version=prompt_version, stage=stage, **request)
+
+        reply = await send()
+        if not structured:
+            return self._finish(definition, route, stage, self.parse_text(definition, reply), start_time)
+        try:
+            result = self.parse_structured(reply)
+        except StructuredReplyError as e:
+            result = self.recover_structured(definition, reply, e)
+            if result is None:
+                # The call was already paid for; one plain-text retry beats failing the turn
+                definition, request, prompt_version, route, stage = self._prepare(
+                    step, user_input, history, goal, False)
+                send_text = with_async_retry(self.max_retries, self.retry_delay)(create_message_text_async)
+                result = self.parse_text(definition, await send_text(
+                    client, usage_label=definition.usage_label, prompt_version=prompt_version, stage=stage,
+                    **request))
+        return self._finish(definition, route, stage, result, start_time)
+
+
+# Engine shared by the step modules; each registers its definition on import
+engine = StepEngine(prompt_registry, hedger=Hedger(
+    percentile=HEDGE_PERCENTILE,
+    budget=HEDGE_BUDGET,
+    fallback_model=HEDGE_FALLBACK_MODEL or None,
+    default_delay=HEDGE_DEFAULT_DELAY,
+) if HEDGE_REQUESTS else None, router=model_router,
+    sentiment_instruction=InlineSentimentScorer.INSTRUCTION if SENTIMENT_BACKEND == 'inline' else None,
+    structured_output=STRUCTURED_OUTPUT)
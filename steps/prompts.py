@@ -0,0 +1,124 @@
+"""
+Registry of the step system prompts.
+
+Every step registers its static prompt, goal label and coaching-stage instructions once at
+import time. Templates are validated and hashed when registered, and the system blocks for a
+(step, stage, goal) are built once and served from an LRU cache afterwards, so repeated
+turns send byte-identical prompts and each prompt has a version to log.
+"""
+import re
+import hashlib
+import logging
+import functools
+from typing import Any, Dict, List, Optional, Tuple
+
+import sys
+import os
+
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import build_system_blocks
+
+logger = logging.getLogger(__name__)
+
+# A leftover {name} means a template was not rendered (e.g. a missing f prefix)
+_PLACEHOLDER_PATTERN = re.compile(r'\{[A-Za-z_][A-Za-z0-9_]*\}')
+
+
+def content_hash(text: str) -> str:
+    """Short, stable fingerprint of a prompt"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+
+def validate_template(name: str, text: str) -> None:
+    """Raise ValueError if a prompt is empty or still contains template placeholders"""
+    if not text or not text.strip():
+        raise ValueError(f"Prompt '{name}' is empty")
+    placeholder = _PLACEHOLDER_PATTERN.search(text)
+    if placeholder:
+        raise ValueError(f"Prompt '{name}' contains unrendered placeholder {placeholder.group()}")
+
+
+class StepPrompts:
+    """Validated prompt text for one step"""
+
+    def __init__(self, step: int, system_prompt: str, goal_label: str,
+                 stage_prompts: Optional[Dict[str, str]] = None):
+        validate_template(f"step{step}", system_prompt)
+        for stage, text in (stage_prompts or {}).items():
+            validate_template(f"step{step}/{stage}", text)
+
+        self.step = step
+        self.system_prompt = system_prompt
+        self.goal_label = goal_label
+        self.stage_prompts = dict(stage_prompts or {})
+        self.hash = content_hash(system_prompt)
+        self.stage_hashes = {stage: content_hash(text) for stage, text in self.stage_prompts.items()}
+
+    def resolve_stage(self, stage: Optional[str]) -> Optional[str]:
+        """Known stage name for a requested stage; unknown stages fall back to the first one"""
+        if not self.stage_prompts:
+            return None
+        return stage if stage in self.stage_prompts else next(iter(self.stage_prompts))
+
+
+class PromptRegistry:
+    """Builds and caches system blocks for every registered step"""
+
+    def __init__(self, cache_size: int = 1024):
+        self._steps: Dict[int, StepPrompts] = {}
+        self._build = functools.lru_cache(maxsize=cache_size)(self._build_blocks)
+
+    def register(self, step: int, system_prompt: str, goal_label: str,
+                 stage_prompts: Optional[Dict[str, str]] = None) -> StepPrompts:
+        prompts = StepPrompts(step, system_prompt, goal_label, stage_prompts)
+        self._steps[step] = prompts
+        self._build.cache_clear()
+        logger.info(f"Registered step {step} prompt {prompts.hash} with {len(prompts.stage_prompts)} stages")
+        return prompts
+
+    def version(self, step: int, stage: Optional[str] = None) -> str:
+        """
+        Version of the prompt sent for a step and stage.
+
+        Args:
+            step: Step number
+            stage: Coaching stage, for steps that have stages
+
+        Returns:
+            The static prompt hash, suffixed with the stage prompt hash when there is one
+        """
+        prompts = self._steps[step]
+        stage = prompts.resolve_stage(stage)
+        if stage is None:
+            return prompts.hash
+        return f"{prompts.hash}.{prompts.stage_hashes[stage]}"
+
+    def _build_blocks(self, step: int, stage: Optional[str], goal: Optional[str]) -> Tuple[Dict[str, Any], ...]:
+        prompts = self._steps[step]
+        dynamic_context = f"{prompts.goal_label}: {goal if goal else 'Not yet defined'}"
+        if stage is not None:
+            dynamic_context += f"\n\n## Current Coaching Stage: {stage}\n{prompts.stage_prompts[stage]}"
+        return tuple(build_system_blocks(prompts.system_prompt, dynamic_context))
+
+    def system_blocks(self, step: int, stage: Optional[str], goal: Optional[str]) -> List[Dict[str, Any]]:
+        """
+        System prompt blocks for a request.
+
+        Args:
+            step: Step number
+            stage: Coaching stage, for steps that have stages
+            goal: The user's goal, if known
+
+        Returns:
+            Fresh list of blocks (the cached blocks themselves are never handed out)
+        """
+        stage = self._steps[step].resolve_stage(stage)
+        return [dict(block) for block in self._build(step, stage, goal)]
+
+    def cache_info(self):
+        return self._build.cache_info()
+
+
+# Registry shared by the step engine
+prompt_registry = PromptRegistry()
@@ -2,24 +2,18 @@
 Step 1: Have Clear Goals - Fast Version
 """
 from .Program_Wide_Prompt import PROGRAM_WIDE_PROMPT
+from .engine import StepDefinition, engine
 import sys
 import os
 
 # Add the parent directory to sys.path to import from root
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import truncate_history, extract_evaluation, check_step_completion, with_retry
-from config import DEFAULT_MODEL, MAX_TOKENS
+from utils import GOAL_COMPLETION_MARKERS
 
-@with_retry()
-def handle_step1(user_input, history, goal, client):
-    """
-    Guides the user through Step 1: Have Clear Goals with faster progression
-    """
-    # System content with minimal coaching instructions
-    system_content = f"""{PROGRAM_WIDE_PROMPT}
+# Static part of the system prompt - identical on every request so it can be cached
+STEP1_SYSTEM_PROMPT = f"""{PROGRAM_WIDE_PROMPT}
 
 You are guiding the user through Step 1: Have Clear Goals.
-The user's current goal is: {goal if goal else "Not yet defined"}
 
 ## Fast Goal Identification Guidelines
 
@@ -46,26 +40,17 @@ The user's current goal is: {goal if goal else "Not yet defined"}
 The MOMENT you identify a specific, workable goal, confirm it and move on. Don't wait for multiple exchanges.
 """
 
-    # Prepare the message history for Claude
-    messages = truncate_history(history) if history else []
-    
-    # Add current user input
-    messages.append({"role": "user", "content": user_input})
-        
-    # Make API call with retry logic handled by decorator
-    api_response = client.messages.create(
-        model=DEFAULT_MODEL,
-        max_tokens=MAX_TOKENS,
-        system=system_content,
-        messages=messages
-    )
-    
-    response = api_response.content[0].text
 
-    # Extract evaluation summary and clean response
-    response, evaluation_summary = extract_evaluation(response)
-    
-    # Check for step completion markers
-    is_complete = check_step_completion(response)
-                   
-    return response, is_complete, evaluation_summary
\ No newline at end of file
+STEP1 = engine.register(StepDefinition(
+    number=1,
+    system_prompt=STEP1_SYSTEM_PROMPT,
+    goal_label="The user's current goal is",
+    completion_markers=GOAL_COMPLETION_MARKERS,
+))
+
+
+def handle_step1(user_input, history, goal, client, on_text=None):
+    """
+    Guides the user through Step 1: Have Clear Goals with faster progression
+    """
+    return engine.run(1, user_input, history, goal, client, on_text)
@@ -2,23 +2,18 @@
 Step 2: Identify and Don't Tolerate Problems
 """
 from .Program_Wide_Prompt import PROGRAM_WIDE_PROMPT
+from .engine import StepDefinition, engine
+import sys
+import os
 
-def handle_step2(user_input, history, goal, client):
-    """
-    Guides the user through Step 2: Identify Problems
-    Helps users identify specific problems standing in the way of their goal,
-    focusing on what causes the most pain
-    """
-    # Determine the coaching stage based on conversation history
-    current_stage = determine_coaching_stage(history)
-    
-    # System content with streamlined coaching instructions
-    system_content = f"""{PROGRAM_WIDE_PROMPT}
+# Add the parent directory to sys.path to import from root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compaction import is_step_summary
 
-You are guiding the user through Step 2: Identify Problems.
-The user's goal is: {goal}
+# Static part of the system prompt - identical on every request so it can be cached
+STEP2_SYSTEM_PROMPT = f"""{PROGRAM_WIDE_PROMPT}
 
-## Current Coaching Stage: {current_stage}
+You are guiding the user through Step 2: Identify Problems.
 
 Your goal is to help the user identify the key pain points that stand in the way of achieving their goal. Focus on the most significant problems rather than trying to be exhaustive.
 
@@ -39,8 +34,6 @@ Your goal is to help the user identify the key pain points that stand in the way
    - Example: "Do you think that's the core issue, or a symptom of something deeper?"
    - Example: "Have you noticed patterns across these different challenges?"
 
-{get_stage_instructions(current_stage)}
-
 After the user has identified their key pain points, provide an evaluation in this format:
 <evaluation>[Your assessment of the most significant problems identified. Focus on 2-3 key issues that appear to cause the most pain and have the greatest impact on the user's goal. Note which seem to be root issues versus symptoms.]</evaluation>
 
@@ -56,47 +49,14 @@ Throughout this process:
 - Remember that pain is a signal - help the user see it as useful information rather than something to avoid
 - Listen for emotional indicators that suggest where the real pain points lie"""
 
-    # Prepare the message history for Claude
-    messages = []
-    
-    # Add conversation history
-    if history:
-        messages.extend(history)
-    
-    # Add current user input
-    messages.append({"role": "user", "content": user_input})
-
-    # Using a larger message history for more context
-    if len(messages) > 50:
-        messages = messages[-50:]
-        
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=4000,
-        system=system_content,
-        messages=messages
-    ).content[0].text
-
-    # Extract evaluation summary if it exists
-    evaluation_summary = ""
-    if "<evaluation>" in response and "</evaluation>" in response:
-        evaluation_start = response.find("<evaluation>") + len("<evaluation>")
-        evaluation_end = response.find("</evaluation>")
-        evaluation_summary = response[evaluation_start:evaluation_end].strip()
-
-        # Remove the evaluation tags and content from the main response
-        response = response[:response.find("<evaluation>")] + response[response.find("</evaluation>") + len("</evaluation>"):]
-    
-    # Check for step completion markers
-    is_complete = "STEP_COMPLETE" in response or "Moving to next step" in response
-    return response, is_complete, evaluation_summary
-
-
 def determine_coaching_stage(history):
     """
     Determines the current coaching stage based on conversation history - simplified
     for faster progression
     """
+    # Summaries of earlier completed steps are not part of this step's conversation
+    history = [msg for msg in history or [] if not is_step_summary(msg)]
+    
     # If no history or very little history, we're at the beginning
     if not history or len(history) < 3:
         return "initial_question"
@@ -113,12 +73,9 @@ def determine_coaching_stage(history):
         return "problem_summarization"
 
 
-def get_stage_instructions(stage):
-    """
-    Returns specific coaching instructions based on the current stage - streamlined
-    """
-    instructions = {
-        "initial_question": """
+# Coaching instructions for each stage - streamlined
+STAGE_INSTRUCTIONS = {
+    "initial_question": """
 ## Problem Identification - Initial Stage
 Begin with a focused question about the main obstacles:
 
@@ -126,7 +83,7 @@ Begin with a focused question about the main obstacles:
 
 Wait for the user's response before asking follow-up questions.
 """,
-        "problem_exploration": """
+    "problem_exploration": """
 ## Problem Identification - Exploration Stage
 Now that the user has shared initial problems, help them prioritize:
 
@@ -136,7 +93,7 @@ Follow up with: "Are these issues more about [select one relevant to their situa
 
 This helps focus on the nature of the core problems.
 """,
-        "problem_summarization": """
+    "problem_summarization": """
 ## Problem Identification - Summarization Stage
 
 Synthesize what you've learned into 2-3 key problems: 
@@ -147,6 +104,29 @@ Check if your summary resonates: "Have I captured your biggest pain points corre
 After the user confirms, include "STEP_COMPLETE" in your response (invisible to user) and transition naturally:
 "Now that we understand what's causing you the most pain, let's explore why these problems exist."
 """
-    }
-    
-    return instructions.get(stage, instructions["initial_question"])
\ No newline at end of file
+}
+
+
+def get_stage_instructions(stage):
+    """
+    Returns specific coaching instructions based on the current stage - streamlined
+    """
+    return STAGE_INSTRUCTIONS.get(stage, STAGE_INSTRUCTIONS["initial_question"])
+
+
+STEP2 = engine.register(StepDefinition(
+    number=2,
+    system_prompt=STEP2_SYSTEM_PROMPT,
+    completion_markers=("STEP_COMPLETE", "Moving to next step"),
+    stage_function=determine_coaching_stage,
+    stage_prompts=STAGE_INSTRUCTIONS,
+))
+
+
+def handle_step2(user_input, history, goal, client, on_text=None):
+    """
+    Guides the user through Step 2: Identify Problems
+    Helps users identify specific problems standing in the way of their goal,
+    focusing on what causes the most pain
+    """
+    return engine.run(2, user_input, history, goal, client, on_text)
@@ -2,17 +2,12 @@
 Step 3: Diagnose Problems to get at their root cause
 """
 from .Program_Wide_Prompt import PROGRAM_WIDE_PROMPT
+from .engine import StepDefinition, engine
 
-def handle_step3(user_input, history, goal, client):
-    """
-    Guides the user through Step 3: Diagnose Problems to get at their root cause
-    Helps users distinguish between proximate causes and deeper root causes
-    """
-    # System content with structured coaching instructions
-    system_content = f"""{PROGRAM_WIDE_PROMPT}
+# Static part of the system prompt - identical on every request so it can be cached
+STEP3_SYSTEM_PROMPT = f"""{PROGRAM_WIDE_PROMPT}
     
     You are guiding the user through Step 3: Diagnose Problems to get at their root cause.
-    The user's goal is: {goal}
     
     Your task is to help the user diagnose the root causes of their problems through higher-level thinking.
     
@@ -53,38 +48,17 @@ def handle_step3(user_input, history, goal, client):
     - Help separate what's real (actionable, rooted in reality) from what's noise (vague, emotional)
     - Encourage the user to be a realist rather than an idealist
     - Keep responses concise and ask only one or two questions at a time"""
-    
-    
-        # Prepare the message history for Claude - only user and assistant roles
-    messages = []
-    
-    # Add conversation history (only user and assistant messages)
-    if history:
-        messages.extend(history)
-    
-    # Add current user input
-    messages.append({"role": "user", "content": user_input})
 
-    # Using a larger message history for more context
-    if len(messages) > 50:
-        messages = messages[-50:]
-        
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=4000,
-        system=system_content,
-        messages=messages
-    ).content[0].text
 
-    # Extract evaluation summary if it exists
-    evaluation_summary = ""
-    if "<evaluation>" in response and "</evaluation>" in response:
-        evaluation_start = response.find("<evaluation>") + len("<evaluation>")
-        evaluation_end = response.find("</evaluation>")
-        evaluation_summary = response[evaluation_start:evaluation_end].strip()
+STEP3 = engine.register(StepDefinition(
+    number=3,
+    system_prompt=STEP3_SYSTEM_PROMPT,
+))
 
-        # Remove the evaluation tags and content from the main response
-        response = response[:response.find("<evaluation>")] + response[response.find("</evaluation>") + len("</evaluation>"):]
-    
-    is_complete = "STEP_COMPLETE" in response
-    return response, is_complete, evaluation_summary
\ No newline at end of file
+
+def handle_step3(user_input, history, goal, client, on_text=None):
+    """
+    Guides the user through Step 3: Diagnose Problems to get at their root cause
+    Helps users distinguish between proximate causes and deeper root causes
+    """
+    return engine.run(3, user_input, history, goal, client, on_text)
@@ -2,18 +2,12 @@
 Step 4: Design a Plan
 """
 from .Program_Wide_Prompt import PROGRAM_WIDE_PROMPT
+from .engine import StepDefinition, engine
 
-def handle_step4(user_input, history, goal, client):
-    """
-    Guides the user through Step 4: Design a Plan
-    Helps users create specific, actionable plans based on root cause analysis
-    """
-    # System content with structured coaching instructions
-    system_content = f"""{PROGRAM_WIDE_PROMPT}
+# Static part of the system prompt - identical on every request so it can be cached
+STEP4_SYSTEM_PROMPT = f"""{PROGRAM_WIDE_PROMPT}
 
 You are guiding the user through Step 4: Design a Plan.
-The user's goal is: {goal}
-
 Your task is to help the user create a specific, actionable plan to achieve their goal by addressing the root causes identified.
 
 ## Plan Design Framework
@@ -67,36 +61,16 @@ Throughout this process:
 once we have a specific actionable plan include the text 'STEP_COMPLETE' in your response (invisible to the user) and say 
    "Moving to next step."""
 
-    # Prepare the message history for Claude - only user and assistant roles
-    messages = []
-    
-    # Add conversation history (only user and assistant messages)
-    if history:
-        messages.extend(history)
-    
-    # Add current user input
-    messages.append({"role": "user", "content": user_input})
-
-    # Using a larger message history for more context
-    if len(messages) > 50:
-        messages = messages[-50:]
-        
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=4000,
-        system=system_content,
-        messages=messages
-    ).content[0].text
-
-    # Extract evaluation summary if it exists
-    evaluation_summary = ""
-    if "<evaluation>" in response and "</evaluation>" in response:
-        evaluation_start = response.find("<evaluation>") + len("<evaluation>")
-        evaluation_end = response.find("</evaluation>")
-        evaluation_summary = response[evaluation_start:evaluation_end].strip()
-
-        # Remove the evaluation tags and content from the main response
-        response = response[:response.find("<evaluation>")] + response[response.find("</evaluation>") + len("</evaluation>"):]
-    
-    is_complete = "STEP_COMPLETE" in response
-    return response, is_complete, evaluation_summary
\ No newline at end of file
+
+STEP4 = engine.register(StepDefinition(
+    number=4,
+    system_prompt=STEP4_SYSTEM_PROMPT,
+))
+
+
+def handle_step4(user_input, history, goal, client, on_text=None):
+    """
+    Guides the user through Step 4: Design a Plan
+    Helps users create specific, actionable plans based on root cause analysis
+    """
+    return engine.run(4, user_input, history, goal, client, on_text)
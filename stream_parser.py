@@ -0,0 +1,311 @@
+"""
+Incremental post-processing for streamed coaching responses.
+
+The batch pipeline applied to a complete response is:
+    1. utils.extract_evaluation   - cut the first <evaluation>...</evaluation> block
+    2. utils.extract_sentiment    - cut the first <sentiment>...</sentiment> block (inline score)
+    3. utils.remove_step_headers  - drop the leading "STEP N: TITLE" header, the trailing
+                                    "CURRENT STEP: N - TITLE" footer and every STEP_COMPLETE
+                                    marker, collapse blank lines and strip
+
+ResponseStreamParser applies the same pipeline one chunk at a time, so hidden content never
+reaches the browser even when a tag or marker is split across chunk boundaries. Each stage
+only holds back text that could still turn out to be part of something hidden; everything
+else is emitted immediately.
+"""
+import re
+from typing import List
+
+from config import STEP_COMPLETE_MARKER
+from utils import EVALUATION_OPEN, EVALUATION_CLOSE, SENTIMENT_OPEN, SENTIMENT_CLOSE
+
+# Longest header/footer candidate we are willing to hold back before giving up on it
+DEFAULT_LOOKAHEAD_LIMIT = 256
+
+_HEADER_PATTERN = re.compile(r'STEP \d+: [A-Z\s]+')
+# Matches any prefix of a header that is still too short to decide on
+_HEADER_PREFIX_PATTERN = re.compile(r'S(?:T(?:E(?:P(?: (?:\d+(?::(?: )?)?)?)?)?)?)?')
+
+_FOOTER_PATTERN = re.compile(r'CURRENT STEP: \d+ - [A-Z\s]+')
+
+
+def _nested_prefix_pattern(tokens: List[str]) -> str:
+    """Build a regex matching any non-empty prefix of the token sequence"""
+    pattern = ""
+    for token in reversed(tokens[1:]):
+        pattern = f"(?:{token}{pattern})?"
+    return tokens[0] + pattern
+
+
+# Matches a footer candidate (complete or still growing) that runs to the end of the buffer
+_FOOTER_CANDIDATE_PATTERN = re.compile(
+    _nested_prefix_pattern(list("CURRENT STEP: ") + [r'\d+', ' ', '-', ' ', r'[A-Z\s]*']) + r'\Z'
+)
+
+_WHITESPACE_RUN_PATTERN = re.compile(r'\s+')
+
+
+def _partial_suffix_length(text: str, marker: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of marker"""
+    # Only suffixes starting with the marker's first character can qualify
+    index = text.find(marker[0], max(0, len(text) - len(marker) + 1))
+    while index != -1:
+        if marker.startswith(text[index:]):
+            return len(text) - index
+        index = text.find(marker[0], index + 1)
+    return 0
+
+
+class _TagFilter:
+    """Removes the first open...close tag block and captures its content"""
+
+    def __init__(self, open_tag: str, close_tag: str):
+        self.open_tag = open_tag
+        self.close_tag = close_tag
+        self.state = "scan"
+        self.buffer = ""
+        self.content = ""
+        self._search_from = 0
+
+    def feed(self, text: str) -> str:
+        if self.state == "done":
+            return text
+
+        self.buffer += text
+        output = ""
+        if self.state == "scan":
+            index = self.buffer.find(self.open_tag)
+            if index == -1:
+                keep = _partial_suffix_length(self.buffer, self.open_tag)
+                output = self.buffer[:len(self.buffer) - keep]
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return output
+            output = self.buffer[:index]
+            self.buffer = self.buffer[index + len(self.open_tag):]
+            self.state = "inside"
+            self._search_from = 0
+
+        index = self.buffer.find(self.close_tag, self._search_from)
+        if index == -1:
+            self._search_from = max(0, len(self.buffer) - len(self.close_tag) + 1)
+            return output
+
+        self.content = self.buffer[:index].strip()
+        output += self.buffer[index + len(self.close_tag):]
+        self.buffer = ""
+        self.state = "done"
+        return output
+
+    def close(self) -> str:
+        if self.state == "inside":
+            # Without a closing tag the batch code leaves the block in the response
+            return self.open_tag + self.buffer
+        return self.buffer
+
+
+class _HeaderFilter:
+    """Removes a "STEP N: TITLE" header at the very start of the text"""
+
+    def __init__(self, lookahead_limit: int):
+        self.lookahead_limit = lookahead_limit
+        self.done = False
+        self.buffer = ""
+
+    def feed(self, text: str) -> str:
+        if self.done:
+            return text
+
+        self.buffer += text
+        if not self.buffer:
+            return ""
+
+        match = _HEADER_PATTERN.match(self.buffer)
+        if match:
+            if match.end() < len(self.buffer) or len(self.buffer) > self.lookahead_limit:
+                output = self.buffer[match.end():]
+                self.buffer = ""
+                self.done = True
+                return output
+            return ""  # The header may still grow
+
+        if _HEADER_PREFIX_PATTERN.fullmatch(self.buffer):
+            return ""  # Too short to tell yet
+
+        output = self.buffer
+        self.buffer = ""
+        self.done = True
+        return output
+
+    def close(self) -> str:
+        match = _HEADER_PATTERN.match(self.buffer)
+        return self.buffer[match.end():] if match else self.buffer
+
+
+class _FooterFilter:
+    """Removes a "CURRENT STEP: N - TITLE" footer that runs to the end of the text"""
+
+    def __init__(self, lookahead_limit: int):
+        self.lookahead_limit = lookahead_limit
+        self.buffer = ""
+
+    def feed(self, text: str) -> str:
+        if not self.buffer and "C" not in text:
+            return text  # Fast path: no footer can start in this chunk
+
+        self.buffer += text
+        match = _FOOTER_CANDIDATE_PATTERN.search(self.buffer)
+        if not match or len(self.buffer) - match.start() > self.lookahead_limit:
+            output = self.buffer
+            self.buffer = ""
+            return output
+
+        output = self.buffer[:match.start()]
+        self.buffer = self.buffer[match.start():]
+        return output
+
+    def close(self) -> str:
+        if _FOOTER_PATTERN.fullmatch(self.buffer):
+            return ""
+        return self.buffer
+
+
+class _MarkerFilter:
+    """Removes every occurrence of the step completion marker"""
+
+    def __init__(self, marker: str):
+        self.marker = marker
+        self.buffer = ""
+
+    def feed(self, text: str) -> str:
+        if not self.buffer and self.marker[0] not in text:
+            return text  # Fast path: no marker can start in this chunk
+
+        parts = (self.buffer + text).split(self.marker)
+        # Only text after the last removed marker can start a new one
+        tail = parts[-1]
+        keep = _partial_suffix_length(tail, self.marker)
+        self.buffer = tail[len(tail) - keep:]
+        return "".join(parts[:-1]) + tail[:len(tail) - keep]
+
+    def close(self) -> str:
+        return self.buffer
+
+
+class _WhitespaceFilter:
+    """Collapses runs of three or more newlines to a blank line and strips both ends"""
+
+    def __init__(self):
+        self.started = False
+        self.pending = ""
+
+    def _flush(self) -> str:
+        whitespace = self.pending
+        self.pending = ""
+        if not self.started:
+            return ""  # Leading whitespace is stripped
+        if whitespace.count("\n") >= 3:
+            first = whitespace.index("\n")
+            last = whitespace.rindex("\n")
+            return whitespace[:first] + "\n\n" + whitespace[last + 1:]
+        return whitespace
+
+    def feed(self, text: str) -> str:
+        output = []
+        position = 0
+        for match in _WHITESPACE_RUN_PATTERN.finditer(text):
+            if match.start() > position:
+                output.append(self._flush())
+                output.append(text[position:match.start()])
+                self.started = True
+            self.pending += match.group()
+            position = match.end()
+        if position < len(text):
+            output.append(self._flush())
+            output.append(text[position:])
+            self.started = True
+        return "".join(output)
+
+    def close(self) -> str:
+        self.pending = ""  # Trailing whitespace is stripped
+        return ""
+
+
+class ResponseStreamParser:
+    """
+    Chunk-at-a-time equivalent of extract_evaluation, extract_sentiment and remove_step_headers.
+
+    Usage:
+        parser = ResponseStreamParser()
+        for chunk in stream:
+            send(parser.feed(chunk))
+        send(parser.close())
+        parser.evaluation, parser.sentiment, parser.response, parser.step_complete
+
+    Concatenating everything returned by feed() and close() gives the same text as
+    remove_step_headers(extract_sentiment(extract_evaluation(full_text)[0])[0]). Header and
+    footer candidates longer than lookahead_limit are released as visible text rather than
+    held indefinitely.
+    """
+
+    def __init__(self, lookahead_limit: int = DEFAULT_LOOKAHEAD_LIMIT):
+        self._evaluation = _TagFilter(EVALUATION_OPEN, EVALUATION_CLOSE)
+        self._sentiment = _TagFilter(SENTIMENT_OPEN, SENTIMENT_CLOSE)
+        self._stages = [
+            _HeaderFilter(lookahead_limit),
+            _FooterFilter(lookahead_limit),
+            _MarkerFilter(STEP_COMPLETE_MARKER),
+            _WhitespaceFilter(),
+        ]
+        self._response: List[str] = []
+        self.closed = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Process the next chunk of the response.
+
+        Args:
+            chunk: Text delta from the model
+
+        Returns:
+            Text that is safe to show to the user (possibly empty)
+        """
+        text = self._sentiment.feed(self._evaluation.feed(chunk))
+        self._response.append(text)
+        for stage in self._stages:
+            text = stage.feed(text)
+        return text
+
+    def close(self) -> str:
+        """
+        Flush held-back text once the response is complete.
+
+        Returns:
+            Remaining visible text
+        """
+        text = self._evaluation.close()
+        text = self._sentiment.feed(text) + self._sentiment.close()
+        self._response.append(text)
+        for stage in self._stages:
+            text = stage.feed(text) + stage.close()
+        self.closed = True
+        return text
+
+    @property
+    def evaluation(self) -> str:
+        """Content of the evaluation block, as returned by extract_evaluation"""
+        return self._evaluation.content
+
+    @property
+    def sentiment(self) -> str:
+        """Content of the inline sentiment block, as returned by extract_sentiment"""
+        return self._sentiment.content
+
+    @property
+    def response(self) -> str:
+        """Response with the evaluation and sentiment blocks removed, markers intact (as the handlers return it)"""
+        return "".join(self._response)
+
+    @property
+    def step_complete(self) -> bool:
+        """Whether the response so far contains the STEP_COMPLETE marker"""
+        return STEP_COMPLETE_MARKER in self.response
@@ -0,0 +1,134 @@
+"""
+Structured step replies through tool use.
+
+In structured mode a step call is forced to answer through the step_reply tool, so the
+message shown to the user, the evaluation, the completion flag and (in step 1) the agreed goal
+come back as separate, typed fields. The reply is validated field by field: no marker search,
+tag slicing or goal regexes are involved, and the step transition follows is_complete alone.
+
+Tool use replies are not streamed as text, so only non-streamed turns use this mode.
+"""
+import logging
+from typing import Any, Dict, NamedTuple, Optional
+
+from sentiment import clamp_score
+
+logger = logging.getLogger(__name__)
+
+STEP_REPLY_TOOL = "step_reply"
+
+# Appended to the per-request part of the step system prompt
+STRUCTURED_INSTRUCTION = (
+    "Reply by calling the step_reply tool. Put everything the user should read in `message`, "
+    "without step headers (\"STEP N: ...\", \"CURRENT STEP: ...\"), STEP_COMPLETE or <evaluation> "
+    "tags; the app shows the step itself. Put your evaluation in `evaluation`. Set `is_complete` "
+    "to true exactly when you would otherwise write STEP_COMPLETE, and whenever you confirm the "
+    "user's goal, put it in `goal` as one short sentence: the goal is only taken from that field."
+)
+SENTIMENT_FIELD_INSTRUCTION = (
+    "Also rate the user's latest message on a rationality vs emotionality scale from -10 "
+    "(highly emotional) to +10 (highly rational) and put the score in `sentiment`."
+)
+
+
+class StructuredReplyError(ValueError):
+    """Raised when a structured reply is missing or does not match the step_reply schema"""
+
+
+class StepReply(NamedTuple):
+    """Validated step_reply tool input"""
+    message: str
+    evaluation: str
+    is_complete: bool
+    goal: Optional[str]
+    sentiment: Optional[int]
+
+
+def step_reply_tool(with_sentiment: bool = False) -> Dict[str, Any]:
+    """
+    Tool definition for structured step replies.
+
+    Args:
+        with_sentiment: Add the inline sentiment score field
+
+    Returns:
+        Tool definition for the Messages API tools parameter
+    """
+    properties = {
+        "message": {"type": "string",
+                    "description": "The reply shown to the user as is, without step headers or tags"},
+        "evaluation": {"type": "string", "description": "Brief evaluation of the user's progress"},
+        "is_complete": {"type": "boolean", "description": "Whether this step is complete"},
+        "goal": {"type": "string",
+                 "description": "The user's confirmed goal, whenever this reply confirms one"},
+    }
+    if with_sentiment:
+        properties["sentiment"] = {"type": "integer", "minimum": -10, "maximum": 10,
+                                   "description": "Rationality (+10) vs emotionality (-10) of the user's message"}
+    return {
+        "name": STEP_REPLY_TOOL,
+        "description": "Send the coaching reply for this turn",
+        "input_schema": {
+            "type": "object",
+            "properties": properties,
+            "required": ["message", "evaluation", "is_complete"],
+        },
+    }
+
+
+def structured_request(with_sentiment: bool = False) -> Dict[str, Any]:
+    """Messages API arguments that force a step_reply tool call"""
+    return {
+        "tools": [step_reply_tool(with_sentiment)],
+        "tool_choice": {"type": "tool", "name": STEP_REPLY_TOOL},
+    }
+
+
+def tool_input(message: Any) -> Optional[Dict[str, Any]]:
+    """Input of the step_reply tool call in a reply message, or None if it has none"""
+    for block in message.content:
+        if getattr(block, "type", None) == "tool_use" and block.name == STEP_REPLY_TOOL:
+            return block.input
+    return None
+
+
+def parse_step_reply(payload: Any) -> StepReply:
+    """
+    Validate a step_reply tool input.
+
+    Args:
+        payload: The tool call's input
+
+    Returns:
+        StepReply with stripped text fields; a blank goal becomes None
+
+    Raises:
+        StructuredReplyError: If the payload is missing or a field has the wrong type
+    """
+    if not isinstance(payload, dict):
+        raise StructuredReplyError("Reply did not call the step_reply tool")
+
+    message = payload.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise StructuredReplyError("step_reply 'message' must be a non-empty string")
+    evaluation = payload.get("evaluation", "")
+    if not isinstance(evaluation, str):
+        raise StructuredReplyError("step_reply 'evaluation' must be a string")
+    is_complete = payload.get("is_complete")
+    if not isinstance(is_complete, bool):
+        raise StructuredReplyError("step_reply 'is_complete' must be a boolean")
+    goal = payload.get("goal")
+    if goal is not None and not isinstance(goal, str):
+        raise StructuredReplyError("step_reply 'goal' must be a string")
+    sentiment = payload.get("sentiment")
+    if sentiment is not None and (isinstance(sentiment, bool) or not isinstance(sentiment, int)):
+        logger.warning(f"Ignoring invalid step_reply sentiment {sentiment!r}")
+        sentiment = None
+
+    return StepReply(
+        message=message.strip(),
+        evaluation=evaluation.strip(),
+        is_complete=is_complete,
+        goal=(goal.strip() or None) if goal is not None else None,
+        sentiment=clamp_score(sentiment) if sentiment is not None else None,
+    )
@@ -3,50 +3,62 @@ Utility functions for the 5-step process coaching application.
 """
 import re
 import time
+import logging
+import threading
 import functools
-from typing import List, Dict, Tuple, Optional, Any, Callable
-import anthropic
-from config import MAX_RETRIES, RETRY_DELAY, MAX_HISTORY_MESSAGES, STEP_COMPLETE_MARKER
+from typing import List, Dict, Tuple, Optional, Any, Callable, Iterable, NamedTuple
+from config import MAX_RETRIES, RETRY_DELAY, STEP_COMPLETE_MARKER, RATE_LIMIT_MAX_WAIT
+from retry_policy import RetryPolicy, circuit_breaker
+from rate_limiter import PRIORITY_COACHING, estimate_request_tokens, rate_limiter
+from metrics import observe_api_call
 
-def truncate_history(history: List[Dict[str, str]], max_messages: int = MAX_HISTORY_MESSAGES) -> List[Dict[str, str]]:
+logger = logging.getLogger(__name__)
+
+# Marks a prompt prefix as cacheable by the Anthropic prompt cache
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def compress_content(role: str, content: str) -> str:
     """
-    Truncate conversation history if needed to prevent token limit issues.
-    Also compresses content to reduce cookie size.
+    Shorten an old message while keeping its gist.
     
     Args:
-        history: List of message dictionaries
-        max_messages: Maximum number of messages to keep
+        role: 'user' or 'assistant'
+        content: Message text
         
     Returns:
-        Truncated history list
+        The shortened text (unchanged if already short)
     """
-    if not history:
-        return []
-        
-    # First truncate the list if it's too long
-    if len(history) > max_messages:
-        # Keep the most recent messages
-        history = history[-max_messages:]
-    
-    # Then compress the content of older messages to reduce cookie size
-    # Keep the last 10 messages intact, compress older ones
-    if len(history) > 10:
-        for i in range(len(history) - 10):
-            # Compress user messages more aggressively than assistant responses
-            if history[i]['role'] == 'user':
-                # Keep only first 100 chars of user messages
-                if len(history[i]['content']) > 100:
-                    history[i]['content'] = history[i]['content'][:100] + "..."
-            else:
-                # For assistant messages, keep about half of the content
-                content_len = len(history[i]['content'])
-                if content_len > 200:
-                    # Keep first paragraph, middle ellipsis, last paragraph
-                    first_part = history[i]['content'][:100]
-                    last_part = history[i]['content'][-100:]
-                    history[i]['content'] = f"{first_part}...[content trimmed]...{last_part}"
-    
-    return history
+    # Compress user messages more aggressively than assistant responses
+    if role == 'user':
+        # Keep only first 100 chars of user messages
+        if len(content) > 100:
+            return content[:100] + "..."
+        return content
+    
+    # For assistant messages, keep the beginning and end with an ellipsis in between
+    if len(content) > 200:
+        return f"{content[:100]}...[content trimmed]...{content[-100:]}"
+    return content
+
+# Goal phrasings, in order of preference; the goal runs to the end of the sentence
+_GOAL_PATTERNS = [re.compile(pattern) for pattern in (
+    r'Goal confirmed: (.+?)(?:\.|\!)',
+    r'goal is: (.+?)(?:\.|\!)',
+    r'focusing on (.+?)(?:\.|\!)',
+    r'aiming to (.+?)(?:\.|\!)',
+)]
+# The goal ends where Claude moves on to the next part of the conversation
+_GOAL_CUTOFF_PATTERN = re.compile(r"I'll help|Let's begin|Let's move|Now let's|Your insight")
+_GOAL_CONFIRMED = "Goal confirmed:"
+
+_HEADER_PATTERN = re.compile(r'STEP \d+: [A-Z\s]+')
+_FOOTER_PREFIX = "CURRENT STEP: "
+_FOOTER_PATTERN = re.compile(r'CURRENT STEP: \d+ - [A-Z\s]+\Z')
+_BLANK_LINES_PATTERN = re.compile(r'\n\s*\n\s*\n')
+
+def _cut_goal(goal: str) -> str:
+    match = _GOAL_CUTOFF_PATTERN.search(goal)
+    return goal[:match.start()].strip() if match else goal
 
 def extract_goal(response: str) -> Optional[str]:
     """
@@ -59,49 +71,42 @@ def extract_goal(response: str) -> Optional[str]:
     Returns:
         Extracted goal or None if not found
     """
-    # Try several patterns to extract the goal
-    patterns = [
-        r'Goal confirmed: (.+?)(?:\.|\!)',
-        r'goal is: (.+?)(?:\.|\!)',
-        r'focusing on (.+?)(?:\.|\!)',
-        r'aiming to (.+?)(?:\.|\!)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, response)
+    for pattern in _GOAL_PATTERNS:
+        match = pattern.search(response)
         if match:
-            goal = match.group(1).strip()
-            # Further clean the goal by removing any text after certain phrases
-            for cutoff in ["I'll help", "Let's begin", "Let's move", "Now let's", "Your insight"]:
-                if cutoff in goal:
-                    goal = goal.split(cutoff)[0].strip()
-            return goal
+            return _cut_goal(match.group(1).strip())
     
     # Fallback method if patterns don't match
-    if "Goal confirmed" in response:
-        parts = response.split("Goal confirmed:")
-        if len(parts) > 1:
-            goal_part = parts[1].strip()
-            # Extract until the end of sentence or first period
-            end_index = goal_part.find('.')
-            if end_index != -1:
-                goal = goal_part[:end_index].strip()
-            else:
-                # If no period, try finding "Moving to next step"
-                end_index = goal_part.find('Moving to next step')
-                if end_index != -1:
-                    goal = goal_part[:end_index].strip()
-                else:
-                    goal = goal_part.strip()
-                    
-            # Further clean the goal by removing any text after certain phrases
-            for cutoff in ["I'll help", "Let's begin", "Let's move", "Now let's", "Your insight"]:
-                if cutoff in goal:
-                    goal = goal.split(cutoff)[0].strip()
-            return goal
+    index = response.find(_GOAL_CONFIRMED)
+    if index != -1:
+        # Up to a repeated confirmation, if there is one
+        start = index + len(_GOAL_CONFIRMED)
+        next_index = response.find(_GOAL_CONFIRMED, start)
+        goal_part = response[start:next_index if next_index != -1 else len(response)].strip()
+        # Extract until the end of sentence or first period
+        end_index = goal_part.find('.')
+        if end_index == -1:
+            # If no period, try finding "Moving to next step"
+            end_index = goal_part.find('Moving to next step')
+        goal = goal_part[:end_index].strip() if end_index != -1 else goal_part
+        return _cut_goal(goal)
     
     return None
 
+def _split_step_markers(response: str) -> Tuple[str, str, str]:
+    """(header, body, footer) of a response; body still contains any STEP_COMPLETE markers"""
+    header = _HEADER_PATTERN.match(response)
+    header_end = header.end() if header else 0
+    # Only the last footer prefix can start a footer running to the end of the text
+    footer_start = response.rfind(_FOOTER_PREFIX, header_end)
+    if footer_start == -1 or not _FOOTER_PATTERN.match(response, footer_start):
+        footer_start = len(response)
+    return response[:header_end], response[header_end:footer_start], response[footer_start:]
+
+def _clean_body(body: str) -> str:
+    # Remove the STEP_COMPLETE marker, then clean up any extra whitespace created by removing markers
+    return _BLANK_LINES_PATTERN.sub('\n\n', body.replace(STEP_COMPLETE_MARKER, "")).strip()
+
 def remove_step_headers(response: str) -> str:
     """
     Remove STEP headers and footers from the response.
@@ -112,21 +117,7 @@ def remove_step_headers(response: str) -> str:
     Returns:
         Cleaned response without headers/footers
     """
-    # Remove the header (STEP X: TITLE)
-    header_pattern = r'^STEP \d+: [A-Z\s]+'
-    response = re.sub(header_pattern, '', response)
-    
-    # Remove the footer (CURRENT STEP: X - TITLE)
-    footer_pattern = r'CURRENT STEP: \d+ - [A-Z\s]+$'
-    response = re.sub(footer_pattern, '', response)
-    
-    # Remove the STEP_COMPLETE marker
-    response = response.replace(STEP_COMPLETE_MARKER, "")
-    
-    # Clean up any extra whitespace created by removing markers
-    response = re.sub(r'\n\s*\n\s*\n', '\n\n', response).strip()
-    
-    return response
+    return _clean_body(_split_step_markers(response)[1])
 
 def extract_evaluation(response: str) -> Tuple[str, str]:
     """
@@ -149,6 +140,38 @@ def extract_evaluation(response: str) -> Tuple[str, str]:
     
     return response, evaluation_summary
 
+EVALUATION_OPEN = "<evaluation>"
+EVALUATION_CLOSE = "</evaluation>"
+SENTIMENT_OPEN = "<sentiment>"
+SENTIMENT_CLOSE = "</sentiment>"
+
+def extract_sentiment(response: str) -> Tuple[str, str]:
+    """
+    Cut the inline sentiment score block from a response.
+    
+    Args:
+        response: Response text, possibly containing <sentiment>N</sentiment>
+        
+    Returns:
+        Tuple of (cleaned_response, score_text); score_text is empty without a complete block
+    """
+    start = response.find(SENTIMENT_OPEN)
+    if start == -1:
+        return response, ""
+    end = response.find(SENTIMENT_CLOSE, start + len(SENTIMENT_OPEN))
+    if end == -1:
+        return response, ""
+    score_text = response[start + len(SENTIMENT_OPEN):end].strip()
+    return response[:start] + response[end + len(SENTIMENT_CLOSE):], score_text
+
+# Markers that complete Step 1 (the goal is agreed)
+GOAL_COMPLETION_MARKERS = [
+    STEP_COMPLETE_MARKER,
+    "Goal confirmed", 
+    "goal is confirmed", 
+    "confirmed your goal"
+]
+
 def check_step_completion(response: str) -> bool:
     """
     Check if the step is complete based on response markers.
@@ -159,45 +182,316 @@ def check_step_completion(response: str) -> bool:
     Returns:
         True if the step is complete, False otherwise
     """
-    completion_markers = [
-        STEP_COMPLETE_MARKER,
-        "Goal confirmed", 
-        "goal is confirmed", 
-        "confirmed your goal"
+    return any(marker in response for marker in GOAL_COMPLETION_MARKERS)
+
+class ProcessedResponse(NamedTuple):
+    """Everything taken from one step reply"""
+    # Reply without the evaluation and sentiment blocks, as kept in history
+    response: str
+    # response without the step header, footer and STEP_COMPLETE markers, as shown to the user
+    visible: str
+    evaluation: str
+    # Inline sentiment score text, empty without a complete <sentiment> block
+    sentiment: str
+    # Completion markers found in response
+    markers: Tuple[str, ...]
+    # Goal candidate; only looked for in replies that complete the step
+    goal: Optional[str]
+    header: str
+    footer: str
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.markers)
+
+def process_response(response: str, completion_markers: Iterable[str] = (STEP_COMPLETE_MARKER,)) -> ProcessedResponse:
+    """
+    Post-process a complete step reply in one go.
+    
+    Equivalent to extract_evaluation, then extract_sentiment, a completion marker check,
+    extract_goal and remove_step_headers on the result, for replies whose evaluation closing
+    tag follows its opening tag. Each tag, marker and the footer is searched for once, with
+    str.find (faster in CPython than one regex alternation over prose); the header, footer
+    and goal are matched with precompiled patterns, and the goal only in completing replies.
+    
+    Args:
+        response: Full reply text
+        completion_markers: Any of these in the reply completes the step
+        
+    Returns:
+        ProcessedResponse
+    """
+    # First evaluation block, then the first sentiment block of what remains
+    evaluation = ""
+    start = response.find(EVALUATION_OPEN)
+    if start != -1:
+        end = response.find(EVALUATION_CLOSE, start + len(EVALUATION_OPEN))
+        if end != -1:
+            evaluation = response[start + len(EVALUATION_OPEN):end].strip()
+            response = response[:start] + response[end + len(EVALUATION_CLOSE):]
+    response, sentiment = extract_sentiment(response)
+    
+    markers = tuple([marker for marker in completion_markers if marker in response])
+    header, body, footer = _split_step_markers(response)
+    return ProcessedResponse(
+        response=response,
+        visible=_clean_body(body),
+        evaluation=evaluation,
+        sentiment=sentiment,
+        markers=markers,
+        goal=extract_goal(response) if markers else None,
+        header=header,
+        footer=footer,
+    )
+
+def build_system_blocks(static_prompt: str, dynamic_context: str) -> List[Dict[str, Any]]:
+    """
+    Build a system prompt as a cacheable static prefix followed by a small dynamic suffix.
+    
+    Args:
+        static_prompt: Prompt text that is identical on every request for a step
+        dynamic_context: Per-request values such as the goal and coaching stage
+        
+    Returns:
+        List of system content blocks for client.messages.create
+    """
+    return [
+        {"type": "text", "text": static_prompt, "cache_control": CACHE_CONTROL},
+        {"type": "text", "text": dynamic_context},
     ]
+
+def mark_history_cache(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Mark the conversation history (everything before the new user message) as cacheable.
     
-    return any(marker in response for marker in completion_markers)
+    Args:
+        messages: Message list ending with the current user input
+        
+    Returns:
+        Copy of the message list with a cache breakpoint on the last history message
+    """
+    if len(messages) < 2:
+        return messages
+    
+    messages = list(messages)
+    last_history = messages[-2]
+    content = last_history['content']
+    if isinstance(content, str):
+        blocks = [{"type": "text", "text": content}]
+    else:
+        blocks = [dict(block) for block in content]
+    blocks[-1]["cache_control"] = CACHE_CONTROL
+    messages[-2] = {"role": last_history['role'], "content": blocks}
+    return messages
 
-def with_retry(max_retries: int = MAX_RETRIES, delay: int = RETRY_DELAY) -> Callable:
+# Per-step token usage, used to verify prompt cache hit rates and latency
+USAGE_STATS: Dict[str, Dict[str, float]] = {}
+_usage_lock = threading.Lock()
+
+def record_usage(label: str, usage: Any, duration: float, prompt_version: Optional[str] = None,
+                 model: Optional[str] = None, stage: Optional[str] = None) -> None:
     """
-    Decorator to add retry logic to API calls.
+    Log and accumulate token usage for one Messages API request, and add it to the metrics.
+    
+    Args:
+        label: Name of the call site (e.g. "step1")
+        usage: The usage object from the API response
+        duration: Wall time of the request in seconds
+        prompt_version: Hash of the system prompt sent, if known
+        model: Model the request was sent to
+        stage: Coaching stage, for steps that have stages
+    """
+    observe_api_call(label, usage, duration, model, stage)
+    input_tokens = getattr(usage, 'input_tokens', 0) or 0
+    output_tokens = getattr(usage, 'output_tokens', 0) or 0
+    cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+    cache_write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+    
+    logger.info(
+        f"{label} usage: input={input_tokens} cache_read={cache_read} "
+        f"cache_write={cache_write} output={output_tokens} time={duration:.2f}s"
+        + (f" prompt={prompt_version}" if prompt_version else "")
+    )
+    
+    with _usage_lock:
+        stats = USAGE_STATS.setdefault(label, {
+            'requests': 0, 'input_tokens': 0, 'output_tokens': 0,
+            'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0, 'total_seconds': 0.0,
+        })
+        stats['requests'] += 1
+        stats['input_tokens'] += input_tokens
+        stats['output_tokens'] += output_tokens
+        stats['cache_read_input_tokens'] += cache_read
+        stats['cache_creation_input_tokens'] += cache_write
+        stats['total_seconds'] += duration
+        if prompt_version:
+            stats['prompt_version'] = prompt_version
+
+def usage_summary() -> Dict[str, Dict[str, float]]:
+    """
+    Snapshot of accumulated usage per call site, with cache hit ratio and mean latency.
+    
+    Returns:
+        Dictionary keyed by label
+    """
+    with _usage_lock:
+        summary = {label: dict(stats) for label, stats in USAGE_STATS.items()}
+    for stats in summary.values():
+        prompt_tokens = (stats['input_tokens'] + stats['cache_read_input_tokens']
+                         + stats['cache_creation_input_tokens'])
+        stats['cache_hit_ratio'] = round(stats['cache_read_input_tokens'] / prompt_tokens, 3) if prompt_tokens else 0.0
+        stats['mean_seconds'] = round(stats['total_seconds'] / stats['requests'], 3)
+    return summary
+
+def create_message(client, on_text: Optional[Callable[[str], None]] = None,
+                   usage_label: Optional[str] = None, prompt_version: Optional[str] = None,
+                   stage: Optional[str] = None, **request: Any) -> Any:
+    """
+    Send a Messages API request and return the reply message.
+    
+    Args:
+        client: Anthropic client
+        on_text: Optional callback; when given, the reply is streamed and each
+                 text delta is passed to it as soon as it arrives
+        usage_label: When given, token usage is logged and accumulated under this name
+        prompt_version: Prompt hash logged alongside the usage
+        stage: Coaching stage the usage metrics are labelled with
+        **request: Arguments for client.messages.create (model, max_tokens, system, messages)
+        
+    Returns:
+        The anthropic Message
+        
+    Raises:
+        RateLimitTimeout: If the rate limiter could not admit the request within RATE_LIMIT_MAX_WAIT
+    """
+    start_time = time.monotonic()
+    # Coaching turns go ahead of any queued sentiment calls
+    reservation = rate_limiter.acquire(PRIORITY_COACHING, estimate_request_tokens(request),
+                                       request.get('max_tokens', 0), timeout=RATE_LIMIT_MAX_WAIT)
+    try:
+        if on_text is None:
+            message = client.messages.create(**request)
+        else:
+            with client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    on_text(text)
+                message = stream.get_final_message()
+        reservation.settle(message.usage)
+    finally:
+        # A failed, rejected (429) or cancelled call must not keep max_tokens reserved; retries reserve again
+        reservation.release()
+    
+    if usage_label:
+        record_usage(usage_label, message.usage, time.monotonic() - start_time, prompt_version,
+                     request.get('model'), stage)
+    return message
+
+def create_message_text(client, on_text: Optional[Callable[[str], None]] = None,
+                        usage_label: Optional[str] = None, prompt_version: Optional[str] = None,
+                        stage: Optional[str] = None, **request: Any) -> str:
+    """
+    Send a Messages API request and return the text of the reply (see create_message).
+    
+    Returns:
+        Full text of the reply
+    """
+    return create_message(client, on_text, usage_label, prompt_version, stage, **request).content[0].text
+
+async def create_message_async(client, on_text: Optional[Callable[[str], None]] = None,
+                               usage_label: Optional[str] = None, prompt_version: Optional[str] = None,
+                               stage: Optional[str] = None, **request: Any) -> Any:
+    """
+    Coroutine version of create_message for anthropic.AsyncAnthropic clients.
+    
+    Args:
+        client: AsyncAnthropic client
+        on_text: Optional callback; when given, the reply is streamed and each
+                 text delta is passed to it as soon as it arrives
+        usage_label: When given, token usage is logged and accumulated under this name
+        prompt_version: Prompt hash logged alongside the usage
+        stage: Coaching stage the usage metrics are labelled with
+        **request: Arguments for client.messages.create (model, max_tokens, system, messages)
+        
+    Returns:
+        The anthropic Message
+    """
+    start_time = time.monotonic()
+    reservation = await rate_limiter.acquire_async(PRIORITY_COACHING, estimate_request_tokens(request),
+                                                   request.get('max_tokens', 0), timeout=RATE_LIMIT_MAX_WAIT)
+    try:
+        if on_text is None:
+            message = await client.messages.create(**request)
+        else:
+            async with client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    on_text(text)
+                message = await stream.get_final_message()
+        reservation.settle(message.usage)
+    finally:
+        # A failed, rejected (429) or cancelled call must not keep max_tokens reserved; retries reserve again
+        reservation.release()
+    
+    if usage_label:
+        record_usage(usage_label, message.usage, time.monotonic() - start_time, prompt_version,
+                     request.get('model'), stage)
+    return message
+
+async def create_message_text_async(client, on_text: Optional[Callable[[str], None]] = None,
+                                    usage_label: Optional[str] = None, prompt_version: Optional[str] = None,
+                                    stage: Optional[str] = None, **request: Any) -> str:
+    """
+    Coroutine version of create_message_text for anthropic.AsyncAnthropic clients.
+    
+    Returns:
+        Full text of the reply
+    """
+    message = await create_message_async(client, on_text, usage_label, prompt_version, stage, **request)
+    return message.content[0].text
+
+def with_retry(max_retries: int = MAX_RETRIES, delay: int = RETRY_DELAY,
+               retry_if: Optional[Callable[[Exception], bool]] = None) -> Callable:
+    """
+    Decorator to add retry logic to API calls (see retry_policy.RetryPolicy).
+    
+    Only transient errors are retried, with jittered backoff or the server's retry-after,
+    and never past RETRY_DEADLINE. Calls fail fast with CircuitOpenError while the shared
+    circuit breaker is open.
     
     Args:
         max_retries: Maximum number of retry attempts
-        delay: Delay between retries in seconds
+        delay: Backoff ceiling in seconds for the first retry, doubling on each retry
+        retry_if: Optional check; a retryable error is re-raised at once when it returns False
         
     Returns:
         Decorated function with retry logic
     """
+    policy = RetryPolicy(max_retries, delay, breaker=circuit_breaker)
+    
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            last_exception = None
-            for attempt in range(max_retries + 1):
-                try:
-                    return func(*args, **kwargs)
-                except (anthropic.RateLimitError, 
-                       anthropic.APITimeoutError, 
-                       anthropic.BadRequestError,
-                       anthropic.APIConnectionError) as e:
-                    last_exception = e
-                    if attempt < max_retries:
-                        # Exponential backoff with jitter
-                        sleep_time = delay * (2 ** attempt) + (time.time() % 1)
-                        time.sleep(sleep_time)
-                    else:
-                        break
-            # If we've exhausted our retries, raise the last exception
-            raise last_exception
+            return policy.call(lambda: func(*args, **kwargs), retry_if)
+        return wrapper
+    return decorator
+
+def with_async_retry(max_retries: int = MAX_RETRIES, delay: int = RETRY_DELAY,
+                     retry_if: Optional[Callable[[Exception], bool]] = None) -> Callable:
+    """
+    Coroutine version of with_retry; waits between attempts without blocking the event loop.
+    
+    Args:
+        max_retries: Maximum number of retry attempts
+        delay: Backoff ceiling in seconds for the first retry, doubling on each retry
+        retry_if: Optional check; a retryable error is re-raised at once when it returns False
+        
+    Returns:
+        Decorated coroutine function with retry logic
+    """
+    policy = RetryPolicy(max_retries, delay, breaker=circuit_breaker)
+    
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await policy.call_async(lambda: func(*args, **kwargs), retry_if)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator